@@ -1,8 +1,19 @@
 import os
-import requests
+import copy
+import json
+import time
+import asyncio
+import importlib
+import threading
+from concurrent.futures import Future
+import httpx
 from dotenv import load_dotenv
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import anthropic
+from llm_cache import get_llm_cache, CacheMissError
+from context_budget import ContextBudget, estimate_tokens
+from telemetry import Span, span, count_tokens
+
+# Heavy backend libraries (transformers/torch, anthropic, tiktoken) are imported on first use
+# by the provider that needs them, so startup only pays for the provider actually selected.
 
 # Load environment variables from key.env
 load_dotenv("key.env")
@@ -10,146 +21,433 @@ load_dotenv("key.env")
 # Configuration for each provider
 # Ollama
 OLLAMA_MODEL_NAME = "deepseek-r1:1.5b"
-OLLAMA_API_URL = "http://localhost:11434/v1/chat/completions"
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434/v1/chat/completions")
 # OpenAI
 OPENAI_MODEL_NAME = "gpt-3.5-turbo"
-OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 # Anthropic
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 ANTHROPIC_MODEL_NAME = "claude-3-opus-20240229"
+# Reply length cap; the model's own output limit, which the agent's max_tokens budget may exceed
+ANTHROPIC_MAX_TOKENS = int(os.getenv("ANTHROPIC_MAX_TOKENS", "4096"))
 # HuggingFace
 HF_DEFAULT_MODEL = "Qwen/Qwen-1_8B-Chat"
 # DeepSeek
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-DEEPSEEK_MODEL_NAME = "deepseek-chat"  
-DEEPSEEK_API_URL = "https://api.deepseek.com"
+DEEPSEEK_MODEL_NAME = "deepseek-chat"
+DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/chat/completions")
 
-# Global variables for Hugging Face model and tokenizer
-hf_model = None
-hf_tokenizer = None
+# Context window sizes in tokens
+OPENAI_CONTEXT_WINDOW = int(os.getenv("OPENAI_CONTEXT_WINDOW", "16385"))
+DEEPSEEK_CONTEXT_WINDOW = int(os.getenv("DEEPSEEK_CONTEXT_WINDOW", "64000"))
+OLLAMA_CONTEXT_WINDOW = int(os.getenv("OLLAMA_CONTEXT_WINDOW", "8192"))
+ANTHROPIC_CONTEXT_WINDOW = int(os.getenv("ANTHROPIC_CONTEXT_WINDOW", "200000"))
+HF_CONTEXT_WINDOW = int(os.getenv("HF_CONTEXT_WINDOW", "8192"))
 
-# Global variable for Anthropic client
-anthropic_client = None
+# HTTP settings shared by all remote providers (seconds / connection counts)
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "600"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
 
-def send_agent_message(messages, provider="ollama", max_tokens=16000):
-    """Send a message to the specified provider and return the response."""
-    if provider.lower() == "openai":
-        return _send_openai_message(messages, max_tokens)
-    elif provider.lower() == "ollama":
-        return _send_ollama_message(messages)
-    elif provider.lower() == "huggingface":
-        return _send_huggingface_message(messages)
-    elif provider.lower() == "anthropic":
-        return _send_anthropic_message(messages)
-    elif provider.lower() == "deepseek":
-        return _send_deepseek_message(messages)
-    else:
-        raise ValueError(f"Unknown provider: {provider}")
-
-def _send_ollama_message(messages):
-    """Send messages to the Ollama API."""
-    headers = {"Content-Type": "application/json"}
-    data = {
-        "messages": messages,
-        "model": OLLAMA_MODEL_NAME
-    }
-    try:
-        response = requests.post(OLLAMA_API_URL, json=data, headers=headers)
+
+def _http_timeout():
+    return httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+
+
+class Provider:
+    """Asynchronous interface implemented by every model backend."""
+
+    name = None
+    model = None
+    context_window = 8192
+
+    async def send(self, messages, max_tokens):
+        """Return a chat completion dict for the messages, or None on failure."""
+        raise NotImplementedError
+
+    async def stream(self, messages, max_tokens):
+        """Yield the completion text as it arrives; the default yields the whole reply at once."""
+        chat_data = await self.send(messages, max_tokens)
+        if chat_data is None:
+            raise RuntimeError(f"{self.name} returned no response")
+        yield chat_data["choices"][0]["message"]["content"]
+
+    def count_tokens(self, text):
+        """Count tokens with the provider's tokenizer when one is available locally."""
+        return estimate_tokens(text)
+
+    async def aclose(self):
+        """Release pooled connections or other resources held by the provider."""
+
+
+class OpenAICompatibleProvider(Provider):
+    """Provider for any endpoint that speaks the OpenAI chat completions protocol."""
+
+    def __init__(self, name, url, model, api_key=None, context_window=8192, tiktoken_encoding=None):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+        self.context_window = context_window
+        self._client = None
+        self._loop = None
+        self._encoding = None
+        if tiktoken_encoding:
+            try:
+                import tiktoken
+            except ImportError:  # Token counts fall back to a character estimate
+                return
+            try:
+                try:
+                    self._encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    self._encoding = tiktoken.get_encoding(tiktoken_encoding)
+            except Exception as err:  # The BPE file is downloaded on first use, which fails offline
+                print(f"[INFO] {name} tokenizer unavailable ({err}); estimating token counts")
+                self._encoding = None
+
+    def count_tokens(self, text):
+        if self._encoding is None:
+            return estimate_tokens(text)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def client(self):
+        """Return the keep-alive client for the running event loop, creating it on first use."""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            headers = {"Content-Type": "application/json"}
+            if self.api_key:
+                headers["Authorization"] = f"Bearer {self.api_key}"
+            self._client = httpx.AsyncClient(
+                headers=headers,
+                timeout=_http_timeout(),
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_CONNECTIONS
+                )
+            )
+            self._loop = loop
+        return self._client
+
+    def at(self, url, model=None):
+        """Copy of this provider for another endpoint (and optionally model) of the same service."""
+        clone = copy.copy(self)
+        clone.url = url
+        clone.model = model or self.model
+        clone._client = None
+        clone._loop = None
+        return clone
+
+    def payload(self, messages, max_tokens):
+        return {"model": self.model, "messages": messages}
+
+    async def request(self, messages, max_tokens):
+        """Return the chat completion dict; raises on transport and HTTP errors."""
+        response = await self.client().post(self.url, json=self.payload(messages, max_tokens))
         response.raise_for_status()
         return response.json()
-    except requests.exceptions.HTTPError as err:
-        print(f"[ERROR] HTTP Error: {response.text}")
-        return None
-    except Exception as err:
-        print(f"[ERROR] Unexpected error: {err}")
-        return None
-
-def _send_openai_message(messages, max_tokens):
-    """Send messages to the OpenAI API."""
-    import openai
-    openai.api_key = OPENAI_API_KEY
-    
-    # Approximate token count: 1 token ≈ 4 characters
-    total_chars = sum(len(m["content"]) for m in messages)
-    max_chars = (max_tokens - 1000) * 4  # Reserve 1,000 tokens for the response
-    
-    if total_chars > max_chars:
-        # Preserve system message, remove oldest non-system messages
-        system_message = next((m for m in messages if m["role"] == "system"), None)
-        other_messages = [m for m in messages if m["role"] != "system"]
-        while total_chars > max_chars and other_messages:
-            removed = other_messages.pop(0)
-            total_chars -= len(removed["content"])
-        messages = [system_message] + other_messages if system_message else other_messages
-    
-    try:
-        response = openai.ChatCompletion.create(
-            model=OPENAI_MODEL_NAME,
-            messages=messages
+
+    async def send(self, messages, max_tokens):
+        try:
+            return await self.request(messages, max_tokens)
+        except httpx.HTTPStatusError as err:
+            print(f"[ERROR] {self.name} HTTP error: {err.response.text}")
+            return None
+        except Exception as err:
+            print(f"[ERROR] {self.name} error: {err}")
+            return None
+
+    async def stream(self, messages, max_tokens):
+        payload = dict(self.payload(messages, max_tokens), stream=True)
+        async with self.client().stream("POST", self.url, json=payload) as response:
+            if response.status_code >= 400:
+                body = await response.aread()
+                raise httpx.HTTPStatusError(
+                    f"{self.name} HTTP error: {body.decode(errors='replace')}",
+                    request=response.request, response=response
+                )
+            # Server-sent events: one "data: {json}" line per delta, terminated by [DONE]
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                if choices:
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content:
+                        yield content
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class OllamaProvider(OpenAICompatibleProvider):
+    def __init__(self):
+        super().__init__("ollama", OLLAMA_API_URL, OLLAMA_MODEL_NAME, context_window=OLLAMA_CONTEXT_WINDOW)
+
+
+class OpenAIProvider(OpenAICompatibleProvider):
+    def __init__(self):
+        super().__init__(
+            "openai", OPENAI_API_URL, OPENAI_MODEL_NAME, OPENAI_API_KEY,
+            context_window=OPENAI_CONTEXT_WINDOW, tiktoken_encoding="cl100k_base"
         )
-        return response
-    except Exception as err:
-        print(f"[ERROR] OpenAI error: {err}")
-        return None
-
-def _send_huggingface_message(messages, model_name=HF_DEFAULT_MODEL):
-    """Send messages to a Hugging Face model for local inference."""
-    global hf_model, hf_tokenizer
-    if hf_model is None or hf_tokenizer is None:
-        print(f"[INFO] Loading Hugging Face model: {model_name}")
-        hf_tokenizer = AutoTokenizer.from_pretrained(model_name)
-        hf_model = AutoModelForCausalLM.from_pretrained(model_name)
-    
-    try:
-        # Format messages using the chat template
-        input_text = hf_tokenizer.apply_chat_template(messages, tokenize=False)
-        input_ids = hf_tokenizer.encode(input_text, return_tensors="pt")
-        output_ids = hf_model.generate(input_ids, max_new_tokens=100)
-        response = hf_tokenizer.decode(output_ids[0][len(input_ids[0]):], skip_special_tokens=True)
-        # Return in a format compatible with other providers
-        return {"choices": [{"message": {"content": response}}]}
-    except Exception as err:
-        print(f"[ERROR] Hugging Face inference error: {err}")
-        return None
-
-def _send_anthropic_message(messages):
-    """Send messages to the Anthropic API."""
-    global anthropic_client
-    if anthropic_client is None:
+
+
+class DeepSeekProvider(OpenAICompatibleProvider):
+    def __init__(self):
+        if not DEEPSEEK_API_KEY:
+            raise ValueError("DEEPSEEK_API_KEY not set in key.env")
+        # DeepSeek's tokenizer is not public; cl100k_base is a much closer estimate than characters
+        super().__init__(
+            "deepseek", DEEPSEEK_API_URL, DEEPSEEK_MODEL_NAME, DEEPSEEK_API_KEY,
+            context_window=DEEPSEEK_CONTEXT_WINDOW, tiktoken_encoding="cl100k_base"
+        )
+
+
+class AnthropicProvider(Provider):
+    """Provider backed by the asynchronous Anthropic client."""
+
+    name = "anthropic"
+    context_window = ANTHROPIC_CONTEXT_WINDOW
+
+    def __init__(self):
         if not ANTHROPIC_API_KEY:
             raise ValueError("ANTHROPIC_API_KEY not set in key.env")
-        anthropic_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-    
-    try:
+        self.model = ANTHROPIC_MODEL_NAME
+        self._client = None
+        self._loop = None
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            import anthropic
+            self._client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, timeout=_http_timeout())
+            self._loop = loop
+        return self._client
+
+    def request_args(self, messages, max_tokens):
         # Separate system message if present
         system_message = next((m["content"] for m in messages if m["role"] == "system"), "")
         user_messages = [m for m in messages if m["role"] != "system"]
-        response = anthropic_client.messages.create(
-            model=ANTHROPIC_MODEL_NAME,
-            messages=user_messages,
-            system=system_message,
-            max_tokens=100
-        )
-        return {"choices": [{"message": {"content": response.content[0].text}}]}
-    except Exception as err:
-        print(f"[ERROR] Anthropic API error: {err}")
-        return None
-
-def _send_deepseek_message(messages):
-    """Send messages to the DeepSeek API using OpenAI SDK."""
-    from openai import OpenAI
-    if not DEEPSEEK_API_KEY:
-        raise ValueError("DEEPSEEK_API_KEY not set in key.env")
-    
-    client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_API_URL)
+        return {
+            "model": self.model,
+            "messages": user_messages,
+            "system": system_message,
+            "max_tokens": min(max_tokens, ANTHROPIC_MAX_TOKENS),
+        }
+
+    async def send(self, messages, max_tokens):
+        try:
+            response = await self.client().messages.create(**self.request_args(messages, max_tokens))
+            return {"choices": [{"message": {"role": "assistant", "content": response.content[0].text}}]}
+        except Exception as err:
+            print(f"[ERROR] Anthropic API error: {err}")
+            return None
+
+    async def stream(self, messages, max_tokens):
+        async with self.client().messages.stream(**self.request_args(messages, max_tokens)) as response:
+            async for text in response.text_stream:
+                yield text
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class HuggingFaceProvider(Provider):
+    """Local inference provider; generation runs in a worker thread to keep the loop free."""
+
+    name = "huggingface"
+    context_window = HF_CONTEXT_WINDOW
+
+    def __init__(self, model_name=HF_DEFAULT_MODEL):
+        from hf_engine import LocalInferenceEngine, ContinuousBatcher, HF_MAX_BATCH_SIZE
+        self.model = model_name
+        self.engine = LocalInferenceEngine(model_name)
+        # Concurrent agents share decode steps instead of queueing for the whole model
+        self.batcher = ContinuousBatcher(self.engine) if HF_MAX_BATCH_SIZE > 1 else None
+
+    def count_tokens(self, text):
+        return len(self.engine.load_tokenizer().encode(text, add_special_tokens=False))
+
+    def _submit(self, messages, streamer=None):
+        """Start a generation; returns a concurrent.futures.Future of the reply text."""
+        if self.batcher is not None:
+            return self.batcher.submit(messages, streamer=streamer)
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self.engine.generate(messages, streamer=streamer))
+            except Exception as err:
+                if streamer is not None:
+                    streamer.end()
+                future.set_exception(err)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    async def send(self, messages, max_tokens):
+        try:
+            response = await asyncio.wrap_future(self._submit(messages))
+            # Return in a format compatible with other providers
+            return {"choices": [{"message": {"role": "assistant", "content": response}}]}
+        except Exception as err:
+            print(f"[ERROR] Hugging Face inference error: {err}")
+            return None
+
+    def _start_stream(self, messages):
+        from transformers import TextIteratorStreamer
+        streamer = TextIteratorStreamer(self.engine.load_tokenizer(), skip_prompt=True, skip_special_tokens=True)
+        return iter(streamer), self._submit(messages, streamer=streamer)
+
+    async def stream(self, messages, max_tokens):
+        tokens, done = await asyncio.to_thread(self._start_stream, messages)
+        while True:
+            text = await asyncio.to_thread(next, tokens, None)
+            if text is None:
+                break
+            if text:
+                yield text
+        await asyncio.wrap_future(done)  # Re-raises a generation error
+
+
+# Provider registry: name -> provider class, factory, or "module:attribute" spec resolved on first use.
+# Third-party packages can add providers through the "auto_python_agent.providers" entry point group.
+PROVIDER_ENTRY_POINT_GROUP = "auto_python_agent.providers"
+PROVIDER_REGISTRY = {
+    "openai": OpenAIProvider,
+    "ollama": OllamaProvider,
+    "huggingface": HuggingFaceProvider,
+    "anthropic": AnthropicProvider,
+    "deepseek": DeepSeekProvider,
+}
+
+# One shared provider instance (and so one connection pool) per provider name
+_providers = {}
+_entry_points_loaded = False
+
+def register_provider(name, factory):
+    """Register a provider class, zero-argument factory, or "module:attribute" spec under a name."""
+    PROVIDER_REGISTRY[name.lower()] = factory
+    _providers.pop(name.lower(), None)
+
+def _load_entry_points():
+    """Add providers advertised by installed packages; only runs when a name is not built in."""
+    global _entry_points_loaded
+    _entry_points_loaded = True
+    from importlib.metadata import entry_points
+    for entry_point in entry_points(group=PROVIDER_ENTRY_POINT_GROUP):
+        PROVIDER_REGISTRY.setdefault(entry_point.name.lower(), entry_point.value)
+
+def _resolve_factory(factory):
+    if isinstance(factory, str):
+        module_name, _, attribute = factory.partition(":")
+        factory = importlib.import_module(module_name)
+        for part in attribute.split(".") if attribute else []:
+            factory = getattr(factory, part)
+    return factory
+
+def get_provider(provider):
+    """Return the shared provider instance for a provider name, importing its backend on first use."""
+    name = provider.lower()
+    if name not in _providers:
+        if name not in PROVIDER_REGISTRY and not _entry_points_loaded:
+            _load_entry_points()
+        factory = PROVIDER_REGISTRY.get(name)
+        if factory is None:
+            raise ValueError(f"Unknown provider: {provider}")
+        instance = _resolve_factory(factory)()
+        if isinstance(instance, OpenAICompatibleProvider):
+            from router import EndpointRouter  # router builds on the classes in this module
+            instance = EndpointRouter.for_provider(instance)
+        _providers[name] = instance
+    return _providers[name]
+
+def create_context_budget(provider, max_tokens=16000):
+    """Return a context budget sized to the provider's window and the caller's token limit."""
+    instance = get_provider(provider)
+    return ContextBudget(instance.count_tokens, min(instance.context_window, max_tokens))
+
+def _record_usage(instance, current, budget, chat_data):
+    """Count prompt/completion tokens, preferring the provider's own usage report."""
+    usage = chat_data.get("usage") or {}
+    prompt_tokens = usage.get("prompt_tokens", usage.get("input_tokens"))
+    completion_tokens = usage.get("completion_tokens", usage.get("output_tokens"))
+    if prompt_tokens is None:
+        prompt_tokens = budget.total
+    if completion_tokens is None:
+        completion_tokens = instance.count_tokens(chat_data["choices"][0]["message"].get("content") or "")
+    current.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    count_tokens(instance.name, prompt_tokens, completion_tokens)
+
+async def send_agent_message(messages, provider="ollama", max_tokens=16000, budget=None):
+    """Send a message to the specified provider and return the response."""
+    instance = get_provider(provider)
+    budget = budget or create_context_budget(provider, max_tokens)
+    with span("llm.send", provider=instance.name, model=instance.model) as current:
+        messages = budget.fit(messages)
+        cache = get_llm_cache()
+        if cache is not None:
+            key = cache.key(instance.name, instance.model, messages, max_tokens)
+            cached = cache.get(key)
+            if cached is not None:
+                current.set(cache="hit")
+                return cached
+            if cache.mode == "replay":
+                raise CacheMissError(f"No cached {instance.name} completion for request {key[:12]}")
+        chat_data = await instance.send(messages, max_tokens)
+        if chat_data is None:
+            current.set(failed=True)
+            return None
+        if cache is not None:
+            cache.put(key, chat_data)
+        _record_usage(instance, current, budget, chat_data)
+        return chat_data
+
+async def stream_agent_message(messages, provider="ollama", max_tokens=16000, budget=None):
+    """Yield the provider's response text incrementally as it is generated."""
+    instance = get_provider(provider)
+    budget = budget or create_context_budget(provider, max_tokens)
+    # Not made the current span: the caller's own spans run between our yields
+    current = Span("llm.stream", provider=instance.name, model=instance.model)
+    error = None
     try:
-        response = client.chat.completions.create(
-            model=DEEPSEEK_MODEL_NAME,
-            messages=messages,
-            stream=False
-        )
-        return response
-    except Exception as err:
-        print(f"[ERROR] DeepSeek API error: {err}")
-        return None
\ No newline at end of file
+        messages = budget.fit(messages)
+        cache = get_llm_cache()
+        if cache is not None:
+            key = cache.key(instance.name, instance.model, messages, max_tokens)
+            cached = cache.get(key)
+            if cached is not None:
+                current.set(cache="hit")
+                yield cached["choices"][0]["message"]["content"]
+                return
+            if cache.mode == "replay":
+                raise CacheMissError(f"No cached {instance.name} completion for request {key[:12]}")
+        chunks = []
+        async for text in instance.stream(messages, max_tokens):
+            if not chunks:
+                current.set(first_token_seconds=time.perf_counter() - current.started)
+            chunks.append(text)
+            yield text
+        chat_data = {"choices": [{"message": {"role": "assistant", "content": "".join(chunks)}}]}
+        if cache is not None:
+            cache.put(key, chat_data)
+        _record_usage(instance, current, budget, chat_data)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        current.finish(error=error if not isinstance(error, GeneratorExit) else None)
+
+async def close_providers():
+    """Close every pooled provider client."""
+    for instance in list(_providers.values()):
+        await instance.aclose()
@@ -1,52 +1,174 @@
-import re
+import copy
 from system_prompt import PROMPTS
-from agent import send_agent_message
-from file_manager import process_agent_commands
+from agent import send_agent_message, stream_agent_message, create_context_budget
+from commands import CommandTokenizer, parse_commands
+from llm_cache import CacheMissError
+from history import HistoryCompactor
+from telemetry import span, profile_turn
+from file_manager import process_agent_commands, apply_command
 
 class Agent:
-    def __init__(self, key, provider="ollama", sandbox_dir=None, max_tokens=16000):
+    def __init__(self, key, provider="ollama", sandbox_dir=None, max_tokens=16000, stream=False):
         self.key = key
         self.system_prompt = PROMPTS.get(key, "Default agent prompt")
         self.provider = provider
         self.sandbox_dir = sandbox_dir
         self.max_tokens = max_tokens
+        self.stream = stream
         self.messages = [{"role": "system", "content": self.system_prompt}]
+        self._parsed = (None, [])  # (response, commands) of the last parsed response
+        self.budget = None  # Context budget, created on first use for the provider
+        self.compactor = HistoryCompactor()
+        self.last_executions = []  # ExecutionResults from the most recent turn
+        self.last_changes = []  # FileChanges the most recent turn's commands made to the sandbox
+        self.failed_patches = []  # Feedback for the most recent turn's <pfil> commands that did not apply
 
     async def process_input(self, input_text):
         """Process input and return the response, handling commands asynchronously."""
+        with span("agent.turn", agent=self.key, provider=self.provider), profile_turn(self.key):
+            return await self._process_turn(input_text)
+
+    async def _process_turn(self, input_text):
         self.messages.append({"role": "user", "content": input_text})
-        chat_data = send_agent_message(self.messages, provider=self.provider, max_tokens=self.max_tokens)
+        if self.budget is None:
+            self.budget = create_context_budget(self.provider, self.max_tokens)
+        if self.stream:
+            return await self._process_streaming()
+        try:
+            chat_data = await send_agent_message(self.messages, provider=self.provider, max_tokens=self.max_tokens, budget=self.budget)
+        except CacheMissError:
+            self.messages.pop()  # A retry must not send the input twice
+            raise
         if chat_data is None:
             print(f"[{self.key.upper()} ERROR] Failed to get response.")
+            self.messages.pop()  # Nothing answered the input: leave the history as it was
             return None
         assistant_message = chat_data["choices"][0]["message"]
         self.messages.append(assistant_message)
-        execution_results = await process_agent_commands(assistant_message, self.sandbox_dir)
+        commands = self.parse(assistant_message["content"])
+        self.last_executions = []
+        self.last_changes = []
+        self.failed_patches = []
+        execution_results = await process_agent_commands(
+            assistant_message, self.sandbox_dir, commands, self.last_executions, self.last_changes,
+            self.failed_patches
+        )
+        self._finish_turn(execution_results)
+        return assistant_message["content"]
+
+    async def _process_streaming(self):
+        """Echo tokens as they arrive and apply each command as soon as its tag closes."""
+        tokenizer = CommandTokenizer()
+        commands = []
+        chunks = []
+        execution_results = []
+        self.last_executions = []
+        self.last_changes = []
+        self.failed_patches = []
+        print(f"{self.key.replace('_', ' ').title()}: ", end="", flush=True)
+        try:
+            async for text in stream_agent_message(
+                    self.messages, provider=self.provider, max_tokens=self.max_tokens, budget=self.budget):
+                print(text, end="", flush=True)
+                chunks.append(text)
+                for command in tokenizer.feed(text):
+                    commands.append(command)
+                    # One span per command: a span over the whole stream would also time the model
+                    with span("commands.process", commands=1, streamed=True):
+                        result = await apply_command(
+                            command, self.sandbox_dir, self.last_executions, self.last_changes, self.failed_patches
+                        )
+                    if result:
+                        execution_results.append(result)
+        except CacheMissError as err:
+            self._interrupted(chunks, commands, execution_results, err)
+            raise  # Replay runs must fail loudly rather than look like a provider outage
+        except Exception as err:
+            print(f"\n[{self.key.upper()} ERROR] Failed to get response: {err}")
+            self._interrupted(chunks, commands, execution_results, err)
+            return None
+        print()
+        commands.extend(tokenizer.close())
+        assistant_message = {"role": "assistant", "content": "".join(chunks)}
+        self._parsed = (assistant_message["content"], commands)
+        self.messages.append(assistant_message)
+        self._finish_turn(execution_results)
+        return assistant_message["content"]
+
+    def _interrupted(self, chunks, commands, execution_results, err):
+        """Settle the history after a stream failed part-way.
+
+        With no text received the input is dropped again; otherwise the partial response
+        stays, since its completed commands were already applied to the sandbox.
+        """
+        if not chunks:
+            self.messages.pop()
+            return
+        assistant_message = {"role": "assistant", "content": "".join(chunks)}
+        self._parsed = (assistant_message["content"], commands)
+        self.messages.append(assistant_message)
+        self.messages.append({
+            "role": "system",
+            "content": f"The response above was cut off ({err}); only the commands completed before that were applied.",
+        })
+        self._finish_turn(execution_results)
+
+    def _finish_turn(self, execution_results):
+        """Record execution results and compact history the new turn superseded."""
         if execution_results:
             execution_summary = "Execution results:\n" + "\n".join(execution_results)
             self.messages.append({"role": "system", "content": execution_summary})
-        return assistant_message["content"]
+        self.compactor.compact(self.messages, self.budget)
+
+    def fork(self, sandbox_dir):
+        """Return a copy of this agent with its own history, working in another sandbox."""
+        clone = copy.copy(self)
+        clone.sandbox_dir = sandbox_dir
+        clone.stream = False  # Concurrent forks must not interleave their tokens on the console
+        clone.messages = [dict(message) for message in self.messages]
+        clone.budget = None
+        clone.compactor = HistoryCompactor()
+        clone._parsed = (None, [])
+        clone.last_executions = []
+        clone.last_changes = []
+        clone.failed_patches = []
+        return clone
+
+    def adopt(self, fork):
+        """Take over a fork's history and results (its sandbox is adopted separately)."""
+        self.messages = fork.messages
+        self.budget = fork.budget
+        self.compactor = fork.compactor
+        self._parsed = fork._parsed
+        self.last_executions = fork.last_executions
+        self.last_changes = fork.last_changes
+        self.failed_patches = fork.failed_patches
+
+    def parse(self, response):
+        """Return the response's commands, reusing the last parse for the same response."""
+        if self._parsed[0] is not response:
+            self._parsed = (response, parse_commands(response))
+        return self._parsed[1]
 
     def needs_more_info(self, response):
-        """Check if the response contains a <rinf> tag."""
-        return "<rinf>" in response if response else False
+        """Check if the response contains a <rinf> command."""
+        return any(command.name == "rinf" for command in self.parse(response)) if response else False
 
     def extract_rinf_prompt(self, response):
-        """Extract the prompt from <rinf> tags."""
-        match = re.search(r"<rinf>(.*?)</rinf>", response)
-        return match.group(1) if match else None
+        """Extract the prompt from the first <rinf> command."""
+        return next((command.body for command in self.parse(response) if command.name == "rinf"), None)
 
 class ProductDesignerAgent(Agent):
-    def __init__(self, provider="ollama", sandbox_dir=None, max_tokens=16000):
-        super().__init__("product_designer", provider, sandbox_dir, max_tokens)
+    def __init__(self, provider="ollama", sandbox_dir=None, max_tokens=16000, stream=False):
+        super().__init__("product_designer", provider, sandbox_dir, max_tokens, stream)
 
     async def process_input(self, input_text):
         """Override to handle product design-specific logic."""
         return await super().process_input(input_text)
 
 class SoftwareEngineerAgent(Agent):
-    def __init__(self, provider="ollama", sandbox_dir=None, max_tokens=16000):
-        super().__init__("software_engineer", provider, sandbox_dir, max_tokens)
+    def __init__(self, provider="ollama", sandbox_dir=None, max_tokens=16000, stream=False):
+        super().__init__("software_engineer", provider, sandbox_dir, max_tokens, stream)
 
     async def process_input(self, input_text):
         """Override to handle software engineering-specific logic."""
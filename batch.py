@@ -0,0 +1,162 @@
+"""Headless batch runner: push many project briefs from a JSONL file through the agent pipeline.
+
+Each input line is a JSON object describing one job:
+    {"id": "...", "prompt": "...", "provider": "openai", "agent_keys": [...], "answers": ["..."]}
+"prompt" may be replaced by "title"/"body" (the backlog format), and "id" by "request_id".
+"answers" are handed out in order to the agents' <rinf> questions; once they run out, questions
+are declined and the agent is told to proceed on its own assumptions.
+
+Usage: python batch.py jobs.jsonl --results results.jsonl --concurrency 4 --job-timeout 1800
+"""
+import re
+import json
+import time
+import asyncio
+import argparse
+from main import create_agents, chain_agents, fix_execution_errors, execution_failed
+from file_manager import create_sandbox
+from agent import close_providers
+from telemetry import span, configure_telemetry, flush_metrics, METRICS_PORT
+
+DECLINE_ANSWER = (
+    "No further information is available. Proceed with reasonable assumptions "
+    "and do not ask any more questions."
+)
+MAX_DECLINED_QUESTIONS = 3
+
+
+def job_prompt(job):
+    """Return the project brief for a job record."""
+    if job.get("prompt"):
+        return job["prompt"]
+    return "\n\n".join(part for part in (job.get("title"), job.get("body")) if part)
+
+
+def job_id(job, line_number):
+    return str(job.get("id") or job.get("request_id") or f"job-{line_number}")
+
+
+def read_jobs(path):
+    """Load job records from a JSONL file, skipping blank lines."""
+    jobs = []
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip():
+                job = json.loads(line)
+                job["id"] = job_id(job, line_number)
+                jobs.append(job)
+    return jobs
+
+
+class JobAnswers:
+    """Answers <rinf> questions from the job record, then declines a bounded number of times."""
+
+    def __init__(self, answers):
+        self.answers = list(answers or [])
+        self.asked = 0
+        self.declined = 0
+
+    async def __call__(self, agent, prompt):
+        self.asked += 1
+        if self.answers:
+            return self.answers.pop(0)
+        if self.declined >= MAX_DECLINED_QUESTIONS:
+            return None  # The agent keeps asking; abort rather than loop forever
+        self.declined += 1
+        return DECLINE_ANSWER
+
+
+async def run_job(job, result, provider, agent_keys, max_retries, sandbox_root):
+    """Run the chain and fix-retry loop for one job, filling in its result record as it goes."""
+    started = time.monotonic()
+    label = re.sub(r"[^A-Za-z0-9_-]+", "-", job["id"])[:48]
+    sandbox_dir = await create_sandbox(label=label, root=sandbox_root)
+    result["sandbox"] = sandbox_dir
+
+    agents = create_agents(job.get("agent_keys") or agent_keys, job.get("provider") or provider, sandbox_dir)
+    if agents is None:
+        result["error"] = "unknown agent key"
+        return
+
+    ask = JobAnswers(job.get("answers"))
+    final_output = await chain_agents(agents, job_prompt(job), ask)
+    result["timings"]["chain"] = time.monotonic() - started
+    if final_output is None:
+        result["error"] = "agent phase aborted or failed"
+    else:
+        fix_started = time.monotonic()
+        retry_count = await fix_execution_errors(agents[-1], job.get("max_retries", max_retries), ask)
+        result["timings"]["fix"] = time.monotonic() - fix_started
+        if retry_count is None:
+            result["error"] = "fix attempt aborted or failed"
+        else:
+            result["retries"] = retry_count
+            result["status"] = "failed" if execution_failed(agents[-1]) else "ok"
+    result["questions"] = {"asked": ask.asked, "declined": ask.declined}
+
+
+async def run_batch(jobs, results_path, provider="openai", agent_keys=("product_designer", "software_engineer"),
+                    concurrency=4, job_timeout=1800, max_retries=3, sandbox_root="."):
+    """Run jobs with bounded concurrency, appending one result line per job as it finishes."""
+    semaphore = asyncio.Semaphore(concurrency)
+    write_lock = asyncio.Lock()
+    summary = {}
+
+    async def worker(job):
+        async with semaphore:
+            result = {"id": job["id"], "status": "error", "sandbox": None, "retries": 0, "timings": {}}
+            result["started_at"] = time.time()
+            started = time.monotonic()
+            try:
+                with span("job", job=job["id"]):
+                    await asyncio.wait_for(
+                        run_job(job, result, provider, list(agent_keys), max_retries, sandbox_root), job_timeout
+                    )
+            except asyncio.TimeoutError:
+                result.update(status="timeout", error=f"exceeded {job_timeout}s")
+            except Exception as e:
+                result.update(status="error", error=f"{type(e).__name__}: {e}")
+            result["duration"] = time.monotonic() - started
+            summary[result["status"]] = summary.get(result["status"], 0) + 1
+            async with write_lock:
+                with open(results_path, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+            flush_metrics()
+            print(f"[BATCH] {job['id']}: {result['status']} in {result['duration']:.1f}s")
+
+    try:
+        await asyncio.gather(*(worker(job) for job in jobs))
+    finally:
+        await close_providers()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run project briefs from a JSONL file through the agent pipeline.")
+    parser.add_argument("jobs", help="input JSONL file, one job per line")
+    parser.add_argument("--results", default="results.jsonl", help="output JSONL file (appended to)")
+    parser.add_argument("--provider", default="openai")
+    parser.add_argument("--agents", nargs="+", default=["product_designer", "software_engineer"])
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--job-timeout", type=float, default=1800, help="seconds per job")
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--sandbox-root", default=".")
+    parser.add_argument("--trace", help="append a JSONL span trace to this file")
+    parser.add_argument("--metrics", help="write Prometheus metrics to this file after every job")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="serve /metrics on this port")
+    parser.add_argument("--profile-dir", help="dump a cProfile of every agent turn here")
+    args = parser.parse_args()
+    configure_telemetry(trace_path=args.trace, metrics_path=args.metrics, metrics_port=args.metrics_port,
+                        profile_dir=args.profile_dir)
+
+    jobs = read_jobs(args.jobs)
+    started = time.monotonic()
+    summary = asyncio.run(run_batch(
+        jobs, args.results, provider=args.provider, agent_keys=args.agents, concurrency=args.concurrency,
+        job_timeout=args.job_timeout, max_retries=args.max_retries, sandbox_root=args.sandbox_root
+    ))
+    print(f"[BATCH] {len(jobs)} job(s) in {time.monotonic() - started:.1f}s: {summary}")
+
+
+if __name__ == "__main__":
+    main()
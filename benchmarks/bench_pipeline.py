@@ -0,0 +1,270 @@
+"""End-to-end pipeline benchmark against the local mock LLM server.
+
+Drives main.chain_agents, the fix-retry loop and execute_code through scripted
+scenarios with no API key and no model time, and reports latency percentiles,
+throughput, memory and where the time went (from the telemetry spans).
+Results saved with --json can be compared across commits with --baseline.
+
+Scenarios:
+  chain  designer -> engineer, the generated program runs cleanly
+  fix    the first program fails and one fix-retry repairs it
+  exec   execute_code on an existing script (no LLM calls)
+
+Usage: python benchmarks/bench_pipeline.py [--scenarios chain fix exec] [--iterations 20] [--concurrency 4]
+       [--latency 0.2] [--tokens-per-second 50] [--stream] [--json results.json] [--baseline old.json]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("chain", "fix", "exec")
+# Spans whose time is reported per iteration
+REPORTED_SPANS = ("llm.send", "llm.stream", "commands.process", "exec.environment", "exec.run")
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def max_rss_mb(who):
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(who).ru_maxrss
+    return (maxrss if sys.platform == "darwin" else maxrss * 1024) / 1024 ** 2
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_mock_server(latency, tokens_per_second):
+    """Run the mock server in its own process so its work is not counted as pipeline overhead."""
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "mock_llm.py"), "--port", "0",
+         "--latency", str(latency), "--tokens-per-second", str(tokens_per_second)],
+        stdout=subprocess.PIPE, text=True
+    )
+    line = process.stdout.readline()
+    if not line.startswith("listening on port"):
+        process.kill()
+        raise RuntimeError(f"mock LLM server failed to start: {line!r}")
+    return process, int(line.split()[-1])
+
+
+def span_seconds():
+    """Total seconds recorded so far per reported span."""
+    from telemetry import metrics
+    totals = dict.fromkeys(REPORTED_SPANS, 0.0)
+    for (name, labels), series in list(metrics.histograms.items()):
+        span = dict(labels).get("span")
+        if name == "agent_span_duration_seconds" and span in totals:
+            totals[span] += series[-2]
+    return totals
+
+
+async def decline(agent, prompt):
+    return None  # Scripted replies never ask; abort if one does
+
+
+async def run_chain(provider, sandbox_root, stream):
+    from main import create_agents, chain_agents, execution_failed
+    from file_manager import create_sandbox
+    sandbox_dir = await create_sandbox(root=tempfile.mkdtemp(dir=sandbox_root))
+    agents = create_agents(["product_designer", "software_engineer"], provider, sandbox_dir, stream)
+    if await chain_agents(agents, "Build a number report tool. scenario:ok", decline) is None:
+        raise RuntimeError("chain aborted")
+    if not agents[-1].last_executions or execution_failed(agents[-1]):
+        raise RuntimeError("the scripted program did not run successfully")
+
+
+async def run_fix(provider, sandbox_root, stream):
+    from main import create_agents, chain_agents, fix_execution_errors, execution_failed
+    from file_manager import create_sandbox
+    sandbox_dir = await create_sandbox(root=tempfile.mkdtemp(dir=sandbox_root))
+    agents = create_agents(["product_designer", "software_engineer"], provider, sandbox_dir, stream)
+    if await chain_agents(agents, "Build a number report tool. scenario:fix", decline) is None:
+        raise RuntimeError("chain aborted")
+    retries = await fix_execution_errors(agents[-1], 3, decline)
+    if retries != 1 or execution_failed(agents[-1]):
+        raise RuntimeError(f"expected exactly one successful fix retry, got {retries}")
+
+
+async def run_exec(provider, sandbox_root, stream):
+    from executor import execute_code
+    sandbox_dir = os.path.join(sandbox_root, "exec")
+    script = os.path.join(sandbox_dir, "report.py")
+    if not os.path.exists(script):
+        os.makedirs(sandbox_dir, exist_ok=True)
+        with open(os.path.join(sandbox_dir, "requirements.txt"), "w") as f:
+            f.write("")
+        with open(script, "w") as f:
+            f.write("print(sum(range(1000)))\n")
+    result = await execute_code(script, sandbox_dir)
+    if not result.succeeded:
+        raise RuntimeError(f"execution failed: {result.error or result.stderr}")
+
+
+RUNNERS = {"chain": run_chain, "fix": run_fix, "exec": run_exec}
+
+
+async def bench_scenario(name, args, sandbox_root):
+    runner = RUNNERS[name]
+    # One untimed warm-up builds the pooled venv and opens provider connections
+    warmup_started = time.perf_counter()
+    await runner(args.provider, sandbox_root, args.stream)
+    warmup = time.perf_counter() - warmup_started
+
+    spans_before = span_seconds()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await runner(args.provider, sandbox_root, args.stream)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.iterations)))
+    wall = time.perf_counter() - started
+    spans_after = span_seconds()
+
+    result = {
+        "iterations": args.iterations,
+        "errors": len(errors),
+        "warmup_seconds": warmup,
+        "wall_seconds": wall,
+        "throughput_per_second": len(latencies) / wall if wall else None,
+        "spans_per_iteration": {
+            span: (spans_after[span] - spans_before[span]) / args.iterations
+            for span in REPORTED_SPANS if spans_after[span] > spans_before[span]
+        },
+    }
+    if latencies:
+        result.update(
+            p50_seconds=percentile(latencies, 0.5),
+            p99_seconds=percentile(latencies, 0.99),
+            mean_seconds=sum(latencies) / len(latencies),
+        )
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+async def run_benchmarks(args, sandbox_root):
+    from agent import close_providers
+    results = {}
+    try:
+        for name in args.scenarios:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                results[name] = await bench_scenario(name, args, sandbox_root)
+            print(format_result(name, results[name]))
+    finally:
+        await close_providers()
+    return results
+
+
+def format_result(name, result):
+    if "p50_seconds" not in result:
+        return f"{name:6} all {result['iterations']} iteration(s) failed: {result.get('first_error')}"
+    line = (
+        f"{name:6} p50 {result['p50_seconds'] * 1000:8.1f} ms  p99 {result['p99_seconds'] * 1000:8.1f} ms  "
+        f"{result['throughput_per_second']:7.2f}/s  warm-up {result['warmup_seconds']:.2f}s"
+    )
+    if result["errors"]:
+        line += f"  errors {result['errors']} ({result['first_error']})"
+    spans = ", ".join(f"{span} {seconds * 1000:.1f} ms" for span, seconds in result["spans_per_iteration"].items())
+    return line + (f"\n       per iteration: {spans}" if spans else "")
+
+
+def compare(results, baseline):
+    """Print current/baseline ratios for the headline numbers of each shared scenario."""
+    print(f"\ncompared with {baseline.get('commit') or 'baseline'}:")
+    for name, result in results.items():
+        old = baseline.get("scenarios", {}).get(name)
+        if not old or "p50_seconds" not in old or "p50_seconds" not in result:
+            continue
+        ratios = [
+            f"{key.split('_')[0]} x{result[key] / old[key]:.2f}"
+            for key in ("p50_seconds", "p99_seconds", "throughput_per_second") if old.get(key)
+        ]
+        print(f"  {name:6} " + "  ".join(ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--provider", choices=("openai", "ollama"), default="openai")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock first-token latency in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="mock token rate (0 = instant)")
+    parser.add_argument("--stream", action="store_true", help="use streaming responses")
+    parser.add_argument("--pool-dir", help="venv pool directory (default: a fresh temporary one)")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="results file from an earlier run to compare against")
+    args = parser.parse_args()
+
+    server, port = start_mock_server(args.latency, args.tokens_per_second)
+    work_dir = tempfile.mkdtemp(prefix="bench-pipeline-")
+    # Provider settings are read at import time, so point them at the mock server before importing the pipeline
+    os.environ["OPENAI_API_URL"] = os.environ["OLLAMA_API_URL"] = f"http://127.0.0.1:{port}/v1/chat/completions"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ["LLM_CACHE_MODE"] = "off"
+    os.environ["VENV_POOL_DIR"] = args.pool_dir or os.path.join(work_dir, "venvs")
+    sys.path.insert(0, ROOT)
+    try:
+        results = asyncio.run(run_benchmarks(args, work_dir))
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: getattr(args, key) for key in ("iterations", "concurrency", "provider", "latency",
+                                                        "tokens_per_second", "stream")},
+        "max_rss_mb": max_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "children_max_rss_mb": max_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+        "scenarios": results,
+    }
+    if report["max_rss_mb"] is not None:
+        print(f"peak RSS {report['max_rss_mb']:.1f} MiB (children {report['children_max_rss_mb']:.1f} MiB)")
+    print(f"sandboxes and venvs kept in {work_dir}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Startup benchmark: import time and resident memory of the CLI entry point.
+
+Each measurement runs in a fresh interpreter so nothing is cached in-process.
+Pass --max-seconds / --max-rss-mb to fail (exit code 1) when startup regresses.
+
+Usage: python benchmarks/bench_startup.py [--module main] [--repeat 5] [--max-seconds 1.0] [--max-rss-mb 150]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports the module, then reports wall-clock import time and peak RSS from inside the child
+PROBE = """
+import sys, time, json, resource
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+rss = maxrss if sys.platform == "darwin" else maxrss * 1024
+heavy = sorted(m for m in ("torch", "transformers", "anthropic", "tiktoken") if m in sys.modules)
+print(json.dumps({{"seconds": elapsed, "rss": rss, "heavy": heavy}}))
+"""
+
+
+def measure(module):
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module)],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(module, top):
+    """Return the top cumulative entries from python -X importtime."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        rows.append((int(cumulative), name))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--max-seconds", type=float, help="fail if median import time exceeds this")
+    parser.add_argument("--max-rss-mb", type=float, help="fail if median startup RSS exceeds this")
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.repeat)]
+    seconds = statistics.median(run["seconds"] for run in runs)
+    rss_mb = statistics.median(run["rss"] for run in runs) / 1024 ** 2
+    print(f"import {args.module}: median {seconds * 1000:.1f} ms, RSS {rss_mb:.1f} MiB over {args.repeat} run(s)")
+    if runs[0]["heavy"]:
+        print(f"heavy backends imported at startup: {', '.join(runs[0]['heavy'])}")
+    print("slowest imports (cumulative):")
+    for cumulative, name in slowest_imports(args.module, args.top):
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if args.max_seconds is not None and seconds > args.max_seconds:
+        print(f"[FAIL] import time {seconds:.3f}s exceeds {args.max_seconds}s")
+        failed = True
+    if args.max_rss_mb is not None and rss_mb > args.max_rss_mb:
+        print(f"[FAIL] startup RSS {rss_mb:.1f} MiB exceeds {args.max_rss_mb} MiB")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Micro-benchmark: single-pass command tokenizer vs. the previous per-tag regex scans.
+
+Usage: python benchmarks/bench_tokenizer.py [--megabytes 8] [--repeat 3] [--body-megabytes 1 4] [--chunk-size 4]
+
+The second table streams one large <efil> body in small chunks, as SSE providers emit
+them, which is where a tokenizer that re-copies or re-searches its buffer goes quadratic.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from commands import CommandTokenizer, parse_commands
+
+LEGACY_PATTERNS = [
+    re.compile(r"<cfol>(.*?)</cfol>"),
+    re.compile(r"<cfil>(.*?)</cfil>"),
+    re.compile(r'<efil file="(.*?)">(.*?)</efil>', re.DOTALL),
+    re.compile(r"<exec>(.*?)</exec>"),
+    re.compile(r"<rinf>(.*?)</rinf>"),
+]
+
+
+def legacy_parse(text):
+    """The five finditer passes process_agent_commands used, plus the agent's <rinf> rescan.
+
+    Returns (commands, the <rinf> question or None).
+    """
+    commands = [match for pattern in LEGACY_PATTERNS for match in pattern.finditer(text)]
+    question = None
+    if "<rinf>" in text:
+        match = re.search(r"<rinf>(.*?)</rinf>", text)
+        question = match.group(1) if match else None
+    return commands, question
+
+
+def synthetic_response(megabytes):
+    """Build a response that mixes prose, folders, large file bodies and executions."""
+    body = "".join(f"def f{i}(x):\n    return x < {i} and x > -{i}\n\n" for i in range(200))
+    parts = []
+    size = 0
+    i = 0
+    while size < megabytes * 1024 * 1024:
+        block = (
+            f"Step {i}: creating the module.\n<cfol>pkg{i}</cfol>\n<cfil>pkg{i}/mod.py</cfil>\n"
+            f'<efil file="pkg{i}/mod.py">{body}</efil>\n<exec>pkg{i}/mod.py</exec>\n'
+        )
+        parts.append(block)
+        size += len(block)
+        i += 1
+    parts.append("<rinf>Anything else?</rinf>")
+    return "".join(parts)
+
+
+def large_body_response(megabytes):
+    """One <efil> whose body alone is the given size."""
+    line = "    total = total + compute(item) if item < limit else total\n"
+    body = line * int(megabytes * 1024 * 1024 / len(line))
+    return f'Writing the module.\n<efil file="big.py">{body}</efil>\n<exec>big.py</exec>'
+
+
+def best_of(repeat, fn, *args):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def streamed(text, chunk_size=64):
+    tokenizer = CommandTokenizer()
+    commands = []
+    for i in range(0, len(text), chunk_size):
+        commands.extend(tokenizer.feed(text[i:i + chunk_size]))
+    commands.extend(tokenizer.close())
+    return commands
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megabytes", type=float, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--body-megabytes", type=float, nargs="+", default=[0.25, 1, 4])
+    parser.add_argument("--chunk-size", type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'commands':>9} {'legacy s':>9} {'single s':>9} {'stream s':>9} {'MB/s':>8}")
+    for megabytes in args.megabytes:
+        text = synthetic_response(megabytes)
+        commands = parse_commands(text)
+        assert len(commands) == len(legacy_parse(text)[0])
+        legacy = best_of(args.repeat, legacy_parse, text)
+        single = best_of(args.repeat, parse_commands, text)
+        stream = best_of(args.repeat, streamed, text)
+        mb = len(text) / 1024 / 1024
+        print(f"{mb:>7.1f}M {len(commands):>9} {legacy:>9.4f} {single:>9.4f} {stream:>9.4f} {mb / single:>8.1f}")
+
+    print()
+    print(f"{'body':>8} {'chunk':>6} {'single s':>9} {'stream s':>9} {'MB/s':>8}")
+    for megabytes in args.body_megabytes:
+        text = large_body_response(megabytes)
+        assert streamed(text, args.chunk_size) == parse_commands(text)
+        single = best_of(args.repeat, parse_commands, text)
+        stream = best_of(args.repeat, streamed, text, args.chunk_size)
+        mb = len(text) / 1024 / 1024
+        print(f"{mb:>7.2f}M {args.chunk_size:>6} {single:>9.4f} {stream:>9.4f} {mb / stream:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Local stand-in for an OpenAI/Ollama-compatible chat completions API.
+
+Replies come from a script of rules matched against the request, and are paced by a
+configurable first-token latency and token rate, so the pipeline can be benchmarked
+offline without model time drowning out our own overhead.
+
+A script is a JSON object: {"rules": [{"system": "...", "user": "...", "response": "..."}], "default": "..."}.
+"system" and "user" are case-insensitive substrings of the first system message and the
+last user message; the first rule whose conditions all match is used.
+
+Usage: python benchmarks/mock_llm.py [--port 8089] [--latency 0.5] [--tokens-per-second 40] [--script rules.json]
+"""
+import re
+import json
+import time
+import asyncio
+import argparse
+
+TOKEN_PATTERN = re.compile(r"\s*\S+\s*")
+
+DESIGN = (
+    "Design sheet: a command line tool that reads numbers, computes their sum, mean and maximum, "
+    "and prints a one-line report. Single module, standard library only. {marker}"
+)
+WORKING_CODE = (
+    "<efil file=\"requirements.txt\"></efil>\n"
+    "<efil file=\"app/report.py\">\n"
+    "numbers = [3, 1, 4, 1, 5, 9, 2, 6]\n"
+    "print(f\"sum={sum(numbers)} mean={sum(numbers) / len(numbers):.2f} max={max(numbers)}\")\n"
+    "</efil>\n"
+    "<exec>app/report.py</exec>"
+)
+BROKEN_CODE = (
+    "<efil file=\"requirements.txt\"></efil>\n"
+    "<efil file=\"app/report.py\">\n"
+    "numbers = []\n"
+    "print(f\"sum={sum(numbers)} mean={sum(numbers) / len(numbers):.2f} max={max(numbers)}\")\n"
+    "</efil>\n"
+    "<exec>app/report.py</exec>"
+)
+FIXED_CODE = (
+    "<pfil file=\"app/report.py\">\n"
+    "<<<<<<< SEARCH\n"
+    "numbers = []\n"
+    "=======\n"
+    "numbers = [3, 1, 4, 1, 5, 9, 2, 6]\n"
+    ">>>>>>> REPLACE\n"
+    "</pfil>\n"
+    "<exec>app/report.py</exec>"
+)
+
+# Covers the benchmark scenarios: a clean run, and a first attempt that fails and is fixed once
+DEFAULT_SCRIPT = {
+    "rules": [
+        {"system": "product designer", "user": "scenario:fix", "response": DESIGN.format(marker="scenario:fix")},
+        {"system": "product designer", "response": DESIGN.format(marker="scenario:ok")},
+        {"system": "software engineer", "user": "the execution failed", "response": FIXED_CODE},
+        {"system": "software engineer", "user": "scenario:fix", "response": BROKEN_CODE},
+        {"system": "software engineer", "response": WORKING_CODE},
+    ],
+    "default": "OK",
+}
+
+
+class MockLLMServer:
+    """Minimal HTTP/1.1 server answering /chat/completions with scripted, paced replies."""
+
+    def __init__(self, script=None, latency=0.0, tokens_per_second=0.0):
+        self.script = script or DEFAULT_SCRIPT
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.requests = 0
+        self.server = None
+
+    def reply(self, messages):
+        system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "").lower()
+        user = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "").lower()
+        for rule in self.script.get("rules", []):
+            if rule.get("system", "").lower() in system and rule.get("user", "").lower() in user:
+                return rule["response"]
+        return self.script.get("default", "")
+
+    async def _pace(self, tokens):
+        if self.tokens_per_second > 0:
+            await asyncio.sleep(tokens / self.tokens_per_second)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                if method != "POST" or not path.rstrip("/").endswith("/chat/completions"):
+                    self._respond(writer, 404, b'{"error": "not found"}')
+                    await writer.drain()
+                    continue
+                self.requests += 1
+                payload = json.loads(body or b"{}")
+                if payload.get("stream"):
+                    await self._stream(writer, payload)
+                    break  # Streamed responses are delimited by closing the connection
+                await self._complete(writer, payload)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, writer, status, body, content_type="application/json"):
+        reason = {200: "OK", 404: "Not Found"}.get(status, "OK")
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+
+    async def _complete(self, writer, payload):
+        messages = payload.get("messages", [])
+        text = self.reply(messages)
+        tokens = TOKEN_PATTERN.findall(text)
+        await asyncio.sleep(self.latency)
+        await self._pace(len(tokens))
+        body = json.dumps({
+            "id": f"mock-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": sum(len(m.get("content") or "") for m in messages) // 4,
+                "completion_tokens": len(tokens),
+            },
+        }).encode()
+        self._respond(writer, 200, body)
+        await writer.drain()
+
+    async def _stream(self, writer, payload):
+        text = self.reply(payload.get("messages", []))
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+        await asyncio.sleep(self.latency)
+        for token in TOKEN_PATTERN.findall(text):
+            chunk = {"choices": [{"index": 0, "delta": {"content": token}}]}
+            writer.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await writer.drain()
+            await self._pace(1)
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start listening; returns the bound port."""
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+
+async def serve(args):
+    script = None
+    if args.script:
+        with open(args.script, "r") as f:
+            script = json.load(f)
+    server = MockLLMServer(script, args.latency, args.tokens_per_second)
+    port = await server.start(args.host, args.port)
+    print(f"listening on port {port}", flush=True)
+    async with server.server:
+        await server.server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089, help="0 picks a free port")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="0 sends the reply at once")
+    parser.add_argument("--script", help="JSON rules file (default: the built-in benchmark script)")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""Session checkpoints: content-addressed agent histories and sandbox snapshots.
+
+Every file body and every history message is stored once under objects/<sha256>, so
+a checkpoint only costs the files and messages that are new since the last one. Files
+are copied in and out (reflinked where the filesystem can), never hardlinked, so a
+program rewriting a sandbox file can neither corrupt the store nor force a copy of
+every checkpointed file before it runs. Layout under CHECKPOINT_DIR:
+
+    objects/ab/cdef...           file bodies and JSON messages, named by their sha256
+    sessions/<session>/000001.json  one manifest per turn: message digests per agent and the sandbox file table
+"""
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import contextlib
+from executor import ExecutionResult
+
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "checkpoints")
+# Checkpoint after every agent turn (off by default)
+CHECKPOINT_ENABLED = os.getenv("CHECKPOINT_ENABLED", "0").lower() in ("1", "true", "yes")
+# Checkpoints kept per session, newest first (0 keeps them all); gc() frees what older ones referenced
+CHECKPOINT_KEEP = int(os.getenv("CHECKPOINT_KEEP", "20"))
+# gc() leaves objects this recent alone, since a save in another process may not have written its manifest yet
+CHECKPOINT_GC_GRACE_SECONDS = 3600
+
+HASH_CHUNK_BYTES = 1024 * 1024
+# Checkpoint ids are "<session>/<sequence>"; both parts come from clients, so they are validated
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+SEQUENCE_PATTERN = re.compile(r"\d{6}")
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_checkpoint_id(checkpoint_id):
+    """Split "<session>[/<sequence>]" into (session, sequence or None); raises ValueError if malformed."""
+    session_id, _, sequence = str(checkpoint_id).partition("/")
+    if not SESSION_ID_PATTERN.fullmatch(session_id) or (sequence and not SEQUENCE_PATTERN.fullmatch(sequence)):
+        raise ValueError(f"Invalid checkpoint id: {checkpoint_id!r}")
+    return session_id, sequence or None
+
+
+def _inside(root, relative):
+    root = os.path.abspath(root)
+    return not os.path.isabs(relative) and os.path.commonpath([root, os.path.abspath(os.path.join(root, relative))]) == root
+
+
+def _write_json(path, data):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+class CheckpointStore:
+    """Saves and restores sessions; see the module docstring for the on-disk layout."""
+
+    def __init__(self, root=CHECKPOINT_DIR):
+        self.root = root
+        self._stat_cache = {}  # absolute path -> (inode, size, mtime_ns, sha256) of files already stored
+
+    def object_path(self, digest):
+        if not isinstance(digest, str) or not DIGEST_PATTERN.fullmatch(digest):
+            raise ValueError(f"Invalid object digest: {digest!r}")
+        return os.path.join(self.root, "objects", digest[:2], digest[2:])
+
+    def session_dir(self, session_id):
+        return os.path.join(self.root, "sessions", session_id)
+
+    def _store(self, path, digest):
+        """Add a file body to the object store unless an identical one is already there."""
+        from file_manager import copy_file  # file_manager imports this module
+        target = self.object_path(digest)
+        if os.path.exists(target):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+        copy_file(path, temp_path)
+        os.replace(temp_path, target)
+
+    def _store_message(self, message):
+        """Add one history message to the object store; returns its digest."""
+        data = json.dumps(message, sort_keys=True).encode()
+        digest = hashlib.sha256(data).hexdigest()
+        target = self.object_path(digest)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            temp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, target)
+        return digest
+
+    def _load_messages(self, spec):
+        if "message_objects" not in spec:
+            return spec["messages"]  # Written before histories were content-addressed
+        messages = []
+        for digest in spec["message_objects"]:
+            with open(self.object_path(digest), "rb") as f:
+                messages.append(json.loads(f.read()))
+        return messages
+
+    def snapshot_sandbox(self, sandbox_dir):
+        """Store the sandbox's files and return its file table; unchanged files are not re-read."""
+        files, dirs = {}, []
+        for root, dir_names, file_names in os.walk(sandbox_dir):
+            relative_root = os.path.relpath(root, sandbox_dir)
+            dirs.extend(os.path.normpath(os.path.join(relative_root, name)) for name in dir_names)
+            for name in file_names:
+                path = os.path.join(root, name)
+                relative = os.path.normpath(os.path.join(relative_root, name))
+                if os.path.islink(path):
+                    files[relative] = {"link": os.readlink(path)}
+                    continue
+                st = os.stat(path)
+                key = os.path.abspath(path)
+                cached = self._stat_cache.get(key)
+                if cached and cached[:3] == (st.st_ino, st.st_size, st.st_mtime_ns):
+                    digest = cached[3]
+                else:
+                    digest = _hash_file(path)
+                    self._store(path, digest)
+                    self._stat_cache[key] = (st.st_ino, st.st_size, st.st_mtime_ns, digest)
+                files[relative] = {"sha256": digest}
+        return {"files": files, "dirs": sorted(dirs)}
+
+    def restore_sandbox(self, snapshot, sandbox_dir):
+        """Materialize a snapshot into an empty directory by copying objects back in."""
+        from file_manager import copy_file  # file_manager imports this module
+        if not all(_inside(sandbox_dir, relative) for relative in list(snapshot["dirs"]) + list(snapshot["files"])):
+            raise ValueError("Snapshot has paths outside the sandbox")
+        os.makedirs(sandbox_dir, exist_ok=True)
+        for relative in snapshot["dirs"]:
+            os.makedirs(os.path.join(sandbox_dir, relative), exist_ok=True)
+        for relative, entry in snapshot["files"].items():
+            path = os.path.join(sandbox_dir, relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if "link" in entry:
+                os.symlink(entry["link"], path)
+                continue
+            copy_file(self.object_path(entry["sha256"]), path)
+            st = os.stat(path)
+            self._stat_cache[os.path.abspath(path)] = (st.st_ino, st.st_size, st.st_mtime_ns, entry["sha256"])
+
+    def forget(self, sandbox_dir):
+        """Drop the stat cache of a sandbox that is finished with or removed."""
+        prefix = os.path.join(os.path.abspath(sandbox_dir), "")
+        for path in [path for path in self._stat_cache if path.startswith(prefix)]:
+            del self._stat_cache[path]
+
+    def checkpoints(self, session_id):
+        """Checkpoint ids of a session, oldest first."""
+        parse_checkpoint_id(session_id)
+        try:
+            names = sorted(name for name in os.listdir(self.session_dir(session_id)) if name.endswith(".json"))
+        except FileNotFoundError:
+            return []
+        return [f"{session_id}/{name[:-len('.json')]}" for name in names]
+
+    def save(self, session_id, agents, sandbox_dir, parent=None):
+        """Checkpoint the agents' state and the sandbox; returns the new checkpoint id."""
+        existing = self.checkpoints(session_id)
+        sequence = int(existing[-1].rsplit("/", 1)[1]) + 1 if existing else 1
+        checkpoint_id = f"{session_id}/{sequence:06d}"
+        manifest = {
+            "id": checkpoint_id,
+            "session": session_id,
+            "parent": existing[-1] if existing else parent,
+            "created": time.time(),
+            "agents": [
+                {
+                    "key": agent.key,
+                    "provider": agent.provider,
+                    "max_tokens": agent.max_tokens,
+                    "stream": agent.stream,
+                    "message_objects": [self._store_message(message) for message in agent.messages],
+                    "last_executions": [result._asdict() for result in agent.last_executions],
+                    "failed_patches": agent.failed_patches,
+                }
+                for agent in agents
+            ],
+            "sandbox": self.snapshot_sandbox(sandbox_dir),
+        }
+        os.makedirs(self.session_dir(session_id), exist_ok=True)
+        _write_json(os.path.join(self.session_dir(session_id), f"{sequence:06d}.json"), manifest)
+        self.prune(session_id)
+        return checkpoint_id
+
+    def prune(self, session_id, keep=None):
+        """Delete all but the newest keep (default CHECKPOINT_KEEP) manifests of a session; returns how many."""
+        keep = CHECKPOINT_KEEP if keep is None else keep
+        existing = self.checkpoints(session_id)
+        if keep <= 0 or len(existing) <= keep:
+            return 0
+        for checkpoint_id in existing[:-keep]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.session_dir(session_id), f"{checkpoint_id.rsplit('/', 1)[1]}.json"))
+        return len(existing) - keep
+
+    def load(self, checkpoint_id):
+        """Read a manifest; a bare session id means its latest checkpoint. Raises ValueError if malformed."""
+        session_id, sequence = parse_checkpoint_id(checkpoint_id)
+        if sequence is None:
+            existing = self.checkpoints(session_id)
+            if not existing:
+                raise FileNotFoundError(f"No checkpoints for session {session_id}")
+            sequence = existing[-1].rsplit("/", 1)[1]
+        with open(os.path.join(self.session_dir(session_id), f"{sequence}.json"), "r") as f:
+            manifest = json.load(f)
+        if not isinstance(manifest, dict) or not all(key in manifest for key in ("id", "session", "agents", "sandbox")):
+            raise ValueError(f"Malformed checkpoint {checkpoint_id}")
+        return manifest
+
+    def resume(self, checkpoint_id, sandbox_dir, branch=False):
+        """Restore a checkpoint into a new sandbox and rebuild its agents.
+
+        Returns (session_id, agents). Resuming continues the original session's checkpoint
+        sequence; branching starts a new session whose first checkpoint points back here.
+        """
+        from main import create_agents  # main imports this module
+        manifest = self.load(checkpoint_id)
+        try:
+            self.restore_sandbox(manifest["sandbox"], sandbox_dir)
+            specs = manifest["agents"]
+            agents = create_agents([spec["key"] for spec in specs], specs[0]["provider"] if specs else None,
+                                   sandbox_dir, specs[0]["stream"] if specs else False)
+            if not agents:
+                raise ValueError("no known agents")
+            for agent, spec in zip(agents, specs):
+                agent.provider = spec["provider"]
+                agent.max_tokens = spec["max_tokens"]
+                agent.messages = self._load_messages(spec)
+                agent.last_executions = [ExecutionResult(**result) for result in spec["last_executions"]]
+                agent.failed_patches = spec.get("failed_patches", [])
+        except (KeyError, TypeError, AttributeError, IndexError) as e:
+            raise ValueError(f"Malformed checkpoint {checkpoint_id}: {e!r}")
+        if branch:
+            session_id = f"{manifest['session']}-{uuid.uuid4().hex[:6]}"
+            self.save(session_id, agents, sandbox_dir, parent=manifest["id"])
+            return session_id, agents
+        return manifest["session"], agents
+
+    def gc(self, keep=None):
+        """Prune every session to its newest keep checkpoints, then delete objects no manifest refers to.
+
+        Returns (checkpoints removed, objects removed).
+        """
+        referenced = set()
+        pruned = 0
+        sessions_root = os.path.join(self.root, "sessions")
+        for session_id in os.listdir(sessions_root) if os.path.isdir(sessions_root) else []:
+            if not SESSION_ID_PATTERN.fullmatch(session_id):
+                continue  # Not a session this store wrote; its checkpoints could never be loaded
+            pruned += self.prune(session_id, keep)
+            for checkpoint_id in self.checkpoints(session_id):
+                manifest = self.load(checkpoint_id)
+                referenced.update(entry["sha256"] for entry in manifest["sandbox"]["files"].values() if "sha256" in entry)
+                for spec in manifest["agents"]:
+                    referenced.update(spec.get("message_objects", []))
+        removed = 0
+        cutoff = time.time() - CHECKPOINT_GC_GRACE_SECONDS
+        objects_root = os.path.join(self.root, "objects")
+        for root, _, names in os.walk(objects_root):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp") or os.path.basename(root) + name in referenced:
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    if os.stat(path).st_ctime < cutoff:
+                        os.remove(path)
+                        removed += 1
+        return pruned, removed
+
+
+checkpoint_store = CheckpointStore()
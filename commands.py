@@ -0,0 +1,167 @@
+from collections import namedtuple
+
+# A parsed agent command. attr is the file="..." attribute for tags that take one.
+Command = namedtuple("Command", ["name", "attr", "body", "start", "end"])
+
+# Tags whose body must fit on one line, matching how agents are prompted to use them
+LINE_COMMANDS = ("cfol", "cfil", "exec", "rinf")
+# Tags that carry a file="..." attribute and a multi-line body
+FILE_COMMANDS = ("efil", "pfil")
+
+OPENERS = {name: f"<{name}>" for name in LINE_COMMANDS}
+OPENERS.update({name: f'<{name} file="' for name in FILE_COMMANDS})
+LONGEST_OPENER = max(len(opener) for opener in OPENERS.values())
+
+
+class CommandTokenizer:
+    """Single-pass tokenizer that turns agent text into a command stream in document order.
+
+    Text can be fed incrementally (for streamed responses); every command is
+    returned as soon as its closing tag has been seen. Each character is
+    examined a bounded number of times, so parsing is linear in the input,
+    however small the chunks: consumed text is dropped, and while a command
+    waits for its closing tag new chunks are collected in a list and only the
+    new text (plus a closer-length overlap) is searched.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.chunks = None     # Text after the buffer while the pending command waits for its closer
+        self.overlap = ""      # Last few characters fed, in case the closer is split across chunks
+        self.offset = 0        # Absolute position of buffer[0] in the full text
+        self.position = 0      # Scan position within the buffer
+        self.pending = None    # (name, attr, start, body_start) of an open tag
+        self.search_from = 0   # Where to resume looking for the pending closing tag
+        self.next_close = {}   # Last closing-tag position found per tag, reused while still ahead
+        self.unclosed = set()  # Tags known to have no closing tag in the rest of the input
+
+    def feed(self, text):
+        """Add text and return the commands it completed."""
+        if self.chunks is not None:
+            name = self.pending[0]
+            closer = f"</{name}>"
+            window = self.overlap + text
+            if closer not in window and not (name in LINE_COMMANDS and "\n" in text):
+                # Nothing for the scanner to do yet: keep the chunk without copying the body
+                self.chunks.append(text)
+                self.overlap = window[-(len(closer) - 1):]
+                return []
+            self.chunks.append(text)
+            self._join()
+        else:
+            self.buffer += text
+        return self._scan(final=False)
+
+    def close(self):
+        """Finish the input; unterminated commands are dropped."""
+        self._join()
+        commands = self._scan(final=True)
+        self.pending = None
+        return commands
+
+    def _join(self):
+        if self.chunks is not None:
+            self.buffer = "".join(self.chunks)
+            self.chunks = None
+
+    def _compact(self):
+        # Drop consumed text, so the buffer only holds what can still be part of a command
+        keep_from = self.pending[2] if self.pending else self.position
+        if keep_from:
+            self.buffer = self.buffer[keep_from:]
+            self.offset += keep_from
+            self.position -= keep_from
+            self.search_from -= keep_from
+            self.next_close = {
+                name: close - keep_from
+                for name, close in self.next_close.items() if close >= keep_from
+            }
+            if self.pending:
+                name, attr, start, body_start = self.pending
+                self.pending = (name, attr, start - keep_from, body_start - keep_from)
+
+    def _open_tag(self, buf, lt, final):
+        """Identify the command opening at buf[lt]; returns (name, attr, body_start), "wait" or None."""
+        for name, opener in OPENERS.items():
+            if buf.startswith(opener, lt):
+                if name not in FILE_COMMANDS:
+                    return name, None, lt + len(opener)
+                attr_start = lt + len(opener)
+                attr_end = buf.find('">', attr_start)
+                if buf.find("\n", attr_start, attr_end if attr_end != -1 else len(buf)) != -1:
+                    return None
+                if attr_end == -1:
+                    return None if final else "wait"
+                return name, buf[attr_start:attr_end], attr_end + 2
+        if not final and len(buf) - lt < LONGEST_OPENER:
+            # Could still be the start of an opener that is split across chunks
+            tail = buf[lt:]
+            if any(opener.startswith(tail) for opener in OPENERS.values()):
+                return "wait"
+        return None
+
+    def _find_close(self, buf, name, closer, final):
+        """Return the closing tag position, -1 to wait for more text, or -2 if the command is malformed."""
+        close = self.next_close.get(name, -1)
+        if close < self.search_from:
+            close = buf.find(closer, self.search_from)
+            self.next_close[name] = close
+        end = close if close != -1 else len(buf)
+        if name in LINE_COMMANDS and buf.find("\n", self.search_from, end) != -1:
+            return -2  # The line ended before the tag was closed
+        if close == -1 and final:
+            self.unclosed.add(name)
+            return -2
+        return close
+
+    def _scan(self, final):
+        buf = self.buffer
+        commands = []
+        waiting = None
+        while True:
+            if self.pending is None:
+                lt = buf.find("<", self.position)
+                if lt == -1:
+                    self.position = len(buf)
+                    break
+                opened = self._open_tag(buf, lt, final)
+                if opened == "wait":
+                    self.position = lt
+                    break
+                if opened is None or opened[0] in self.unclosed:
+                    self.position = lt + 1
+                    continue
+                name, attr, body_start = opened
+                self.pending = (name, attr, lt, body_start)
+                self.search_from = body_start
+
+            name, attr, start, body_start = self.pending
+            closer = f"</{name}>"
+            close = self._find_close(buf, name, closer, final)
+            if close == -2:
+                # Malformed command: resume scanning just after its "<"
+                self.pending = None
+                self.position = start + 1
+                continue
+            if close == -1:
+                # Closing tag may be split across chunks; only rescan the overlap
+                self.search_from = max(body_start, len(buf) - len(closer) + 1)
+                waiting = closer
+                break
+            end = close + len(closer)
+            commands.append(Command(name, attr, buf[body_start:close], self.offset + start, self.offset + end))
+            self.pending = None
+            self.position = end
+        self._compact()
+        if waiting and not final:
+            self.chunks = [self.buffer]
+            self.overlap = self.buffer[-(len(waiting) - 1):]
+        return commands
+
+
+def parse_commands(text):
+    """Return every complete command in the text, in document order."""
+    tokenizer = CommandTokenizer()
+    commands = tokenizer.feed(text or "")
+    commands.extend(tokenizer.close())
+    return commands
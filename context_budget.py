@@ -0,0 +1,83 @@
+import os
+
+# Tokens reserved for the model's reply when fitting the prompt into the window
+RESPONSE_TOKEN_RESERVE = int(os.getenv("RESPONSE_TOKEN_RESERVE", "1000"))
+# Role markers and separators each message costs on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    """Rough token count for providers without a local tokenizer (1 token ≈ 4 characters)."""
+    return (len(text) + 3) // 4
+
+
+class ContextBudget:
+    """Keeps a conversation inside a provider's context window with incremental bookkeeping.
+
+    Token counts are computed once per message and kept alongside a running
+    total of the messages currently in the window, so fitting a conversation
+    that only grew by a few messages costs O(new messages), not O(history).
+    The leading system prompt is always kept; the oldest other messages are
+    dropped first.
+    """
+
+    def __init__(self, count_tokens=estimate_tokens, window=16000, reserve=RESPONSE_TOKEN_RESERVE):
+        self.count_tokens = count_tokens
+        self.limit = max(window - reserve, 0)
+        self._reset(None)
+
+    def _reset(self, messages):
+        self._source = messages
+        self._counts = []
+        self._last = None
+        self._start = 1
+        self._total = 0
+
+    def _count(self, message):
+        return self.count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+    def _sync(self, messages):
+        """Count any messages appended since the last call; start over if the history was replaced."""
+        tracked = len(self._counts)
+        if (messages is not self._source or len(messages) < tracked
+                or (tracked and messages[tracked - 1] is not self._last)):
+            self._reset(messages)
+            tracked = 0
+        for message in messages[tracked:]:
+            count = self._count(message)
+            self._counts.append(count)
+            self._total += count
+        if messages:
+            self._last = messages[-1]
+
+    def update(self, index, message):
+        """Re-count one message after it was rewritten in place (e.g. by history compaction)."""
+        if index < len(self._counts):
+            count = self._count(message)
+            if index == 0 or index >= self._start:
+                self._total += count - self._counts[index]
+            self._counts[index] = count
+            if index == len(self._counts) - 1:
+                self._last = message
+
+    @property
+    def total(self):
+        """Tokens in the messages that would currently be sent."""
+        return self._total
+
+    def fit(self, messages):
+        """Return the messages to send, trimmed from the oldest end to fit the window."""
+        if not messages:
+            return messages
+        self._sync(messages)
+        last = len(messages) - 1
+        while self._total > self.limit and self._start < last:
+            self._total -= self._counts[self._start]
+            self._start += 1
+            # Never open the window on an assistant turn or a stale execution result
+            while self._start < last and messages[self._start].get("role") != "user":
+                self._total -= self._counts[self._start]
+                self._start += 1
+        if self._start <= 1:
+            return messages
+        return messages[:1] + messages[self._start:]
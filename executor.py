@@ -1,56 +1,264 @@
 import os
-import asyncio
 import sys
-import shutil
+import json
+import time
+import signal
+import asyncio
+import contextlib
+from collections import deque, namedtuple
+from venv_pool import venv_pool, read_requirements, VenvSetupError
+from telemetry import span, metrics
+from warm_worker import warm_workers, WARM_WORKERS
 
-async def execute_code(file_path, sandbox_dir):
-    """Execute code in a fresh virtual environment after installing requirements with uv."""
-    venv_path = os.path.join(sandbox_dir, ".venv")
-    if os.path.exists(venv_path):
-        shutil.rmtree(venv_path)
-    
-    # Create virtual environment
+try:
+    import resource
+except ImportError:  # Windows: no rlimits, only the wall-clock timeout applies
+    resource = None
+
+# Limits for executed programs (0 disables a limit)
+EXEC_TIMEOUT_SECONDS = float(os.getenv("EXEC_TIMEOUT_SECONDS", "300"))
+EXEC_CPU_SECONDS = int(os.getenv("EXEC_CPU_SECONDS", "300"))
+# RLIMIT_AS caps address space, not RSS: numpy/torch reserve far more than they touch
+EXEC_MEMORY_BYTES = int(os.getenv("EXEC_MEMORY_BYTES", str(16 * 1024 ** 3)))
+EXEC_FILE_SIZE_BYTES = int(os.getenv("EXEC_FILE_SIZE_BYTES", str(512 * 1024 ** 2)))
+# How much of each output stream is kept: the first HEAD bytes and the last TAIL bytes
+EXEC_OUTPUT_HEAD_BYTES = int(os.getenv("EXEC_OUTPUT_HEAD_BYTES", str(16 * 1024)))
+EXEC_OUTPUT_TAIL_BYTES = int(os.getenv("EXEC_OUTPUT_TAIL_BYTES", str(64 * 1024)))
+
+LIMIT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rlimit_exec.py")
+
+READ_CHUNK_BYTES = 64 * 1024
+RSS_SAMPLE_SECONDS = 0.1
+READER_DRAIN_SECONDS = 5
+
+
+class ExecutionResult(namedtuple("ExecutionResult", [
+        "file_path", "exit_code", "stdout", "stderr", "duration", "peak_rss",
+        "stdout_truncated", "stderr_truncated", "timed_out", "error"])):
+    """Outcome of one program execution.
+
+    exit_code is None when the program never started (error explains why);
+    peak_rss is in bytes: the exact peak for warm-worker runs, otherwise the highest
+    VmHWM sampled while the program ran (None off Linux or if it finished before the
+    first sample). The process-wide RUSAGE_CHILDREN mark is deliberately not used, as
+    it also reflects concurrent executions and installs.
+    """
+
+    @property
+    def succeeded(self):
+        return self.exit_code == 0 and not self.timed_out and self.error is None
+
+    @classmethod
+    def failed_to_start(cls, file_path, error, duration=0.0):
+        return cls(file_path, None, "", "", duration, None, False, False, False, error)
+
+
+class OutputBuffer:
+    """Bounded capture of a byte stream: keeps the head and a ring buffer of the tail."""
+
+    def __init__(self, head_limit=EXEC_OUTPUT_HEAD_BYTES, tail_limit=EXEC_OUTPUT_TAIL_BYTES):
+        self.head_limit = head_limit
+        self.tail_limit = tail_limit
+        self.head = bytearray()
+        self.tail = deque()
+        self.tail_size = 0
+        self.dropped = 0
+
+    def write(self, data):
+        if len(self.head) < self.head_limit:
+            take = self.head_limit - len(self.head)
+            self.head += data[:take]
+            data = data[take:]
+        if not data:
+            return
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail_size > self.tail_limit:
+            excess = self.tail_size - self.tail_limit
+            oldest = self.tail[0]
+            if len(oldest) <= excess:
+                self.tail.popleft()
+                self.tail_size -= len(oldest)
+                self.dropped += len(oldest)
+            else:
+                self.tail[0] = oldest[excess:]
+                self.tail_size -= excess
+                self.dropped += excess
+
+    @property
+    def truncated(self):
+        return self.dropped > 0
+
+    def text(self):
+        head = self.head.decode(errors="replace")
+        tail = b"".join(self.tail).decode(errors="replace")
+        if self.truncated:
+            return f"{head}\n... [{self.dropped} bytes omitted] ...\n{tail}"
+        return head + tail
+
+
+def _resource_limits():
+    """(rlimit, value) pairs to apply to executed programs."""
+    if resource is None:
+        return []
+    limits = [
+        (resource.RLIMIT_CPU, EXEC_CPU_SECONDS),
+        (getattr(resource, "RLIMIT_AS", None), EXEC_MEMORY_BYTES),
+        (resource.RLIMIT_FSIZE, EXEC_FILE_SIZE_BYTES),
+    ]
+    return [(kind, value) for kind, value in limits if kind is not None and value]
+
+
+def _limited(args):
+    """Wrap a command so rlimit_exec.py applies the rlimits in the child and then execs it.
+
+    args[0] is a Python interpreter, so it also runs the wrapper (isolated and without
+    site, to keep the extra start-up short).
+    """
+    limits = _resource_limits()
+    if not limits:
+        return list(args)
+    return [args[0], "-I", "-S", LIMIT_SCRIPT, json.dumps(limits), *args]
+
+
+def _sample_rss(pid):
+    """Peak resident set size of a running process in bytes (Linux only)."""
     try:
-        process = await asyncio.create_subprocess_exec(
-            "uv", "venv", venv_path,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        if process.returncode != 0:
-            return "", f"Failed to create virtual environment: {stderr.decode()}"
-    except Exception as e:
-        return "", f"Failed to create virtual environment: {str(e)}"
-    
-    # Determine Python path
-    if sys.platform == "win32":
-        python_path = os.path.join(venv_path, "Scripts", "python.exe")
-    else:
-        python_path = os.path.join(venv_path, "bin", "python")
-    
-    # Install requirements if present
-    requirements_path = os.path.join(sandbox_dir, "requirements.txt")
-    if os.path.exists(requirements_path):
-        try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+async def _pump(stream, buffer):
+    while True:
+        data = await stream.read(READ_CHUNK_BYTES)
+        if not data:
+            break
+        buffer.write(data)
+
+
+def _kill(process):
+    try:
+        if sys.platform == "win32":
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)  # The whole process group, including grandchildren
+    except ProcessLookupError:
+        pass
+
+
+async def run_program(args, file_path, cwd=None, timeout=EXEC_TIMEOUT_SECONDS, worker=None):
+    """Run a program with bounded output capture, a wall-clock timeout and rlimits.
+
+    With a warm worker, args[1:] is forked from the worker instead of starting args[0];
+    failing to reach the worker raises, so the caller can fall back to a cold start.
+    """
+    start = time.monotonic()
+    try:
+        if worker is not None:
+            process = await worker.spawn(args[1:], cwd, _resource_limits())
+        else:
             process = await asyncio.create_subprocess_exec(
-                "uv", "pip", "install", "-r", requirements_path, "--python", python_path,
+                *_limited(args),
+                cwd=cwd,
                 stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=sys.platform != "win32"
             )
-            stdout, stderr = await process.communicate()
-            if process.returncode != 0:
-                return "", f"Failed to install requirements: {stderr.decode()}"
-        except Exception as e:
-            return "", f"Failed to install requirements: {str(e)}"
-    
-    # Execute the script
-    try:
-        process = await asyncio.create_subprocess_exec(
-            python_path, file_path,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        return stdout.decode(), stderr.decode() if stderr else ""
     except Exception as e:
-        return "", str(e)
\ No newline at end of file
+        if worker is not None:
+            raise
+        return ExecutionResult.failed_to_start(file_path, str(e), time.monotonic() - start)
+
+    stdout, stderr = OutputBuffer(), OutputBuffer()
+    readers = asyncio.gather(_pump(process.stdout, stdout), _pump(process.stderr, stderr))
+    peak_rss = None
+    timed_out = False
+    deadline = start + timeout if timeout else None
+    try:
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                timed_out = True
+                _kill(process)
+                break
+            wait = RSS_SAMPLE_SECONDS if remaining is None else min(RSS_SAMPLE_SECONDS, remaining)
+            try:
+                await asyncio.wait_for(asyncio.shield(process.wait()), wait)
+                break
+            except asyncio.TimeoutError:
+                sample = _sample_rss(process.pid)
+                if sample is not None:
+                    peak_rss = max(peak_rss or 0, sample)
+    except asyncio.CancelledError:
+        _kill(process)
+        raise
+    finally:
+        exit_code = await process.wait()
+        try:
+            await asyncio.wait_for(readers, READER_DRAIN_SECONDS)
+        except asyncio.TimeoutError:
+            _kill(process)  # A background grandchild is still holding the pipes open
+
+    if getattr(process, "peak_rss", None) is not None:
+        peak_rss = max(peak_rss or 0, process.peak_rss)  # Reported by the warm worker that reaped it
+
+    return ExecutionResult(
+        file_path=file_path,
+        exit_code=exit_code,
+        stdout=stdout.text(),
+        stderr=stderr.text(),
+        duration=time.monotonic() - start,
+        peak_rss=peak_rss,
+        stdout_truncated=stdout.truncated,
+        stderr_truncated=stderr.truncated,
+        timed_out=timed_out,
+        error=None
+    )
+
+
+async def execute_code(file_path, sandbox_dir):
+    """Execute code in a pooled virtual environment matching the sandbox's requirements."""
+    requirements_path = os.path.join(sandbox_dir, "requirements.txt")
+    start = time.monotonic()
+    stage = "environment"
+    with span("exec", file=file_path) as current:
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                with span("exec.environment"):
+                    python_path = await stack.enter_async_context(venv_pool.lease(requirements_path))
+                stage = "run"
+                with span("exec.run") as run:
+                    # Execute the script from inside the sandbox so relative output paths land there
+                    args = [python_path, os.path.abspath(file_path)]
+                    worker = warm_workers.get(python_path, read_requirements(requirements_path)) if WARM_WORKERS else None
+                    try:
+                        result = await run_program(args, file_path, cwd=sandbox_dir, worker=worker)
+                    except Exception as e:
+                        if worker is None:
+                            raise
+                        print(f"[INFO] Warm worker failed ({e}), running cold")
+                        warm_workers.discard(python_path)
+                        worker = None
+                        result = await run_program(args, file_path, cwd=sandbox_dir)
+                    run.set(warm=worker is not None, exit_code=result.exit_code, timed_out=result.timed_out, peak_rss=result.peak_rss)
+        except VenvSetupError as e:
+            if e.stage == "venv":
+                error = f"Failed to create virtual environment: {e}"
+            else:
+                error = f"Failed to install requirements: {e}"
+            result = ExecutionResult.failed_to_start(file_path, error, time.monotonic() - start)
+        except Exception as e:
+            if stage == "run":
+                error = f"Failed to run program: {e}"
+            else:
+                error = f"Failed to create virtual environment: {e}"
+            result = ExecutionResult.failed_to_start(file_path, error, time.monotonic() - start)
+        current.set(succeeded=result.succeeded)
+        metrics.inc("agent_executions_total", help="Executed programs by outcome",
+                    outcome="ok" if result.succeeded else "timeout" if result.timed_out else "failed")
+        return result
@@ -1,89 +1,292 @@
 import os
 import time
-import re
+import shutil
+import asyncio
+import contextlib
 from executor import execute_code
+from commands import parse_commands
+from patcher import apply_patch, PatchError
+from telemetry import span
+from prewarm import prewarm_dependencies
+from manifest import manifest_for, forget_manifest
+from checkpoint import checkpoint_store
 
-async def create_sandbox():
+try:
+    import fcntl
+except ImportError:  # Windows: no reflinks
+    fcntl = None
+
+# Files at least this large are hardlinked into sandbox clones when the filesystem cannot reflink
+SANDBOX_CLONE_LINK_BYTES = int(os.getenv("SANDBOX_CLONE_LINK_BYTES", str(8 * 1024 ** 2)))
+FICLONE = 0x40049409  # Linux ioctl: share a file's extents copy-on-write (btrfs, xfs, ...)
+
+async def create_sandbox(label=None, root="."):
+    """Create a new, empty sandbox directory; never reuses one another session created."""
     timestamp = int(time.time())
-    sandbox_dir = f"sandbox_{timestamp}"
-    os.makedirs(sandbox_dir, exist_ok=True)
-    return sandbox_dir
+    base = os.path.join(root, f"sandbox_{timestamp}_{label}" if label else f"sandbox_{timestamp}")
+    os.makedirs(root, exist_ok=True)
+    sandbox_dir, attempt = base, 1
+    while True:
+        try:
+            os.mkdir(sandbox_dir)  # Atomic: exactly one caller gets each name
+            return os.path.normpath(sandbox_dir)
+        except FileExistsError:
+            attempt += 1
+            sandbox_dir = f"{base}_{attempt}"
+
+def sandbox_path(sandbox_dir, relative):
+    """Join an agent-supplied path onto the sandbox, refusing anything that resolves outside it."""
+    root = os.path.realpath(sandbox_dir)
+    full_path = os.path.realpath(os.path.join(root, relative))
+    if os.path.isabs(relative) or os.path.commonpath([root, full_path]) != root:
+        raise ValueError(f"{relative} is outside the sandbox")
+    return os.path.join(sandbox_dir, relative)
+
+def release_sandbox(sandbox_dir):
+    """Forget the in-memory state kept for a sandbox that is finished with or removed."""
+    forget_manifest(sandbox_dir)
+    checkpoint_store.forget(sandbox_dir)
+
+def _reflink(src, dst):
+    """Copy a file by sharing its extents copy-on-write; returns False if the filesystem cannot."""
+    if fcntl is None:
+        return False
+    try:
+        with open(src, "rb") as source, open(dst, "wb") as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        shutil.copystat(src, dst)
+        return True
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(dst)
+        return False
+
+def copy_file(src, dst):
+    """Copy a file into a new inode of its own: reflink if possible, else a plain copy."""
+    if not _reflink(src, dst):
+        shutil.copy2(src, dst)
+
+def _clone_file(src, dst):
+    """Copy one file for a sandbox clone: reflink if possible, else hardlink large files, else copy."""
+    if _reflink(src, dst):
+        return
+    if os.path.getsize(src) >= SANDBOX_CLONE_LINK_BYTES:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+def clone_sandbox(sandbox_dir, suffix):
+    """Make a cheap copy of a sandbox next to it.
+
+    Agent commands replace files atomically, so editing a hardlinked file in a clone
+    never writes through to the original.
+    """
+    clone_dir = f"{os.path.normpath(sandbox_dir)}.{suffix}"
+    shutil.rmtree(clone_dir, ignore_errors=True)
+    shutil.copytree(sandbox_dir, clone_dir, symlinks=True, copy_function=_clone_file)
+    return clone_dir
+
+def adopt_sandbox(sandbox_dir, clone_dir):
+    """Replace a sandbox with one of its clones, keeping the original path."""
+    retired = f"{os.path.normpath(sandbox_dir)}.retired"
+    shutil.rmtree(retired, ignore_errors=True)
+    os.rename(sandbox_dir, retired)
+    os.rename(clone_dir, sandbox_dir)
+    shutil.rmtree(retired, ignore_errors=True)
+    release_sandbox(clone_dir)
+
+def detach_hardlinks(sandbox_dir):
+    """Give every hardlinked sandbox file its own copy before a program can rewrite it in place.
+
+    Clones share large file bodies through hardlinks; agent commands replace files
+    atomically, but an executed program opening a file for writing would otherwise
+    change every copy. Returns the number of files copied.
+    """
+    detached = 0
+    for root, _, names in os.walk(sandbox_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.islink(path) or os.stat(path).st_nlink < 2:
+                continue
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            shutil.copy2(path, temp_path)
+            os.replace(temp_path, path)
+            detached += 1
+    return detached
+
+def _write_file(full_path, content):
+    """Write a sandbox file by replacing it, so hardlinked copies of the old file stay intact."""
+    folder = os.path.dirname(full_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    temp_path = f"{full_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(content)
+    os.replace(temp_path, full_path)
+
+def create_folder(folder_name, sandbox_dir):
+    try:
+        os.makedirs(sandbox_path(sandbox_dir, folder_name), exist_ok=True)
+        print(f"[INFO] Created folder: {folder_name}")
+    except Exception as e:
+        print(f"[ERROR] Could not create folder: {e}")
 
-async def process_agent_commands(assistant_message, sandbox_dir):
+def _update_file(file_path, content, sandbox_dir, changes=None):
+    """Write a sandbox file unless it already holds the content; returns the FileChange or None."""
+    full_path = sandbox_path(sandbox_dir, file_path)
+    manifest = manifest_for(sandbox_dir)
+    change = manifest.change(file_path, content)
+    if change is None:
+        return None
+    _write_file(full_path, content)
+    manifest.digest(file_path)
+    if changes is not None:
+        changes.append(change)
+    return change
+
+def create_file(file_path, sandbox_dir, changes=None):
+    try:
+        if os.path.exists(sandbox_path(sandbox_dir, file_path)):
+            print(f"[INFO] File already exists, left unchanged: {file_path}")
+            return
+        _update_file(file_path, "# File created by agent\n", sandbox_dir, changes)
+        print(f"[INFO] Created file: {file_path}")
+    except Exception as e:
+        print(f"[ERROR] Could not create file: {e}")
+
+def edit_file(file_path, new_content, sandbox_dir, changes=None):
+    """Returns the FileChange, or None when the file already had this content."""
+    try:
+        change = _update_file(file_path, new_content, sandbox_dir, changes)
+        print(f"[INFO] Edited file: {file_path}" if change else f"[INFO] File unchanged: {file_path}")
+        return change
+    except Exception as e:
+        print(f"[ERROR] Could not edit file: {e}")
+        return None
+
+def patch_file(file_path, patch_text, sandbox_dir, changes=None):
+    """Apply SEARCH/REPLACE blocks to a sandbox file; returns feedback for the agent on failure."""
+    try:
+        full_path = sandbox_path(sandbox_dir, file_path)
+        if not os.path.exists(full_path):
+            raise PatchError("file does not exist; create it with <efil> first")
+        with open(full_path, "r") as f:
+            original = f.read()
+        change = _update_file(file_path, apply_patch(original, patch_text), sandbox_dir, changes)
+        print(f"[INFO] Patched file: {file_path}" if change else f"[INFO] Patch left file unchanged: {file_path}")
+        return None
+    except Exception as e:
+        print(f"[ERROR] Could not patch file: {e}")
+        return f"Patch of {file_path} failed with error: {e}\nThe file was left unchanged."
+
+def summarize_execution(result):
+    """Build the execution summary the agent sees from a structured result."""
+    if result.timed_out:
+        result_str = f"Execution of {result.file_path} failed with error: timed out after {result.duration:.0f}s and was killed."
+    elif result.error:
+        result_str = f"Execution of {result.file_path} failed with error: {result.error}"
+    elif result.exit_code != 0:
+        result_str = f"Execution of {result.file_path} failed with error (exit code {result.exit_code}): {result.stderr}"
+    else:
+        result_str = f"Execution of {result.file_path} succeeded."
+    if result.stderr_truncated and not result.succeeded:
+        result_str += "\n(stderr was truncated; the middle of it was omitted)"
+
+    # Include a snippet of output for context
+    output_lines = result.stdout.splitlines()
+    snippet = "\n".join(output_lines[-10:]) if output_lines else ""
+    if snippet or result.succeeded:
+        result_str += f"\nLast 10 lines of output:\n{snippet}"
+
+    # Enforce a character limit
+    MAX_SUMMARY_CHARS = 5000
+    if len(result_str) > MAX_SUMMARY_CHARS:
+        result_str = result_str[:MAX_SUMMARY_CHARS] + "\n... (truncated)"
+    return result_str
+
+async def run_file(file_path, sandbox_dir, executions=None):
+    """Execute a sandbox file and return the execution summary for the agent.
+
+    With EXEC_SKIP_UNCHANGED, a rerun with no sandbox file changed since the last successful run reuses its result.
+    """
+    try:
+        full_path = sandbox_path(sandbox_dir, file_path)
+        manifest = manifest_for(sandbox_dir)
+        result = await asyncio.to_thread(manifest.previous_result, file_path)
+        if result is not None:
+            print(f"[INFO] No source changed since {file_path} last ran; reusing its result")
+            if executions is not None:
+                executions.append(result)
+            return "(Nothing changed since the previous run; its result is repeated.)\n" + summarize_execution(result)
+        await asyncio.to_thread(detach_hardlinks, sandbox_dir)
+        result = await execute_code(full_path, sandbox_dir)
+        result = result._replace(file_path=file_path)
+        await asyncio.to_thread(manifest.remember_result, file_path, result)
+        if executions is not None:
+            executions.append(result)
+        if result.stdout:
+            print(f"[OUTPUT]\n{result.stdout}")
+        if result.stderr:
+            print(f"[ERROR]\n{result.stderr}")
+        if result.error:
+            print(f"[ERROR]\n{result.error}")
+        rss = f", peak RSS {result.peak_rss / 1024 ** 2:.0f} MiB" if result.peak_rss else ""
+        print(f"[INFO] {file_path} exited with code {result.exit_code} after {result.duration:.2f}s{rss}")
+        return summarize_execution(result)
+    except Exception as e:
+        print(f"[ERROR] Could not execute code: {e}")
+        return f"Execution of {file_path} failed: {e}"
+
+async def apply_command(command, sandbox_dir, executions=None, changes=None, failed_patches=None):
+    """Apply one parsed command; returns a summary for <exec> or a failed <pfil>, otherwise None.
+
+    Files the command actually changed are appended to changes when given, and the
+    feedback for a <pfil> that could not be applied to failed_patches.
+    """
+    if changes is None:
+        changes = []
+    written = len(changes)
+    if command.name == "cfol":
+        create_folder(command.body.strip(), sandbox_dir)
+    elif command.name == "cfil":
+        create_file(command.body.strip(), sandbox_dir, changes)
+    elif command.name == "efil":
+        edit_file(command.attr.strip(), command.body, sandbox_dir, changes)
+        if len(changes) > written:  # An unchanged requirements.txt or module needs no new install
+            prewarm_dependencies(command.attr.strip(), sandbox_dir)
+    elif command.name == "pfil":
+        feedback = patch_file(command.attr.strip(), command.body, sandbox_dir, changes)
+        if len(changes) > written:
+            prewarm_dependencies(command.attr.strip(), sandbox_dir)
+        if feedback and failed_patches is not None:
+            failed_patches.append(feedback)
+        return feedback
+    elif command.name == "exec":
+        return await run_file(command.body.strip(), sandbox_dir, executions)
+    elif command.name == "rinf":
+        print(f"[INFO] Agent requests more information: {command.body.strip()}")
+    return None
+
+async def process_agent_commands(assistant_message, sandbox_dir, commands=None, executions=None, changes=None,
+                                 failed_patches=None):
+    """Apply the message's commands in the order the agent wrote them.
+
+    Structured ExecutionResults for every <exec> are appended to executions when given,
+    a FileChange for every file the commands changed to changes, and the feedback of
+    every failed <pfil> to failed_patches.
+    """
     agent_message = assistant_message.get("content", "")
+    if commands is None:
+        commands = parse_commands(agent_message)
     execution_results = []
 
-    for match in re.finditer(r"<cfol>(.*?)</cfol>", agent_message):
-        folder_name = match.group(1).strip()
-        try:
-            os.makedirs(os.path.join(sandbox_dir, folder_name), exist_ok=True)
-            print(f"[INFO] Created folder: {folder_name}")
-        except Exception as e:
-            print(f"[ERROR] Could not create folder: {e}")
+    with span("commands.process", commands=len(commands)):
+        for command in commands:
+            result = await apply_command(command, sandbox_dir, executions, changes, failed_patches)
+            if result:
+                execution_results.append(result)
 
-    for match in re.finditer(r"<cfil>(.*?)</cfil>", agent_message):
-        file_path = match.group(1).strip()
-        try:
-            full_path = os.path.join(sandbox_dir, file_path)
-            folder = os.path.dirname(full_path)
-            if folder and not os.path.exists(folder):
-                os.makedirs(folder, exist_ok=True)
-            with open(full_path, "w") as f:
-                f.write("# File created by agent\n")
-            print(f"[INFO] Created file: {file_path}")
-        except Exception as e:
-            print(f"[ERROR] Could not create file: {e}")
-
-    for match in re.finditer(r'<efil file="(.*?)">(.*?)</efil>', agent_message, re.DOTALL):
-        file_path = match.group(1).strip()
-        new_content = match.group(2)
-        try:
-            full_path = os.path.join(sandbox_dir, file_path)
-            folder = os.path.dirname(full_path)
-            if folder and not os.path.exists(folder):
-                os.makedirs(folder, exist_ok=True)
-            with open(full_path, "w") as f:
-                f.write(new_content)
-            print(f"[INFO] Edited file: {file_path}")
-        except Exception as e:
-            print(f"[ERROR] Could not edit file: {e}")
-
-    for match in re.finditer(r"<exec>(.*?)</exec>", agent_message):
-        file_path = match.group(1).strip()
-        try:
-            full_path = os.path.join(sandbox_dir, file_path)
-            output, error = await execute_code(full_path, sandbox_dir)
-            if output:
-                print(f"[OUTPUT]\n{output}")
-            if error:
-                print(f"[ERROR]\n{error}")
-            
-            # Build execution summary
-            if error:
-                # Only include error, with a snippet of output for context
-                output_lines = output.splitlines()
-                snippet = "\n".join(output_lines[-10:]) if output_lines else ""
-                result_str = f"Execution of {file_path} failed with error: {error}"
-                if snippet:
-                    result_str += f"\nLast 10 lines of output:\n{snippet}"
-            else:
-                # Success case: include a snippet of output
-                output_lines = output.splitlines()
-                snippet = "\n".join(output_lines[-10:]) if output_lines else ""
-                result_str = f"Execution of {file_path} succeeded. Last 10 lines of output:\n{snippet}"
-            
-            # Enforce a character limit
-            MAX_SUMMARY_CHARS = 5000
-            if len(result_str) > MAX_SUMMARY_CHARS:
-                result_str = result_str[:MAX_SUMMARY_CHARS] + "\n... (truncated)"
-            
-            execution_results.append(result_str)
-        except Exception as e:
-            print(f"[ERROR] Could not execute code: {e}")
-            execution_results.append(f"Execution of {file_path} failed: {e}")
-
-    for match in re.finditer(r"<rinf>(.*?)</rinf>", agent_message):
-        prompt = match.group(1).strip()
-        print(f"[INFO] Agent requests more information: {prompt}")
-
-    return execution_results
\ No newline at end of file
+    return execution_results
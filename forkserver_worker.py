@@ -0,0 +1,185 @@
+"""Warm interpreter worker, run with a pooled venv's python (standard library only).
+
+Imports the modules of the declared requirements once, then listens on a Unix socket.
+Each request carries argv, cwd and resource limits as JSON plus the stdout/stderr pipe
+descriptors; the worker forks, and the child runs the script as __main__ in its own
+session with a clean module namespace. The worker answers with the child's pid, and
+later its exit code and peak RSS.
+
+Usage: python forkserver_worker.py SOCKET_PATH [REQUIREMENT ...]
+"""
+import os
+import re
+import sys
+import json
+import runpy
+import socket
+import threading
+import traceback
+import importlib
+
+MAX_REQUEST_BYTES = 1024 * 1024
+
+
+def _normalize(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def preload(requirements):
+    """Import the top-level modules provided by the required distributions."""
+    wanted = set()
+    for line in requirements:
+        match = re.match(r"^([A-Za-z0-9][A-Za-z0-9._-]*)", line.strip())
+        if match:
+            wanted.add(_normalize(match.group(1)))
+    try:
+        from importlib.metadata import packages_distributions
+        provided = packages_distributions()
+    except ImportError:  # Python < 3.10: guess that the module is named after the distribution
+        provided = {name.replace("-", "_"): [name] for name in wanted}
+    loaded = []
+    for module, distributions in sorted(provided.items()):
+        if module.startswith("_") or not module.isidentifier():
+            continue
+        if not any(_normalize(distribution) in wanted for distribution in distributions):
+            continue
+        try:
+            importlib.import_module(module)
+            loaded.append(module)
+        except Exception:
+            pass  # Whatever fails here fails the same way, with a proper traceback, in the script itself
+    return loaded
+
+
+def reseed():
+    """Give the forked child fresh random state, as a cold start would have.
+
+    Preloaded modules' global generators were seeded once, in the worker, and every
+    fork would otherwise repeat the same sequence. The random module reseeds itself
+    after a fork.
+    """
+    numpy = sys.modules.get("numpy")
+    if numpy is not None:
+        try:
+            numpy.random.seed()  # The legacy global RandomState behind np.random.*
+        except Exception:
+            pass
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        try:
+            torch.seed()
+        except Exception:
+            pass
+
+
+def run_child(request, stdout_fd, stderr_fd):
+    """Runs in the forked child: become the requested program, then exit with its status."""
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    for fd in (devnull, stdout_fd, stderr_fd):
+        os.close(fd)
+    try:
+        import resource
+        for kind, value in request.get("limits", []):
+            try:
+                resource.setrlimit(kind, (value, value))
+            except (ValueError, OSError):
+                pass
+    except ImportError:
+        pass
+    reseed()
+    code = 0
+    try:
+        os.chdir(request["cwd"])
+        argv = request["argv"]
+        sys.argv = list(argv)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(argv[0])))
+        runpy.run_path(argv[0], run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+    os._exit(code & 0xFF)
+
+
+def reap(connection, pid):
+    """Wait for a child and report its exit code and peak RSS on its connection."""
+    _, status, usage = os.wait4(pid, 0)
+    maxrss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    try:
+        connection.sendall(json.dumps({"exit_code": os.waitstatus_to_exitcode(status), "peak_rss": maxrss}).encode() + b"\n")
+    except OSError:
+        pass
+    finally:
+        connection.close()
+
+
+def handle(listener, connection):
+    data, fds, _, _ = socket.recv_fds(connection, MAX_REQUEST_BYTES, 2)
+    while not data.endswith(b"\n"):
+        more = connection.recv(MAX_REQUEST_BYTES)
+        if not more:
+            break
+        data += more
+    if len(fds) != 2:
+        for fd in fds:
+            os.close(fd)
+        connection.close()
+        return
+    request = json.loads(data)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        listener.close()
+        connection.close()
+        run_child(request, *fds)
+    for fd in fds:
+        os.close(fd)
+    connection.sendall(json.dumps({"pid": pid}).encode() + b"\n")
+    threading.Thread(target=reap, args=(connection, pid), daemon=True).start()
+
+
+def exit_with_parent():
+    """The parent keeps our stdin open; EOF means it is gone."""
+    sys.stdin.buffer.read()
+    os._exit(0)
+
+
+def main():
+    socket_path, requirements = sys.argv[1], sys.argv[2:]
+    # Scripts must not see this file's directory on their import path
+    sys.path = [path for path in sys.path if os.path.abspath(path or ".") != os.path.dirname(os.path.abspath(__file__))]
+    loaded = preload(requirements)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(16)
+    threading.Thread(target=exit_with_parent, daemon=True).start()
+    print("ready " + json.dumps(loaded), flush=True)
+    while True:
+        connection, _ = listener.accept()
+        try:
+            handle(listener, connection)
+        except Exception:
+            traceback.print_exc()
+            connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+import os
+import copy
+import queue
+import contextlib
+import threading
+from collections import OrderedDict
+
+# Configuration for local Hugging Face inference
+HF_MAX_NEW_TOKENS = int(os.getenv("HF_MAX_NEW_TOKENS", "2048"))
+HF_QUANTIZE_INT8 = os.getenv("HF_QUANTIZE_INT8", "0").lower() in ("1", "true", "yes")
+HF_MAX_CACHED_PREFIXES = int(os.getenv("HF_MAX_CACHED_PREFIXES", "8"))
+# Continuous batching: concurrent sessions share decode steps (1 disables it and serializes requests)
+HF_MAX_BATCH_SIZE = int(os.getenv("HF_MAX_BATCH_SIZE", "8"))
+HF_TEMPERATURE = float(os.getenv("HF_TEMPERATURE", "0"))  # 0 is greedy decoding
+
+
+def common_prefix_length(a, b):
+    """Length of the shared leading run of two token id lists."""
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class PrefixEntry:
+    """Token ids already run through the model, with the key/value cache they produced."""
+
+    def __init__(self, token_ids, past_key_values):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+
+
+class LocalInferenceEngine:
+    """Local causal-LM inference that reuses key/value caches across turns.
+
+    Each finished generation leaves its prompt-plus-reply cache in a small LRU
+    pool. The next request picks the entry sharing the longest token prefix
+    with its prompt, crops it to that prefix and only prefills the new suffix,
+    so the system prompt and earlier turns are not recomputed every turn.
+    """
+
+    def __init__(self, model_name, max_new_tokens=HF_MAX_NEW_TOKENS, quantize=HF_QUANTIZE_INT8,
+                 max_cached_prefixes=HF_MAX_CACHED_PREFIXES):
+        self.model_name = model_name
+        self.max_new_tokens = max_new_tokens
+        self.quantize = quantize
+        self.max_cached_prefixes = max_cached_prefixes
+        self.model = None
+        self.tokenizer = None
+        self._prefixes = OrderedDict()  # id -> PrefixEntry, least recently used first
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def load_tokenizer(self):
+        if self.tokenizer is None:
+            from transformers import AutoTokenizer
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        return self.tokenizer
+
+    def load(self):
+        if self.model is None:
+            print(f"[INFO] Loading Hugging Face model: {self.model_name}")
+            self.load_tokenizer()
+            import torch
+            from transformers import AutoModelForCausalLM
+            model = AutoModelForCausalLM.from_pretrained(self.model_name)
+            model.eval()
+            if self.quantize and not torch.cuda.is_available():
+                # Dynamic int8 quantization of the linear layers: smaller weights, faster CPU matmuls
+                print("[INFO] Quantizing linear layers to int8")
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            self.model = model
+        return self.model
+
+    def encode(self, messages):
+        """Token ids for the conversation, ending with the assistant generation prompt."""
+        self.load()
+        encoded = self.tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)
+        if isinstance(encoded, dict) or hasattr(encoded, "input_ids"):
+            encoded = encoded["input_ids"]  # Newer tokenizers return a BatchEncoding
+        return list(encoded)
+
+    def _take_prefix(self, token_ids):
+        """Return (cache, reused_length) for the best cached prefix of token_ids."""
+        from transformers import DynamicCache
+        best_id, best_length = None, 0
+        for entry_id, entry in self._prefixes.items():
+            length = common_prefix_length(entry.token_ids, token_ids)
+            if length > best_length:
+                best_id, best_length = entry_id, length
+        # At least one prompt token has to be run to get logits for the first new token
+        best_length = min(best_length, len(token_ids) - 1)
+        if best_id is None or best_length <= 0:
+            return DynamicCache(), 0
+        entry = self._prefixes[best_id]
+        if best_length * 2 >= len(entry.token_ids):
+            # Mostly the same conversation: take the entry over instead of copying it
+            del self._prefixes[best_id]
+            cache = entry.past_key_values
+        else:
+            # Only a shared prefix (e.g. the system prompt): leave the other conversation's entry intact
+            self._prefixes.move_to_end(best_id)
+            cache = copy.deepcopy(entry.past_key_values)
+        cache.crop(best_length)
+        return cache, best_length
+
+    def _store_prefix(self, token_ids, cache):
+        self._prefixes[self._next_id] = PrefixEntry(token_ids, cache)
+        self._next_id += 1
+        while len(self._prefixes) > self.max_cached_prefixes:
+            self._prefixes.popitem(last=False)
+
+    def generate(self, messages, max_new_tokens=None, streamer=None):
+        """Generate a reply for the conversation, prefilling only the uncached suffix."""
+        import torch
+        with self._lock:
+            model = self.load()
+            token_ids = self.encode(messages)
+            cache, reused = self._take_prefix(token_ids)
+            input_ids = torch.tensor([token_ids], device=model.device)
+            with torch.no_grad():
+                output = model.generate(
+                    input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    past_key_values=cache,
+                    max_new_tokens=max_new_tokens or self.max_new_tokens,
+                    return_dict_in_generate=True,
+                    streamer=streamer,
+                    pad_token_id=self.tokenizer.pad_token_id or self.tokenizer.eos_token_id
+                )
+            sequence = output.sequences[0].tolist()
+            cache = output.past_key_values
+            # The cache covers every token except the last one sampled
+            self._store_prefix(sequence[:cache.get_seq_length()], cache)
+            if reused:
+                print(f"[INFO] Reused {reused}/{len(token_ids)} cached prompt tokens")
+            return self.tokenizer.decode(sequence[len(token_ids):], skip_special_tokens=True)
+
+
+def _cache_layers(cache):
+    """[(keys, values), ...] per layer of a DynamicCache, across transformers versions."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def _build_cache(layers):
+    from transformers import DynamicCache
+    cache = DynamicCache()
+    for index, (keys, values) in enumerate(layers):
+        cache.update(keys, values, index)
+    return cache
+
+
+def _left_pad(tensor, amount, dim):
+    """Prepend `amount` zeros along dim (the sequence axis)."""
+    if amount <= 0:
+        return tensor
+    import torch
+    shape = list(tensor.shape)
+    shape[dim] = amount
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class GenerationRequest:
+    """One sequence being decoded by the continuous batcher."""
+
+    def __init__(self, token_ids, max_new_tokens, streamer, future):
+        self.token_ids = token_ids
+        self.max_new_tokens = max_new_tokens
+        self.streamer = streamer
+        self.future = future
+        self.generated = []
+        self.length = len(token_ids)  # Tokens held in this row's cache, excluding left padding
+        self.done = False
+
+
+class ContinuousBatcher:
+    """Step-level batching of concurrent generations on one local model.
+
+    A scheduler thread keeps the active sequences in one left-padded key/value
+    cache and runs a single decode step for all of them at once. New requests
+    are prefilled on their own (reusing the engine's prefix caches) and join
+    between steps; finished ones leave immediately, so a short reply never
+    waits for a long one and the weights are read once per step for everyone.
+    """
+
+    def __init__(self, engine, max_batch_size=HF_MAX_BATCH_SIZE, temperature=HF_TEMPERATURE):
+        self.engine = engine
+        self.max_batch_size = max(max_batch_size, 1)
+        self.temperature = temperature
+        self.active = []
+        self.cache = None  # Batched DynamicCache, one row per active request
+        self.mask = None   # Attention mask over the cache, 0 for left padding
+        self._eos = None
+        self._pending = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, messages, max_new_tokens=None, streamer=None):
+        """Queue a conversation; returns a concurrent.futures.Future of the reply text."""
+        from concurrent.futures import Future
+        future = Future()
+        self._pending.put((messages, max_new_tokens or self.engine.max_new_tokens, streamer, future))
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="hf-batcher", daemon=True)
+                self._thread.start()
+        return future
+
+    def _run(self):
+        # Any failure fails the batch it hit and resets it; the thread itself must never die,
+        # or every pending and future request would wait on its future forever
+        while True:
+            try:
+                self._run_once()
+            except Exception as e:
+                print(f"[ERROR] Batched generation failed: {e}")
+                for request in self.active:
+                    self._finish(request, error=e)
+                self.active, self.cache, self.mask = [], None, None
+
+    def _run_once(self):
+        if not self.active:
+            self._admit(self._pending.get())  # Idle: block until a request arrives
+        while len(self.active) < self.max_batch_size:
+            try:
+                self._admit(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        self._drop_finished()
+        if self.active:
+            import torch
+            with torch.no_grad():
+                self._step()
+
+    def _eos_ids(self):
+        if self._eos is None:
+            ids = self.engine.model.generation_config.eos_token_id
+            ids = set(ids if isinstance(ids, (list, tuple)) else [] if ids is None else [ids])
+            if self.engine.tokenizer.eos_token_id is not None:
+                ids.add(self.engine.tokenizer.eos_token_id)
+            self._eos = ids
+        return self._eos
+
+    def _sample(self, logits):
+        import torch
+        if self.temperature <= 0:
+            return logits.argmax(dim=-1)
+        probabilities = torch.softmax(logits.float() / self.temperature, dim=-1)
+        return torch.multinomial(probabilities, 1).squeeze(-1)
+
+    def _accept(self, request, token):
+        """Record a sampled token, marking the request done on EOS or at its token limit."""
+        if token in self._eos_ids():
+            request.done = True
+            return
+        request.generated.append(token)
+        if request.streamer is not None:
+            import torch
+            request.streamer.put(torch.tensor([token]))
+        if len(request.generated) >= request.max_new_tokens:
+            request.done = True
+
+    def _admit(self, item):
+        """Prefill a new request on its own and merge its cache into the running batch."""
+        messages, max_new_tokens, streamer, future = item
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            import torch
+            with torch.no_grad(), self.engine._lock:
+                model = self.engine.load()
+                token_ids = self.engine.encode(messages)
+                cache, reused = self.engine._take_prefix(token_ids)
+                output = model(
+                    input_ids=torch.tensor([token_ids[reused:]], device=model.device),
+                    attention_mask=torch.ones((1, len(token_ids)), dtype=torch.long, device=model.device),
+                    position_ids=torch.arange(reused, len(token_ids), device=model.device)[None],
+                    past_key_values=cache,
+                    use_cache=True
+                )
+            if reused:
+                print(f"[INFO] Reused {reused}/{len(token_ids)} cached prompt tokens")
+        except Exception as e:
+            if streamer is not None:
+                streamer.end()
+            future.set_exception(e)
+            return
+        request = GenerationRequest(token_ids, max_new_tokens, streamer, future)
+        try:
+            if streamer is not None:
+                streamer.put(torch.tensor([token_ids]))  # Streamers skip the first (prompt) chunk they get
+            self._merge(request, output.past_key_values)
+            self._accept(request, int(self._sample(output.logits[:, -1, :])[0]))
+        except Exception as e:
+            if request not in self.active:
+                self._finish(request, error=e)  # Not in the batch, so _run would not fail it
+            raise
+
+    def _merge(self, request, row_cache):
+        """Append a prefilled row, left-padding whichever of the batch and the row is shorter."""
+        import torch
+        row_layers = _cache_layers(row_cache)
+        row_mask = torch.ones((1, request.length), dtype=torch.long, device=row_layers[0][0].device)
+        if self.cache is None:
+            self.active = [request]
+            self.cache, self.mask = _build_cache(row_layers), row_mask
+            return
+        batch_pad = max(request.length - self.mask.shape[1], 0)
+        row_pad = max(self.mask.shape[1] - request.length, 0)
+        layers = [
+            (torch.cat([_left_pad(keys, batch_pad, 2), _left_pad(row_keys, row_pad, 2)]),
+             torch.cat([_left_pad(values, batch_pad, 2), _left_pad(row_values, row_pad, 2)]))
+            for (keys, values), (row_keys, row_values) in zip(_cache_layers(self.cache), row_layers)
+        ]
+        self.mask = torch.cat([_left_pad(self.mask, batch_pad, 1), _left_pad(row_mask, row_pad, 1)])
+        self.cache = _build_cache(layers)
+        self.active.append(request)
+
+    def _step(self):
+        """Feed every active row its last sampled token and sample the next one."""
+        import torch
+        device = self.mask.device
+        self.mask = torch.cat([self.mask, self.mask.new_ones((len(self.active), 1))], dim=1)
+        output = self.engine.model(
+            input_ids=torch.tensor([[request.generated[-1]] for request in self.active], device=device),
+            attention_mask=self.mask,
+            position_ids=torch.tensor([[request.length] for request in self.active], device=device),
+            past_key_values=self.cache,
+            use_cache=True
+        )
+        self.cache = output.past_key_values
+        for request, token in zip(self.active, self._sample(output.logits[:, -1, :]).tolist()):
+            request.length += 1
+            self._accept(request, token)
+
+    def _drop_finished(self):
+        """Remove finished rows and trim padding columns that no remaining row needs."""
+        keep = [i for i, request in enumerate(self.active) if not request.done]
+        if len(keep) == len(self.active):
+            return
+        import torch
+        layers = _cache_layers(self.cache)
+        width = self.mask.shape[1]
+        for i, request in enumerate(self.active):
+            if request.done:
+                # Hand the row's unpadded cache back to the engine's prefix pool for the next turn
+                row = [(keys[i:i + 1, :, width - request.length:], values[i:i + 1, :, width - request.length:])
+                       for keys, values in layers]
+                self._finish(request, row_cache=_build_cache([(k.clone(), v.clone()) for k, v in row]))
+        if not keep:
+            self.active, self.cache, self.mask = [], None, None
+            return
+        index = torch.tensor(keep, device=self.mask.device)
+        start = width - max(self.active[i].length for i in keep)
+        self.mask = self.mask.index_select(0, index)[:, start:]
+        self.cache = _build_cache([
+            (keys.index_select(0, index)[:, :, start:], values.index_select(0, index)[:, :, start:])
+            for keys, values in layers
+        ])
+        self.active = [self.active[i] for i in keep]
+
+    def _finish(self, request, row_cache=None, error=None):
+        if request.future.done():
+            return
+        if request.streamer is not None:
+            with contextlib.suppress(Exception):
+                request.streamer.end()
+        if error is not None:
+            request.future.set_exception(error)
+            return
+        if row_cache is not None:
+            # The cache covers the prompt and every reply token except the last one sampled
+            sequence = request.token_ids + request.generated
+            with self.engine._lock:
+                self.engine._store_prefix(sequence[:request.length], row_cache)
+        text = self.engine.tokenizer.decode(request.generated, skip_special_tokens=True)
+        request.future.set_result(text)
@@ -0,0 +1,100 @@
+import hashlib
+from collections import Counter
+from commands import parse_commands
+
+EXECUTION_RESULTS_PREFIX = "Execution results:\n"
+MAX_COLLAPSED_LINE_CHARS = 160
+
+
+def file_stub(path, body):
+    """Short placeholder for a file body that a later edit replaced.
+
+    The stub deliberately is not an <efil> tag so the model never copies it as file content.
+    """
+    digest = hashlib.sha256(body.encode("utf-8")).hexdigest()[:12]
+    lines = body.count("\n") + 1 if body else 0
+    return f'[efil file="{path}" superseded by a later edit; sha256:{digest}, {lines} lines]'
+
+
+def collapse_execution_results(content):
+    """Reduce an old execution summary to one line per executed file."""
+    headers = [
+        line[:MAX_COLLAPSED_LINE_CHARS]
+        for line in content[len(EXECUTION_RESULTS_PREFIX):].splitlines()
+        if line.startswith("Execution of ")
+    ]
+    return "Execution results (superseded):\n" + "\n".join(headers)
+
+
+class HistoryCompactor:
+    """Keeps only the latest full body of each sandbox file in an agent's history.
+
+    Earlier <efil> bodies for the same path become content-hash stubs and all
+    but the most recent execution summary are collapsed, so the prompt grows
+    with the number of distinct files rather than with the number of edits.
+    """
+
+    def __init__(self):
+        self._reset(None)
+
+    def _reset(self, messages):
+        self._source = messages
+        self._seen = 0
+        self.latest_file = {}       # path -> index of the message holding its latest full body
+        self.latest_results = None  # index of the most recent execution summary
+
+    def compact(self, messages, budget=None):
+        """Stub out history superseded by messages appended since the last call."""
+        if messages is not self._source or len(messages) < self._seen:
+            self._reset(messages)
+        for index in range(self._seen, len(messages)):
+            message = messages[index]
+            content = message.get("content") or ""
+            if message.get("role") == "assistant":
+                self._supersede_files(messages, index, content, budget)
+            elif message.get("role") == "system" and content.startswith(EXECUTION_RESULTS_PREFIX):
+                if self.latest_results is not None:
+                    old = messages[self.latest_results]
+                    self._replace(messages, self.latest_results, collapse_execution_results(old["content"]), budget)
+                self.latest_results = index
+        self._seen = len(messages)
+
+    def _supersede_files(self, messages, index, content, budget):
+        paths = [command.attr.strip() for command in parse_commands(content) if command.name == "efil"]
+        if not paths:
+            return
+        stale = {}
+        for path in paths:
+            previous = self.latest_file.get(path)
+            if previous is not None and previous != index:
+                stale.setdefault(previous, set()).add(path)
+            self.latest_file[path] = index
+        repeated = {path for path, count in Counter(paths).items() if count > 1}
+        if repeated:
+            stale.setdefault(index, set()).update(repeated)
+        for stale_index, stale_paths in stale.items():
+            self._stub_files(messages, stale_index, stale_paths, budget, keep_last=stale_index == index)
+
+    def _stub_files(self, messages, index, paths, budget, keep_last):
+        content = messages[index]["content"]
+        commands = [c for c in parse_commands(content) if c.name == "efil" and c.attr.strip() in paths]
+        if keep_last:
+            # Within the newest message only the final edit of each path stays in full
+            last = {c.attr.strip(): c for c in commands}
+            commands = [c for c in commands if last[c.attr.strip()] is not c]
+        if not commands:
+            return
+        parts = []
+        position = 0
+        for command in commands:
+            parts.append(content[position:command.start])
+            parts.append(file_stub(command.attr.strip(), command.body))
+            position = command.end
+        parts.append(content[position:])
+        self._replace(messages, index, "".join(parts), budget)
+
+    def _replace(self, messages, index, content, budget):
+        message = dict(messages[index], content=content)
+        messages[index] = message
+        if budget is not None:
+            budget.update(index, message)
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Configuration for the on-disk completion cache
+# Modes: "off" (default), "readwrite" (serve hits, store misses), "replay" (serve hits, fail on misses)
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "off")
+LLM_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "auto-python-agent", "llm_cache.sqlite3"),
+)
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(512 * 1024 ** 2)))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "0"))  # 0 keeps entries until evicted
+
+CACHE_MODES = ("off", "readwrite", "replay")
+
+
+class CacheMissError(LookupError):
+    """Raised in replay mode when a request has no cached completion."""
+
+
+class LLMCache:
+    """Content-addressed SQLite store of chat completions with LRU size/TTL eviction."""
+
+    def __init__(self, path=LLM_CACHE_PATH, mode="readwrite", max_bytes=LLM_CACHE_MAX_BYTES, ttl=LLM_CACHE_TTL_SECONDS):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        self._total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    @staticmethod
+    def key(provider, model, messages, max_tokens):
+        """Hash everything that determines a completion into a stable cache key."""
+        request = {
+            "provider": provider,
+            "model": model,
+            "max_tokens": max_tokens,
+            "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+        }
+        encoded = json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key):
+        """Return the cached completion dict, or None on a miss or expired entry."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT response, size, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response, size, created = row
+            if self.ttl and now - created > self.ttl:
+                self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._total -= size
+                return None
+            self._db.execute("UPDATE completions SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(response)
+
+    def put(self, key, chat_data):
+        """Store a completion, evicting least recently used entries past the size limit."""
+        content = chat_data["choices"][0]["message"]["content"]
+        response = json.dumps({"choices": [{"message": {"role": "assistant", "content": content}}]})
+        size = len(response)
+        now = time.time()
+        with self._lock:
+            previous = self._db.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions (key, response, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now)
+            )
+            self._total += size - (previous[0] if previous else 0)
+            if self._total > self.max_bytes:
+                self._evict(now)
+
+    def _evict(self, now):
+        if self.ttl:
+            expired = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM completions WHERE created < ?", (now - self.ttl,)
+            ).fetchone()[0]
+            self._db.execute("DELETE FROM completions WHERE created < ?", (now - self.ttl,))
+            self._total -= expired
+        # Evict down to 90% so a full cache does not evict on every insert
+        target = self.max_bytes * 0.9
+        rows = self._db.execute("SELECT key, size FROM completions ORDER BY last_used ASC")
+        doomed = []
+        for key, size in rows:
+            if self._total <= target:
+                break
+            doomed.append((key,))
+            self._total -= size
+        self._db.executemany("DELETE FROM completions WHERE key = ?", doomed)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_cache = None
+_configured = False
+
+def configure_llm_cache(mode=LLM_CACHE_MODE, path=LLM_CACHE_PATH, **kwargs):
+    """Select the process-wide cache mode; returns the active cache or None when off."""
+    global _cache, _configured
+    _configured = True
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+    if mode != "off":
+        _cache = LLMCache(path=path, mode=mode, **kwargs)
+    return _cache
+
+def get_llm_cache():
+    """Return the process-wide cache, creating it from the environment on first use."""
+    if not _configured:
+        configure_llm_cache()
+    return _cache
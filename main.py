@@ -1,7 +1,10 @@
 import os
+import shutil
 import asyncio
 from agents import ProductDesignerAgent, SoftwareEngineerAgent
-from file_manager import create_sandbox
+from file_manager import create_sandbox, clone_sandbox, adopt_sandbox, release_sandbox
+from checkpoint import checkpoint_store, CHECKPOINT_ENABLED
+from telemetry import span, metrics, serve_metrics, flush_metrics, METRICS_PORT
 
 # Map agent keys to their classes
 AGENT_CLASSES = {
@@ -9,25 +12,43 @@ AGENT_CLASSES = {
     "software_engineer": SoftwareEngineerAgent
 }
 
+# Number of fix candidates tried in parallel per retry (1 keeps the sequential fix loop)
+FIX_CANDIDATES = int(os.getenv("FIX_CANDIDATES", "1"))
+
 # Force Ollama to use CPU mode if chosen (optional)
 os.environ["OLLAMA_USE_GPU"] = "0"
 
-async def process_agent_interaction(agent, initial_input):
-    """Process interaction with an agent, handling <rinf> if present."""
+async def ainput(prompt=""):
+    """Read a line from the terminal without blocking the event loop."""
+    return (await asyncio.to_thread(input, prompt)).strip()
+
+async def console_ask(agent, prompt):
+    """Ask the person at the terminal to answer an agent's <rinf> prompt."""
+    return await ainput("You: ")
+
+async def process_agent_interaction(agent, initial_input, ask_user=console_ask, on_response=None):
+    """Process interaction with an agent, handling <rinf> if present.
+
+    ask_user(agent, prompt) supplies the answer to each <rinf>; returning None or "exit" aborts the phase.
+    on_response(agent, response), if given, is awaited with every response the agent produces.
+    """
     current_input = initial_input
     while True:
         response = await agent.process_input(current_input)
         if response is None:
             print(f"[{agent.key.upper()} ERROR] Failed to respond.")
             return None
-        print(f"{agent.key.replace('_', ' ').title()}: {response}")
+        if not agent.stream:
+            print(f"{agent.key.replace('_', ' ').title()}: {response}")
+        if on_response is not None:
+            await on_response(agent, response)
         if not agent.needs_more_info(response):
             return response
         prompt = agent.extract_rinf_prompt(response)
         if prompt:
             print(f"{agent.key.replace('_', ' ').title()} asks: {prompt}")
-            user_response = input("You: ").strip()  # Synchronous input
-            if user_response.lower() == "exit":
+            user_response = await ask_user(agent, prompt)
+            if user_response is None or user_response.lower() == "exit":
                 print(f"Exiting {agent.key} phase.")
                 return None
             current_input = user_response
@@ -35,59 +56,172 @@ async def process_agent_interaction(agent, initial_input):
             print(f"[{agent.key.upper()} ERROR] Invalid <rinf> format.")
             return None
 
-async def chain_agents(agent_list, initial_input):
+async def chain_agents(agent_list, initial_input, ask_user=console_ask, on_response=None):
     """Chain agents, passing each response to the next."""
     current_input = initial_input
     for agent in agent_list:
-        response = await process_agent_interaction(agent, current_input)
+        response = await process_agent_interaction(agent, current_input, ask_user, on_response)
         if response is None:
             return None
         current_input = response
     return current_input
 
-async def main(provider="ollama", agent_keys=["product_designer", "software_engineer"]):
-    print("Please describe what you want to build:")
-    user_initial_prompt = input().strip()  # Synchronous input
-
-    if not user_initial_prompt:
-        print("[ERROR] You must enter a project description.")
-        return
-
-    sandbox_dir = await create_sandbox()
-    print(f"[INFO] Using sandbox directory: {sandbox_dir}")
-
-    # Instantiate agents based on keys
+def create_agents(agent_keys, provider, sandbox_dir, stream=False):
+    """Instantiate the agents for the given keys, or return None if a key is unknown."""
     agents = []
     for key in agent_keys:
         agent_class = AGENT_CLASSES.get(key)
         if not agent_class:
             print(f"[ERROR] Unknown agent key: {key}")
-            return
-        agents.append(agent_class(provider=provider, sandbox_dir=sandbox_dir))
+            return None
+        agents.append(agent_class(provider=provider, sandbox_dir=sandbox_dir, stream=stream))
+    return agents
+
+def execution_failed(agent):
+    """Check whether the agent's last turn left a <pfil> unapplied or ran a program that failed."""
+    return bool(agent.failed_patches) or any(not result.succeeded for result in agent.last_executions)
 
-    # Chain agents with initial prompt
-    final_output = await chain_agents(agents, user_initial_prompt)
-    if final_output is None:
-        return
+def made_progress(agent):
+    """Whether the agent's last turn changed the sandbox or ran anything."""
+    return bool(agent.last_executions or agent.last_changes)
 
-    # Retry mechanism to fix execution errors after initial development
-    last_agent = agents[-1]
-    max_retries = 3
+def fix_prompt(agent):
+    last_message = agent.messages[-1]
+    return f"The execution failed with the following error:\n{last_message['content']}\nPlease fix the issue and ensure the code runs successfully."
+
+async def fix_execution_errors(agent, max_retries=3, ask_user=console_ask, on_response=None):
+    """Ask the agent to fix failed executions; returns the number of retries, or None if a retry aborted."""
+    if FIX_CANDIDATES > 1:
+        return await fix_execution_errors_parallel(agent, FIX_CANDIDATES, max_retries, on_response)
     retry_count = 0
-    while retry_count < max_retries:
-        last_message = last_agent.messages[-1]
-        if last_message["role"] == "system" and "error" in last_message["content"].lower():
-            fix_prompt = f"The execution failed with the following error:\n{last_message['content']}\nPlease fix the issue and ensure the code runs successfully."
-            response = await process_agent_interaction(last_agent, fix_prompt)
+    with span("fix", agent=agent.key) as current:
+        while retry_count < max_retries and execution_failed(agent):
+            metrics.inc("agent_fix_retries_total", help="Fix attempts after failed executions", agent=agent.key)
+            response = await process_agent_interaction(agent, fix_prompt(agent), ask_user, on_response)
             if response is None:
-                break
+                current.set(retries=retry_count, aborted=True)
+                return None
             retry_count += 1
-        else:
-            break
-    if retry_count == max_retries:
-        print("[ERROR] Maximum retries reached. Entering interactive mode for manual intervention.")
-        # Reset message history for fresh start in interactive mode
-        last_agent.messages = [{"role": "system", "content": last_agent.system_prompt}]
+        current.set(retries=retry_count, still_failing=execution_failed(agent))
+    return retry_count
+
+async def no_answer(agent, prompt):
+    return None  # Parallel fix candidates cannot ask questions; one that does drops out
+
+async def attempt_fix(candidate, prompt):
+    """Run one fix candidate; returns (candidate, True) if it acted and all its patches and programs succeeded."""
+    response = await process_agent_interaction(candidate, prompt, no_answer)
+    return candidate, response is not None and made_progress(candidate) and not execution_failed(candidate)
+
+async def fix_execution_errors_parallel(agent, candidates=2, max_rounds=3, on_response=None):
+    """Best-of-N repair: try several fixes at once, each in its own clone of the sandbox.
+
+    The first candidate whose patches apply and programs all exit cleanly is adopted and the
+    others are cancelled. If none does, the first one that changed or ran anything is adopted
+    and the next round starts from it. Returns the number of rounds, or None if no
+    candidate produced anything usable.
+    """
+    rounds = 0
+    with span("fix.parallel", agent=agent.key, candidates=candidates) as current:
+        while rounds < max_rounds and execution_failed(agent):
+            rounds += 1
+            metrics.inc("agent_fix_retries_total", help="Fix attempts after failed executions", agent=agent.key)
+            prompt = fix_prompt(agent)
+            forks = []
+            for i in range(candidates):
+                clone_dir = await asyncio.to_thread(clone_sandbox, agent.sandbox_dir, f"fix{rounds}-{i + 1}")
+                forks.append(agent.fork(clone_dir))
+            # Vary the prompts so candidates explore different fixes (and do not share a cached reply)
+            tasks = [
+                asyncio.create_task(attempt_fix(fork, prompt if i == 0 else (
+                    f"{prompt}\n(Candidate {i + 1} of {candidates}: consider a different fix than the most obvious one.)"
+                )))
+                for i, fork in enumerate(forks)
+            ]
+            winner = fallback = None
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    try:
+                        candidate, succeeded = await finished
+                    except Exception as e:
+                        print(f"[ERROR] Fix candidate failed: {e}")
+                        continue
+                    if succeeded:
+                        winner = candidate
+                        break
+                    if fallback is None and made_progress(candidate):
+                        fallback = candidate
+            finally:
+                for task in tasks:
+                    task.cancel()  # Also kills programs the losing candidates are still running
+                await asyncio.gather(*tasks, return_exceptions=True)
+            winner = winner or fallback
+            for fork in forks:
+                if fork is not winner:
+                    await asyncio.to_thread(shutil.rmtree, fork.sandbox_dir, True)
+                    release_sandbox(fork.sandbox_dir)
+            if winner is None:
+                current.set(rounds=rounds, aborted=True)
+                return None
+            await asyncio.to_thread(adopt_sandbox, agent.sandbox_dir, winner.sandbox_dir)
+            winner.sandbox_dir = agent.sandbox_dir
+            agent.adopt(winner)
+            print(f"[INFO] Adopted fix candidate {forks.index(winner) + 1} of {candidates}")
+            if on_response is not None:
+                response = next(m["content"] for m in reversed(agent.messages) if m["role"] == "assistant")
+                await on_response(agent, response)
+        current.set(rounds=rounds, still_failing=execution_failed(agent))
+    return rounds
+
+def checkpointer(session_id, agents, sandbox_dir):
+    """on_response callback that checkpoints the session after every agent turn."""
+    async def on_response(agent, response):
+        if CHECKPOINT_ENABLED:
+            checkpoint_id = await asyncio.to_thread(checkpoint_store.save, session_id, agents, sandbox_dir)
+            print(f"[INFO] Checkpoint {checkpoint_id}")
+    return on_response
+
+async def main(provider="ollama", agent_keys=["product_designer", "software_engineer"], stream=False,
+               resume=None, branch=False):
+    """Run a session; resume (a checkpoint or session id) continues or, with branch, forks an earlier one."""
+    if resume:
+        sandbox_dir = await create_sandbox(label="resumed")
+        session_id, agents = await asyncio.to_thread(checkpoint_store.resume, resume, sandbox_dir, branch)
+        for agent in agents:
+            agent.stream = agent.stream or stream  # --stream turns it on; otherwise keep the checkpoint's setting
+        print(f"[INFO] {'Branched' if branch else 'Resumed'} session {session_id} in {sandbox_dir}")
+        on_response = checkpointer(session_id, agents, sandbox_dir)
+        last_agent = agents[-1]
+    else:
+        print("Please describe what you want to build:")
+        user_initial_prompt = await ainput()
+
+        if not user_initial_prompt:
+            print("[ERROR] You must enter a project description.")
+            return
+
+        sandbox_dir = await create_sandbox()
+        print(f"[INFO] Using sandbox directory: {sandbox_dir}")
+
+        # Instantiate agents based on keys
+        agents = create_agents(agent_keys, provider, sandbox_dir, stream)
+        if agents is None:
+            return
+        on_response = checkpointer(os.path.basename(sandbox_dir), agents, sandbox_dir)
+
+        # Chain agents with initial prompt
+        final_output = await chain_agents(agents, user_initial_prompt, on_response=on_response)
+        if final_output is None:
+            return
+
+        # Retry mechanism to fix execution errors after initial development
+        last_agent = agents[-1]
+        max_retries = 3
+        retry_count = await fix_execution_errors(last_agent, max_retries, on_response=on_response)
+        if retry_count == max_retries:
+            print("[ERROR] Maximum retries reached. Entering interactive mode for manual intervention.")
+            # Reset message history for fresh start in interactive mode
+            last_agent.messages = [{"role": "system", "content": last_agent.system_prompt}]
 
     # Start interactive post-development session with the last agent
     print(f"\n{last_agent.key.replace('_', ' ').title()} has completed the initial development.")
@@ -96,41 +230,50 @@ async def main(provider="ollama", agent_keys=["product_designer", "software_engi
 
     while True:
         # Prompt user for a request
-        user_input = input("Your request (or 'exit' to quit): ").strip()  # Synchronous input
+        user_input = await ainput("Your request (or 'exit' to quit): ")
         if user_input.lower() == "exit":
             print("Ending chat. Goodbye!")
             break
 
         # Process the request, which may involve multiple interactions if <rinf> is used
-        response = await process_agent_interaction(last_agent, user_input)
+        response = await process_agent_interaction(last_agent, user_input, on_response=on_response)
         if response is None:
             print("\nRequest aborted or failed. You can try again.")
             continue
 
         # Check for execution errors and attempt to fix them
         max_retries = 3
-        retry_count = 0
-        while retry_count < max_retries:
-            last_message = last_agent.messages[-1]
-            if last_message["role"] == "system" and "error" in last_message["content"].lower():
-                fix_prompt = f"The execution failed with the following error:\n{last_message['content']}\nPlease fix the issue and ensure the code runs successfully."
-                response = await process_agent_interaction(last_agent, fix_prompt)
-                if response is None:
-                    print("\nError fixing aborted or failed.")
-                    break
-                retry_count += 1
-            else:
-                break
-        if retry_count == max_retries:
+        retry_count = await fix_execution_errors(last_agent, max_retries, on_response=on_response)
+        if retry_count is None:
+            print("\nError fixing aborted or failed.")
+        elif retry_count == max_retries:
             print("[ERROR] Maximum retries reached. Please check the code manually or try a different request.")
 
         # After a complete response or error resolution, ask if the user wants more
-        continue_chat = input("Did you want anything else? (yes/no): ").strip().lower()
+        continue_chat = (await ainput("Did you want anything else? (yes/no): ")).lower()
         if continue_chat != "yes":
             print("Ending chat. Goodbye!")
             break
 
 if __name__ == "__main__":
-    provider = "openai"  # or "ollama", "anthropic", "huggingface", "deepseek"
+    import argparse
+    parser = argparse.ArgumentParser(description="Build a project with a chain of agents.")
+    parser.add_argument("--provider", default="openai", help="openai, ollama, anthropic, huggingface or deepseek")
+    parser.add_argument("--resume", metavar="CHECKPOINT", help="continue a session from a checkpoint or session id")
+    parser.add_argument("--branch", metavar="CHECKPOINT", help="start a new session from a checkpoint")
+    parser.add_argument("--stream", action="store_true", help="echo responses as they arrive and apply commands as they close")
+    parser.add_argument("--gc-checkpoints", action="store_true",
+                        help="prune old checkpoints (CHECKPOINT_KEEP per session), delete unreferenced objects and exit")
+    args = parser.parse_args()
+    if args.gc_checkpoints:
+        pruned, removed = checkpoint_store.gc()
+        print(f"[INFO] Removed {pruned} checkpoint(s) and {removed} object(s) from {checkpoint_store.root}")
+        raise SystemExit(0)
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
     # Run the main function with the specified provider and agent keys
-    asyncio.run(main(provider=provider, agent_keys=["product_designer", "software_engineer"]))
\ No newline at end of file
+    try:
+        asyncio.run(main(provider=args.provider, agent_keys=["product_designer", "software_engineer"],
+                         stream=args.stream, resume=args.resume or args.branch, branch=bool(args.branch)))
+    finally:
+        flush_metrics()
\ No newline at end of file
@@ -0,0 +1,94 @@
+import os
+import hashlib
+from collections import namedtuple
+
+# Reuse the last successful result when a program is executed again and no sandbox file changed (off by default)
+EXEC_SKIP_UNCHANGED = os.getenv("EXEC_SKIP_UNCHANGED", "0").lower() in ("1", "true", "yes")
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+class FileChange(namedtuple("FileChange", ["path", "kind", "sha256"])):
+    """One file an agent command wrote: kind is "added" or "modified"."""
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SandboxManifest:
+    """Content hashes of a sandbox's files, kept current by stat so unchanged files are not re-read."""
+
+    def __init__(self, sandbox_dir):
+        self.sandbox_dir = sandbox_dir
+        self.entries = {}  # relative path -> (inode, size, mtime_ns, sha256)
+        self._results = {}  # executed relative path -> (sandbox fingerprint after the run, ExecutionResult)
+
+    def digest(self, relative):
+        """sha256 of a sandbox file as it is on disk now, or None if it does not exist."""
+        relative = os.path.normpath(relative)
+        try:
+            st = os.stat(os.path.join(self.sandbox_dir, relative))
+        except OSError:
+            self.entries.pop(relative, None)
+            return None
+        cached = self.entries.get(relative)
+        if cached and cached[:3] == (st.st_ino, st.st_size, st.st_mtime_ns):
+            return cached[3]
+        digest = _hash_file(os.path.join(self.sandbox_dir, relative))
+        self.entries[relative] = (st.st_ino, st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    def change(self, relative, content):
+        """The FileChange that writing content would make, or None if the file already holds it."""
+        current = self.digest(relative)
+        try:
+            new = hashlib.sha256(content.encode()).hexdigest()
+        except UnicodeEncodeError:
+            new = None  # Cannot tell what the write would produce; assume it changes the file
+        if current is not None and current == new:
+            return None
+        return FileChange(os.path.normpath(relative), "added" if current is None else "modified", new)
+
+    def fingerprint(self):
+        """Hash of every file in the sandbox (code, data, databases, ...); files unchanged by stat are not re-read."""
+        digest = hashlib.sha256()
+        for root, dir_names, file_names in os.walk(self.sandbox_dir):
+            dir_names[:] = sorted(name for name in dir_names if name not in ("__pycache__", ".git"))
+            for name in sorted(file_names):
+                relative = os.path.relpath(os.path.join(root, name), self.sandbox_dir)
+                digest.update(f"{relative}\0{self.digest(relative)}\n".encode())
+        return digest.hexdigest()
+
+    def previous_result(self, relative):
+        """The last result of executing this file, if no sandbox file changed since that run ended."""
+        if not EXEC_SKIP_UNCHANGED or os.path.normpath(relative) not in self._results:
+            return None
+        fingerprint, result = self._results[os.path.normpath(relative)]
+        return result if fingerprint == self.fingerprint() else None
+
+    def remember_result(self, relative, result):
+        if not result.succeeded:
+            # A failure is what the fix loop is retrying, and timeouts or crashes may be transient: never reuse it
+            self._results.pop(os.path.normpath(relative), None)
+            return
+        self._results[os.path.normpath(relative)] = (self.fingerprint(), result)
+
+
+# One manifest per sandbox directory
+_manifests = {}
+
+
+def manifest_for(sandbox_dir):
+    key = os.path.abspath(sandbox_dir)
+    if key not in _manifests:
+        _manifests[key] = SandboxManifest(sandbox_dir)
+    return _manifests[key]
+
+
+def forget_manifest(sandbox_dir):
+    _manifests.pop(os.path.abspath(sandbox_dir), None)
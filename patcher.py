@@ -0,0 +1,165 @@
+import re
+import difflib
+
+# Minimum similarity for a fuzzy SEARCH match when neither exact nor whitespace-insensitive matching works
+PATCH_FUZZY_THRESHOLD = 0.9
+
+BLOCK_PATTERN = re.compile(
+    r"<<<<<<< SEARCH[ \t]*\n(.*?)^=======[ \t]*\n(.*?)^>>>>>>> REPLACE[ \t]*$",
+    re.DOTALL | re.MULTILINE,
+)
+
+
+class PatchError(ValueError):
+    """Raised when a patch cannot be applied; the message is fed back to the agent."""
+
+
+def parse_blocks(patch_text):
+    """Split a patch into (search, replace) pairs."""
+    blocks = [(m.group(1), m.group(2)) for m in BLOCK_PATTERN.finditer(patch_text)]
+    if not blocks:
+        raise PatchError(
+            "no SEARCH/REPLACE blocks found; use <<<<<<< SEARCH, =======, >>>>>>> REPLACE markers on their own lines"
+        )
+    return blocks
+
+
+def _indent(line):
+    return line[:len(line) - len(line.lstrip())]
+
+
+def _find_lines(lines, search_lines, normalize):
+    """Return start indexes where search_lines match lines after normalizing both."""
+    wanted = [normalize(line) for line in search_lines]
+    first = wanted[0]
+    size = len(wanted)
+    return [
+        i for i in range(len(lines) - size + 1)
+        if normalize(lines[i]) == first and [normalize(line) for line in lines[i:i + size]] == wanted
+    ]
+
+
+def _closest(lines, search_lines):
+    """Return (ratio, start) of the window most similar to the search text."""
+    size = len(search_lines)
+    target = "".join(search_lines)
+    matcher = difflib.SequenceMatcher(autojunk=False)
+    matcher.set_seq2(target)
+    best = (0.0, 0)
+    for i in range(max(len(lines) - size + 1, 1)):
+        matcher.set_seq1("".join(lines[i:i + size]))
+        if matcher.real_quick_ratio() <= best[0] or matcher.quick_ratio() <= best[0]:
+            continue
+        ratio = matcher.ratio()
+        if ratio > best[0]:
+            best = (ratio, i)
+    return best
+
+
+def _indent_map(file_lines, search_lines, number):
+    """Pair each indentation used in the SEARCH text with the matched file lines' indentation."""
+    mapping = {}
+    for file_line, search_line in zip(file_lines, search_lines):
+        if search_line.strip() and mapping.setdefault(_indent(search_line), _indent(file_line)) != _indent(file_line):
+            mapping = None
+            break
+    levels = sorted(mapping or {}, key=len)
+    if mapping is None or any(len(mapping[a]) >= len(mapping[b]) for a, b in zip(levels, levels[1:])):
+        raise PatchError(
+            f"block {number}: SEARCH lines are nested differently from the file; copy the file's indentation exactly"
+        )
+    return mapping
+
+
+def _indent_step(mapping):
+    """(SEARCH step, file step) of one nesting level, or None if the SEARCH text has only one level."""
+    levels = sorted(mapping, key=len)
+    for a, b in zip(levels, levels[1:]):
+        if b.startswith(a) and mapping[b].startswith(mapping[a]):
+            return b[len(a):], mapping[b][len(mapping[a]):]
+    return None
+
+
+def _reindent(replace_lines, mapping, number):
+    """Indent each replacement line the way the file indents the SEARCH line it lines up with.
+
+    A replacement line nested deeper than any SEARCH line keeps its extra indentation,
+    converted to the file's indent unit when the SEARCH text shows it; lines that cannot
+    be placed without mixing tabs and spaces fail the block instead.
+    """
+    if all(search == found for search, found in mapping.items()):
+        return replace_lines
+    levels = sorted(mapping, key=len, reverse=True)
+    step = _indent_step(mapping)
+    shifts = {found[:len(found) - len(search)] if found.endswith(search) else None for search, found in mapping.items()}
+    shift = shifts.pop() if len(shifts) == 1 else None  # Set when the file only adds a common prefix
+    mixed = any(" " in found and "\t" in found for found in mapping.values())
+    adjusted = []
+    for line in replace_lines:
+        indent = _indent(line)
+        if not line.strip():
+            adjusted.append(line)
+            continue
+        base = next((level for level in levels if indent.startswith(level)), None)
+        if base is None:
+            new_indent = None if shift is None else shift + indent
+        else:
+            extra = indent[len(base):]
+            if step and extra and extra == step[0] * (len(extra) // len(step[0])):
+                extra = step[1] * (len(extra) // len(step[0]))
+            new_indent = mapping[base] + extra
+        if new_indent is None or (" " in new_indent and "\t" in new_indent and not mixed):
+            raise PatchError(
+                f"block {number}: cannot match the REPLACE indentation to the file's; copy the file's indentation exactly"
+            )
+        adjusted.append(new_indent + line[len(indent):])
+    return adjusted
+
+
+def apply_block(text, search, replace, number):
+    """Apply one SEARCH/REPLACE block, falling back to progressively fuzzier matching."""
+    if not search.strip():
+        # An empty SEARCH appends to the file
+        return text + ("" if not text or text.endswith("\n") else "\n") + replace
+
+    count = text.count(search)
+    if count == 1:
+        return text.replace(search, replace, 1)
+    if count > 1:
+        raise PatchError(f"block {number}: SEARCH text matches {count} places; include more surrounding lines")
+
+    lines = text.splitlines(keepends=True)
+    search_lines = search.splitlines(keepends=True)
+    replace_lines = replace.splitlines(keepends=True)
+    if replace_lines and not replace_lines[-1].endswith("\n"):
+        replace_lines[-1] += "\n"
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+
+    for normalize in (str.rstrip, str.strip):
+        starts = _find_lines(lines, search_lines, normalize)
+        if len(starts) > 1:
+            raise PatchError(f"block {number}: SEARCH text matches {len(starts)} places; include more surrounding lines")
+        if starts:
+            start = starts[0]
+            mapping = _indent_map(lines[start:start + len(search_lines)], search_lines, number)
+            replace_lines = _reindent(replace_lines, mapping, number)
+            return "".join(lines[:start] + replace_lines + lines[start + len(search_lines):])
+
+    ratio, start = _closest(lines, search_lines)
+    if ratio >= PATCH_FUZZY_THRESHOLD:
+        return "".join(lines[:start] + replace_lines + lines[start + len(search_lines):])
+    snippet = "".join(lines[start:start + len(search_lines)]).rstrip("\n")
+    message = f"block {number}: SEARCH text not found"
+    if snippet:
+        message += (
+            f". Closest match ({ratio:.0%} similar) at lines {start + 1}-{start + len(search_lines)}:\n{snippet}"
+        )
+    raise PatchError(message)
+
+
+def apply_patch(text, patch_text):
+    """Apply every block of a patch in order; the file is only changed if all blocks apply."""
+    for number, (search, replace) in enumerate(parse_blocks(patch_text), start=1):
+        text = apply_block(text, search, replace, number)
+    return text
@@ -0,0 +1,16 @@
+import os
+from venv_pool import venv_pool, read_requirements
+
+# Start installing dependencies as soon as a turn writes requirements.txt (set to 0 to wait for <exec>)
+VENV_PREWARM = os.getenv("VENV_PREWARM", "1").lower() in ("1", "true", "yes")
+
+
+def prewarm_dependencies(file_path, sandbox_dir):
+    """Start installing a sandbox's requirements.txt in the background after it was written.
+
+    Only the declared requirements are installed: guessing distributions from import lines
+    would install whatever PyPI package happens to share a name with a local module.
+    """
+    if not VENV_PREWARM or os.path.normpath(file_path) != "requirements.txt":
+        return None
+    return venv_pool.prewarm(read_requirements(os.path.join(sandbox_dir, "requirements.txt")))
@@ -0,0 +1,28 @@
+"""Apply resource limits to this process, then exec the program (standard library only).
+
+The executor starts programs through this script rather than with a preexec_fn, which
+is not safe in a child forked from a threaded parent; the limits survive the exec.
+
+Usage: python rlimit_exec.py LIMITS_JSON PROGRAM [ARG ...]
+"""
+import os
+import sys
+import json
+
+
+def main():
+    limits, argv = json.loads(sys.argv[1]), sys.argv[2:]
+    try:
+        import resource
+        for kind, value in limits:
+            try:
+                resource.setrlimit(kind, (value, value))
+            except (ValueError, OSError):
+                pass  # Not supported on this platform, or above the hard limit
+    except ImportError:
+        pass
+    os.execv(argv[0], argv)
+
+
+if __name__ == "__main__":
+    main()
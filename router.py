@@ -0,0 +1,266 @@
+"""Routing for OpenAI-compatible providers over a pool of endpoints.
+
+A provider's pool comes from <PROVIDER>_ENDPOINTS, a comma-separated list of URLs, each
+optionally followed by "|model" (for example OLLAMA_ENDPOINTS="http://box1:11434/v1/chat/completions,
+http://box2:11434/v1/chat/completions|qwen2.5-coder:7b"); without it the pool is the provider's
+single configured URL. Requests go to the healthy endpoint with the lowest expected latency
+(latency EWMA times requests in flight), transient failures are retried on another endpoint with
+jittered exponential backoff, and with LLM_HEDGE_SECONDS set a second endpoint is raced against
+a request that has not answered in time. Endpoints that keep failing are taken out of rotation
+for a cooldown, after which a single request probes them again.
+"""
+import os
+import time
+import random
+import asyncio
+import httpx
+from agent import Provider
+from telemetry import span, metrics
+
+# Retries after the first attempt, for transport errors, timeouts, 429 and 5xx
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+LLM_RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", "8"))
+# Race a second endpoint against a request still unanswered after this long (0 disables hedging)
+LLM_HEDGE_SECONDS = float(os.getenv("LLM_HEDGE_SECONDS", "0"))
+# Consecutive failures that take an endpoint out of rotation, and for how long
+LLM_ENDPOINT_FAILURES = int(os.getenv("LLM_ENDPOINT_FAILURES", "3"))
+LLM_ENDPOINT_COOLDOWN_SECONDS = float(os.getenv("LLM_ENDPOINT_COOLDOWN_SECONDS", "30"))
+
+LATENCY_EWMA_ALPHA = 0.3
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+def parse_endpoints(spec, default_model):
+    """Parse "url[|model],url[|model]" into (url, model) pairs."""
+    endpoints = []
+    for entry in spec.split(","):
+        url, _, model = entry.strip().partition("|")
+        if url:
+            endpoints.append((url.strip(), model.strip() or default_model))
+    return endpoints
+
+
+def is_retryable(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS
+    # Connection and read errors, timeouts, and truncated or garbled response bodies
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError, ValueError))
+
+
+def _describe(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"HTTP {error.response.status_code}: {error.response.text[:500]}"
+    return f"{type(error).__name__}: {error}"
+
+
+def backoff_delay(attempt, error=None):
+    """Full-jitter exponential backoff, stretched to honor a numeric Retry-After header."""
+    delay = random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** (attempt - 1)))
+    if isinstance(error, httpx.HTTPStatusError):
+        try:
+            delay = max(delay, min(LLM_RETRY_MAX_SECONDS, float(error.response.headers.get("Retry-After", ""))))
+        except ValueError:
+            pass
+    return delay
+
+
+class Endpoint:
+    """One URL/model of a provider's pool, with its health and latency record."""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.latency = None  # EWMA of request seconds; None until the first success
+        self.in_flight = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.probing = False
+
+    @property
+    def label(self):
+        return f"{self.provider.url} ({self.provider.model})"
+
+    def healthy(self, now):
+        if self.failures < LLM_ENDPOINT_FAILURES:
+            return True
+        # Out of rotation until the cooldown ends, then one request at a time probes it
+        return now >= self.down_until and not self.probing
+
+    def score(self):
+        if self.latency is None:
+            return 0.0  # Unmeasured endpoints are tried first so every box gets a latency estimate
+        return self.latency * (self.in_flight + 1)
+
+    def observe(self, seconds):
+        self.latency = seconds if self.latency is None else (
+            LATENCY_EWMA_ALPHA * seconds + (1 - LATENCY_EWMA_ALPHA) * self.latency
+        )
+
+    def succeeded(self, seconds):
+        self.observe(seconds)
+        self.failures = 0
+        metrics.observe("agent_llm_endpoint_seconds", seconds, help="LLM request latency per endpoint",
+                        endpoint=self.provider.url)
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= LLM_ENDPOINT_FAILURES:
+            if self.failures == LLM_ENDPOINT_FAILURES:
+                print(f"[INFO] Taking {self.label} out of rotation for {LLM_ENDPOINT_COOLDOWN_SECONDS:g}s")
+            self.down_until = time.monotonic() + LLM_ENDPOINT_COOLDOWN_SECONDS
+        metrics.inc("agent_llm_endpoint_failures_total", help="Failed LLM requests per endpoint",
+                    endpoint=self.provider.url)
+
+
+class EndpointRouter(Provider):
+    """Provider that spreads one OpenAI-compatible provider's requests over a pool of endpoints."""
+
+    def __init__(self, endpoints):
+        primary = endpoints[0]
+        self.name = primary.name
+        self.model = "+".join(dict.fromkeys(endpoint.model for endpoint in endpoints))
+        self.context_window = min(endpoint.context_window for endpoint in endpoints)
+        self.endpoints = [Endpoint(endpoint) for endpoint in endpoints]
+
+    @classmethod
+    def for_provider(cls, provider):
+        """Route a provider over <NAME>_ENDPOINTS, or over its own URL when that is not set."""
+        spec = os.getenv(f"{provider.name.upper()}_ENDPOINTS")
+        endpoints = parse_endpoints(spec, provider.model) if spec else []
+        if not endpoints:
+            return cls([provider])
+        return cls([provider.at(url, model) for url, model in endpoints])
+
+    def count_tokens(self, text):
+        return self.endpoints[0].provider.count_tokens(text)
+
+    def select(self, exclude=(), healthy_only=False):
+        """The endpoint with the lowest expected latency; unhealthy ones only if nothing else is left."""
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        healthy = [endpoint for endpoint in candidates if endpoint.healthy(now)]
+        if healthy_only or healthy:
+            candidates = healthy
+        if not candidates:
+            return None
+        return min(candidates, key=lambda endpoint: (endpoint.score(), endpoint.down_until, random.random()))
+
+    async def _attempt(self, endpoint, messages, max_tokens):
+        probing = endpoint.failures >= LLM_ENDPOINT_FAILURES
+        endpoint.probing = endpoint.probing or probing
+        endpoint.in_flight += 1
+        start = time.monotonic()
+        try:
+            with span("llm.attempt", endpoint=endpoint.provider.url, model=endpoint.provider.model):
+                chat_data = await endpoint.provider.request(messages, max_tokens)
+        except asyncio.CancelledError:
+            # Lost a hedge race: no verdict on its health, but it was at least this slow
+            elapsed = time.monotonic() - start
+            if endpoint.latency is None or elapsed > endpoint.latency:
+                endpoint.observe(elapsed)
+            raise
+        except Exception as error:
+            if is_retryable(error):
+                endpoint.failed()
+            raise
+        else:
+            endpoint.succeeded(time.monotonic() - start)
+            return chat_data
+        finally:
+            endpoint.in_flight -= 1
+            if probing:
+                endpoint.probing = False
+
+    async def _hedged(self, messages, max_tokens, tried):
+        """Send to the best untried endpoint, racing another one each time LLM_HEDGE_SECONDS pass unanswered."""
+        endpoint = self.select(tried)
+        tried.add(endpoint)
+        pending = {asyncio.ensure_future(self._attempt(endpoint, messages, max_tokens))}
+        hedge = LLM_HEDGE_SECONDS > 0
+        try:
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=LLM_HEDGE_SECONDS if hedge else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    backup = self.select(tried, healthy_only=True)
+                    if backup is None:
+                        hedge = False
+                        continue
+                    tried.add(backup)
+                    pending.add(asyncio.ensure_future(self._attempt(backup, messages, max_tokens)))
+                    metrics.inc("agent_llm_hedged_total", help="Requests raced on another endpoint", provider=self.name)
+                    continue
+                errors = [task.exception() for task in done]
+                for task, task_error in zip(done, errors):
+                    if task_error is None:
+                        return task.result()
+                for error in errors:
+                    if not is_retryable(error):
+                        raise error
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def request(self, messages, max_tokens):
+        """Return the chat completion dict, retrying across endpoints; raises the last error."""
+        tried = set()
+        for attempt in range(LLM_RETRIES + 1):
+            if len(tried) >= len(self.endpoints):
+                tried = set()  # Every endpoint has had a go: start another round
+            try:
+                return await self._hedged(messages, max_tokens, tried)
+            except Exception as error:
+                if attempt == LLM_RETRIES or not is_retryable(error):
+                    raise
+                delay = backoff_delay(attempt + 1, error)
+                print(f"[INFO] {self.name} request failed ({_describe(error)}); retrying in {delay:.1f}s")
+                metrics.inc("agent_llm_retries_total", help="LLM requests retried after a transient failure",
+                            provider=self.name)
+                await asyncio.sleep(delay)
+
+    async def send(self, messages, max_tokens):
+        try:
+            return await self.request(messages, max_tokens)
+        except Exception as error:
+            print(f"[ERROR] {self.name} error: {_describe(error)}")
+            return None
+
+    async def stream(self, messages, max_tokens):
+        """Stream from the best endpoint; failures before the first chunk are retried elsewhere."""
+        tried = set()
+        for attempt in range(LLM_RETRIES + 1):
+            if len(tried) >= len(self.endpoints):
+                tried = set()
+            endpoint = self.select(tried)
+            tried.add(endpoint)
+            started = False
+            endpoint.in_flight += 1
+            start = time.monotonic()
+            try:
+                async for text in endpoint.provider.stream(messages, max_tokens):
+                    started = True
+                    yield text
+            except Exception as error:
+                if is_retryable(error):
+                    endpoint.failed()
+                if started or attempt == LLM_RETRIES or not is_retryable(error):
+                    raise
+                delay = backoff_delay(attempt + 1, error)
+                print(f"[INFO] {self.name} stream failed ({_describe(error)}); retrying in {delay:.1f}s")
+                metrics.inc("agent_llm_retries_total", help="LLM requests retried after a transient failure",
+                            provider=self.name)
+                await asyncio.sleep(delay)
+            else:
+                endpoint.succeeded(time.monotonic() - start)
+                return
+            finally:
+                endpoint.in_flight -= 1
+
+    async def aclose(self):
+        for endpoint in self.endpoints:
+            await endpoint.provider.aclose()
@@ -0,0 +1,347 @@
+"""Multi-session server: many concurrent agent sessions in one process, driven over HTTP.
+
+Each session owns its agents, sandbox and event queue. Agent responses, <rinf> questions
+and status changes are delivered as events over Server-Sent Events or a WebSocket; the
+client answers questions and sends follow-up requests as messages.
+
+    POST   /sessions                 {"prompt": "...", "provider": "openai", "agents": [...]} -> {"id": ...}
+                                     or {"resume": "<checkpoint>"} / {"branch": "<checkpoint>"}
+    GET    /sessions/{id}            session status
+    POST   /sessions/{id}/messages   {"text": "..."}: answers a pending question, otherwise queues a new request
+    GET    /sessions/{id}/events     text/event-stream of events
+    GET    /sessions/{id}/ws         WebSocket: events out, {"text": "..."} messages in
+    DELETE /sessions/{id}            stop the session
+    GET    /metrics                  Prometheus metrics for every session in the process
+
+Usage: python server.py [--host 127.0.0.1] [--port 8080] [--provider openai] [--metrics metrics.prom]
+"""
+import os
+import json
+import uuid
+import shutil
+import asyncio
+import argparse
+import contextlib
+from aiohttp import web, WSMsgType
+from main import create_agents, chain_agents, fix_execution_errors
+from file_manager import create_sandbox, release_sandbox
+from agent import close_providers
+from checkpoint import checkpoint_store, parse_checkpoint_id, CHECKPOINT_ENABLED
+from telemetry import metrics, configure_telemetry, flush_metrics, METRICS_PORT
+
+SERVER_MAX_SESSIONS = int(os.getenv("SERVER_MAX_SESSIONS", "32"))
+SERVER_SANDBOX_ROOT = os.getenv("SERVER_SANDBOX_ROOT", ".")
+# Per-session quotas
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "50"))
+SESSION_MAX_SANDBOX_BYTES = int(os.getenv("SESSION_MAX_SANDBOX_BYTES", str(1024 ** 3)))
+SESSION_MAX_PENDING_MESSAGES = int(os.getenv("SESSION_MAX_PENDING_MESSAGES", "8"))
+# Events buffered for a slow or absent client before the session pauses
+SESSION_EVENT_BUFFER = int(os.getenv("SESSION_EVENT_BUFFER", "256"))
+SESSION_ANSWER_TIMEOUT = float(os.getenv("SESSION_ANSWER_TIMEOUT", "1800"))
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "3600"))
+SESSION_MAX_RETRIES = int(os.getenv("SESSION_MAX_RETRIES", "3"))
+# How long a finished session stays queryable (status, remaining events) before it is dropped
+SESSION_RETENTION_SECONDS = float(os.getenv("SESSION_RETENTION_SECONDS", "300"))
+
+
+class QuotaExceeded(Exception):
+    """Raised inside a session when it uses up one of its quotas."""
+
+
+async def _json_object(request):
+    """The request body as a JSON object; anything else is the client's error (400), not the server's."""
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="request body must be JSON")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="request body must be a JSON object")
+    return body
+
+
+def _sandbox_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Session:
+    """One user's agent chain, sandbox and queues."""
+
+    def __init__(self, session_id, provider, agent_keys):
+        self.id = session_id
+        self.provider = provider
+        self.agent_keys = agent_keys
+        self.sandbox_dir = None
+        self.agents = None
+        self.state = "starting"
+        self.turns = 0
+        self.error = None
+        self.events = asyncio.Queue(maxsize=SESSION_EVENT_BUFFER)  # Bounded: a slow client pauses the session
+        self.inputs = asyncio.Queue(maxsize=SESSION_MAX_PENDING_MESSAGES)
+        self.answer = None  # Future for the <rinf> question currently waiting on the client
+        self.task = None
+
+    def status(self):
+        return {
+            "id": self.id, "state": self.state, "provider": self.provider, "agents": self.agent_keys,
+            "sandbox": self.sandbox_dir, "turns": self.turns, "error": self.error,
+            "pending_messages": self.inputs.qsize(), "buffered_events": self.events.qsize(),
+        }
+
+    async def emit(self, event_type, **data):
+        await self.events.put(dict(data, type=event_type))
+
+    def notify(self, event_type, **data):
+        """Queue a final event without waiting; dropped if no client has drained the buffer."""
+        with contextlib.suppress(asyncio.QueueFull):
+            self.events.put_nowait(dict(data, type=event_type))
+
+    async def set_state(self, state):
+        self.state = state
+        await self.emit("status", state=state)
+
+    def deliver(self, text):
+        """Route a client message: answer the pending question, or queue it as the next request."""
+        if self.answer is not None and not self.answer.done():
+            self.answer.set_result(text)
+            return "answer"
+        self.inputs.put_nowait(text)  # QueueFull is reported to the client as 429
+        return "queued"
+
+    async def ask(self, agent, prompt):
+        """ask_user callback: forward a <rinf> question to the client and wait for its answer."""
+        self.answer = asyncio.get_running_loop().create_future()
+        await self.set_state("waiting")
+        await self.emit("question", agent=agent.key, prompt=prompt)
+        try:
+            return await asyncio.wait_for(self.answer, SESSION_ANSWER_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.answer = None
+            self.state = "working"
+
+    async def on_response(self, agent, response):
+        self.turns += 1
+        await self.emit("response", agent=agent.key, content=response)
+        if CHECKPOINT_ENABLED:
+            checkpoint_id = await asyncio.to_thread(checkpoint_store.save, self.id, self.agents, self.sandbox_dir)
+            await self.emit("checkpoint", id=checkpoint_id)
+        if self.turns >= SESSION_MAX_TURNS:
+            raise QuotaExceeded(f"turn quota of {SESSION_MAX_TURNS} reached")
+        if await asyncio.to_thread(_sandbox_bytes, self.sandbox_dir) > SESSION_MAX_SANDBOX_BYTES:
+            raise QuotaExceeded(f"sandbox exceeds {SESSION_MAX_SANDBOX_BYTES} bytes")
+
+    async def fix(self):
+        retries = await fix_execution_errors(self.agents[-1], SESSION_MAX_RETRIES, self.ask, self.on_response)
+        if retries is not None:
+            await self.emit("fixed", retries=retries)
+
+    async def run(self, prompt):
+        """Run the agent chain on the prompt, then serve follow-up requests; a resumed session starts idle."""
+        try:
+            if self.agents is None:
+                self.sandbox_dir = await create_sandbox(label=self.id, root=SERVER_SANDBOX_ROOT)
+                self.agents = create_agents(self.agent_keys, self.provider, self.sandbox_dir)
+                if self.agents is None:
+                    raise ValueError(f"unknown agent key in {self.agent_keys}")
+            if prompt:
+                await self.set_state("working")
+                if await chain_agents(self.agents, prompt, self.ask, self.on_response) is not None:
+                    await self.fix()
+            while True:
+                await self.set_state("idle")
+                try:
+                    text = await asyncio.wait_for(self.inputs.get(), SESSION_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                await self.set_state("working")
+                if await chain_agents(self.agents[-1:], text, self.ask, self.on_response) is not None:
+                    await self.fix()
+            self.state = "closed"
+            self.notify("status", state="closed")
+        except asyncio.CancelledError:
+            self.state = "closed"
+            raise
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self.state = "failed"
+            self.notify("error", message=self.error)
+
+
+class SessionServer:
+    def __init__(self, provider="openai", agent_keys=("product_designer", "software_engineer")):
+        self.provider = provider
+        self.agent_keys = list(agent_keys)
+        self.sessions = {}
+
+    def session(self, request):
+        session = self.sessions.get(request.match_info["session_id"])
+        if session is None:
+            raise web.HTTPNotFound(text="unknown session")
+        return session
+
+    async def create(self, request):
+        active = sum(1 for session in self.sessions.values() if not session.task.done())
+        if active >= SERVER_MAX_SESSIONS:
+            raise web.HTTPServiceUnavailable(text="too many active sessions", headers={"Retry-After": "30"})
+        body = await _json_object(request)
+        restore = body.get("resume") or body.get("branch")
+        if restore and not isinstance(restore, str):
+            raise web.HTTPBadRequest(text="resume and branch take a checkpoint id string")
+        if restore:
+            session = await self.restore(restore, branch=bool(body.get("branch")))
+        elif body.get("prompt"):
+            session = Session(uuid.uuid4().hex[:12], body.get("provider") or self.provider,
+                              body.get("agents") or self.agent_keys)
+        else:
+            raise web.HTTPBadRequest(text="prompt, resume or branch is required")
+        session.task = asyncio.create_task(session.run(body.get("prompt")))
+        session.task.add_done_callback(lambda _: self.finished(session))
+        self.sessions[session.id] = session
+        return web.json_response(session.status(), status=201)
+
+    def finished(self, session):
+        flush_metrics()
+        asyncio.get_running_loop().call_later(SESSION_RETENTION_SECONDS, self.prune, session)
+
+    def prune(self, session):
+        """Drop a finished session and the per-sandbox state kept for it; its sandbox stays on disk."""
+        if self.sessions.get(session.id) is session:
+            del self.sessions[session.id]
+        if session.sandbox_dir:
+            release_sandbox(session.sandbox_dir)
+
+    async def restore(self, checkpoint_id, branch):
+        """Rebuild a session from a checkpoint into a fresh sandbox."""
+        try:
+            session_id, _ = parse_checkpoint_id(checkpoint_id)
+        except ValueError as e:
+            raise web.HTTPNotFound(text=f"cannot restore {checkpoint_id}: {e}")
+        existing = self.sessions.get(session_id)
+        if not branch and existing is not None and not existing.task.done():
+            raise web.HTTPConflict(text="session is still running; branch it instead")
+        sandbox_dir = await create_sandbox(label="resumed", root=SERVER_SANDBOX_ROOT)
+        try:
+            session_id, agents = await asyncio.to_thread(checkpoint_store.resume, checkpoint_id, sandbox_dir, branch)
+        except (OSError, ValueError) as e:
+            # Nothing will run in the sandbox: remove it rather than leave an empty resumed_* directory
+            release_sandbox(sandbox_dir)
+            await asyncio.to_thread(shutil.rmtree, sandbox_dir, True)
+            raise web.HTTPNotFound(text=f"cannot restore {checkpoint_id}: {e}")
+        session = Session(session_id, agents[0].provider, [agent.key for agent in agents])
+        session.sandbox_dir, session.agents = sandbox_dir, agents
+        return session
+
+    async def status(self, request):
+        return web.json_response(self.session(request).status())
+
+    async def message(self, request):
+        session = self.session(request)
+        body = await _json_object(request)
+        if not isinstance(body.get("text"), str) or not body["text"]:
+            raise web.HTTPBadRequest(text="text is required")
+        try:
+            routed = session.deliver(body["text"])
+        except asyncio.QueueFull:
+            raise web.HTTPTooManyRequests(text="too many pending messages")
+        return web.json_response({"routed": routed}, status=202)
+
+    async def events(self, request):
+        session = self.session(request)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        while not (session.task.done() and session.events.empty()):
+            try:
+                event = await asyncio.wait_for(session.events.get(), 15)
+            except asyncio.TimeoutError:
+                await response.write(b": keep-alive\n\n")
+                continue
+            await response.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+        return response
+
+    async def websocket(self, request):
+        session = self.session(request)
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        async def send_events():
+            while not (session.task.done() and session.events.empty()):
+                await ws.send_json(await session.events.get())
+            await ws.close()
+
+        sender = asyncio.create_task(send_events())
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    routed = session.deliver(json.loads(message.data).get("text") or "")
+                    await ws.send_json({"type": "ack", "routed": routed})
+                except asyncio.QueueFull:
+                    await ws.send_json({"type": "rejected", "reason": "too many pending messages"})
+                except (ValueError, AttributeError):
+                    await ws.send_json({"type": "rejected", "reason": "expected {\"text\": ...}"})
+        finally:
+            sender.cancel()
+        return ws
+
+    async def delete(self, request):
+        session = self.sessions.pop(request.match_info["session_id"], None)
+        if session is None:
+            raise web.HTTPNotFound(text="unknown session")
+        session.task.cancel()
+        if session.sandbox_dir:
+            release_sandbox(session.sandbox_dir)
+        return web.json_response({"id": session.id, "state": "closed"})
+
+    async def metrics(self, request):
+        return web.Response(body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4"})
+
+    async def shutdown(self, app):
+        for session in self.sessions.values():
+            session.task.cancel()
+        await asyncio.gather(*(session.task for session in self.sessions.values()), return_exceptions=True)
+        await close_providers()
+        flush_metrics()
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([
+            web.post("/sessions", self.create),
+            web.get("/sessions/{session_id}", self.status),
+            web.post("/sessions/{session_id}/messages", self.message),
+            web.get("/sessions/{session_id}/events", self.events),
+            web.get("/sessions/{session_id}/ws", self.websocket),
+            web.delete("/sessions/{session_id}", self.delete),
+            web.get("/metrics", self.metrics),
+        ])
+        app.on_cleanup.append(self.shutdown)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--provider", default="openai")
+    parser.add_argument("--agents", nargs="+", default=["product_designer", "software_engineer"])
+    parser.add_argument("--trace", help="append a JSONL span trace to this file")
+    parser.add_argument("--metrics", help="write Prometheus metrics to this file when a session ends")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="also serve /metrics on this port (it is always served on --port)")
+    parser.add_argument("--profile-dir", help="dump a cProfile of every agent turn here")
+    args = parser.parse_args()
+    configure_telemetry(trace_path=args.trace, metrics_path=args.metrics, metrics_port=args.metrics_port,
+                        profile_dir=args.profile_dir)
+    web.run_app(SessionServer(args.provider, args.agents).app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
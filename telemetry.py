@@ -0,0 +1,276 @@
+"""Spans and metrics for the agent pipeline.
+
+Wrap a phase in `with span("name", attr=value):` to time it. Finished spans are
+appended to a JSONL trace (TRACE_PATH) and folded into Prometheus metrics, which
+can be written to a file (METRICS_PATH) or served over HTTP (METRICS_PORT).
+PROFILE_DIR enables a cProfile dump per agent turn.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+
+TRACE_PATH = os.getenv("TRACE_PATH")
+METRICS_PATH = os.getenv("METRICS_PATH")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+
+# Upper bounds (seconds) of the span duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """Thread-safe counters and histograms rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.help = {}
+
+    def inc(self, name, value=1, help=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            if help:
+                self.help.setdefault(name, help)
+
+    def observe(self, name, value, help=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+            if help:
+                self.help.setdefault(name, help)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            described = set()
+
+            def describe(name, kind):
+                if name not in described:
+                    described.add(name)
+                    if name in self.help:
+                        lines.append(f"# HELP {name} {self.help[name]}")
+                    lines.append(f"# TYPE {name} {kind}")
+
+            for (name, labels), value in counters:
+                describe(name, "counter")
+                lines.append(f"{name}{_labels(dict(labels))} {value}")
+            for (name, labels), series in histograms:
+                describe(name, "histogram")
+                labels = dict(labels)
+                for bound, count in zip(DURATION_BUCKETS, series):
+                    lines.append(f"{name}_bucket{_labels(dict(labels, le=bound))} {count}")
+                lines.append(f"{name}_bucket{_labels(dict(labels, le='+Inf'))} {series[-1]}")
+                lines.append(f"{name}_sum{_labels(labels)} {series[-2]}")
+                lines.append(f"{name}_count{_labels(labels)} {series[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Atomically replace a metrics file (e.g. for the node exporter textfile collector)."""
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+
+metrics = Metrics()
+
+
+class TraceWriter:
+    """Appends finished spans to a JSONL file, one object per line."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", buffering=1)
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_trace = TraceWriter(TRACE_PATH) if TRACE_PATH else None
+
+
+def configure_telemetry(trace_path=None, metrics_path=None, metrics_port=None, profile_dir=None):
+    """Override the environment configuration (e.g. from a command-line flag)."""
+    global _trace, METRICS_PATH, PROFILE_DIR
+    if trace_path is not None:
+        if _trace is not None:
+            _trace.close()
+        _trace = TraceWriter(trace_path) if trace_path else None
+    if metrics_path is not None:
+        METRICS_PATH = metrics_path or None
+    if profile_dir is not None:
+        PROFILE_DIR = profile_dir or None
+    if metrics_port:
+        serve_metrics(metrics_port)
+
+
+class Span:
+    """One timed phase. Attributes can be added while it runs with set()."""
+
+    def __init__(self, name, **attrs):
+        parent = _current_span.get()
+        self.name = name
+        self.attrs = attrs
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.span_id = uuid.uuid4().hex[:16]
+        self.start_time = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, error=None):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.started
+        metrics.observe("agent_span_duration_seconds", self.duration,
+                        help="Wall-clock time spent in each pipeline phase", span=self.name)
+        if error is not None:
+            metrics.inc("agent_span_errors_total", help="Pipeline phases that raised", span=self.name)
+        if _trace is not None:
+            record = {
+                "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+                "name": self.name, "start": self.start_time, "duration": self.duration, "attrs": self.attrs,
+            }
+            if error is not None:
+                record["error"] = f"{type(error).__name__}: {error}"
+            _trace.write(record)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time the enclosed block as a child of the current span; usable in sync and async code."""
+    current = Span(name, **attrs)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.finish(error=e)
+        raise
+    else:
+        current.finish()
+    finally:
+        _current_span.reset(token)
+
+
+def count_tokens(provider, prompt_tokens, completion_tokens):
+    metrics.inc("agent_llm_tokens_total", prompt_tokens, help="Tokens sent to and received from LLM providers",
+                provider=provider, kind="prompt")
+    metrics.inc("agent_llm_tokens_total", completion_tokens, provider=provider, kind="completion")
+
+
+_turns_lock = threading.Lock()
+_active_turns = 0
+_overlapped = False  # Set when a turn starts while the profiled one is still running
+
+
+@contextmanager
+def profile_turn(label):
+    """cProfile the enclosed block into PROFILE_DIR/<label>-<timestamp>.prof when PROFILE_DIR is set.
+
+    cProfile sees every coroutine the thread runs, so a turn is only profiled when no
+    other turn is active, and its profile is discarded if another turn starts before it ends.
+    """
+    global _active_turns, _overlapped
+    with _turns_lock:
+        _active_turns += 1
+        profiled = bool(PROFILE_DIR) and _active_turns == 1
+        _overlapped = not profiled
+    try:
+        if not profiled:
+            yield
+            return
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if _overlapped:
+                print(f"[INFO] Discarded the {label} profile: other turns ran while it was recorded")
+            else:
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                stamp = time.strftime("%Y%m%d_%H%M%S")
+                profiler.dump_stats(os.path.join(PROFILE_DIR, f"{label}-{stamp}-{uuid.uuid4().hex[:6]}.prof"))
+    finally:
+        with _turns_lock:
+            _active_turns -= 1
+
+
+def flush_metrics():
+    """Write the metrics file, if one is configured."""
+    if METRICS_PATH:
+        metrics.write(METRICS_PATH)
+
+
+_server = None
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    """Serve /metrics on a background thread; calling it again is a no-op."""
+    global _server
+    if _server is not None:
+        return _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    _server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    print(f"[INFO] Serving metrics on http://{host}:{port}/metrics")
+    return _server
@@ -0,0 +1,82 @@
+import random
+import pytest
+from commands import CommandTokenizer, Command, parse_commands
+
+RESPONSE = (
+    "Let me set things up.\n"
+    "<cfol>app</cfol>\n"
+    '<efil file="app/main.py">\nprint("a < b </efil")\n</efil>\n'
+    "Some prose with a stray < sign and <unknown> tag.\n"
+    '<pfil file="app/main.py">\n<<<<<<< SEARCH\nprint(1)\n=======\nprint(2)\n>>>>>>> REPLACE\n</pfil>\n'
+    "<exec>app/main.py</exec>\n"
+)
+
+
+def feed_in_chunks(text, sizes):
+    tokenizer = CommandTokenizer()
+    commands, position = [], 0
+    for size in sizes:
+        commands.extend(tokenizer.feed(text[position:position + size]))
+        position += size
+    commands.extend(tokenizer.feed(text[position:]))
+    commands.extend(tokenizer.close())
+    return commands
+
+
+def test_parses_commands_in_document_order():
+    commands = parse_commands(RESPONSE)
+    assert [command.name for command in commands] == ["cfol", "efil", "pfil", "exec"]
+    assert commands[0] == Command("cfol", None, "app", RESPONSE.index("<cfol>"), RESPONSE.index("\n<efil"))
+    assert commands[1].attr == "app/main.py"
+    assert commands[1].body == '\nprint("a < b </efil")\n'
+    assert commands[3].body == "app/main.py"
+    for command in commands:
+        assert RESPONSE[command.start:command.end].startswith(f"<{command.name}")
+        assert RESPONSE[command.start:command.end].endswith(f"</{command.name}>")
+
+
+def test_line_command_must_close_on_its_line():
+    assert parse_commands("<exec>main.py\n</exec> <cfil>a.py</cfil>") == [
+        Command("cfil", None, "a.py", 22, 39)
+    ]
+
+
+def test_unterminated_command_is_dropped():
+    assert parse_commands('<exec>a.py</exec><efil file="b.py">\nno closer') == [
+        Command("exec", None, "a.py", 0, 17)
+    ]
+
+
+def test_empty_input():
+    assert parse_commands("") == []
+    assert parse_commands(None) == []
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16])
+def test_fixed_size_chunks_match_whole_text(size):
+    assert feed_in_chunks(RESPONSE, [size] * (len(RESPONSE) // size)) == parse_commands(RESPONSE)
+
+
+def test_random_chunks_match_whole_text():
+    rng = random.Random(1234)
+    expected = parse_commands(RESPONSE * 3)
+    for _ in range(200):
+        sizes = [rng.randint(0, 12) for _ in range(60)]
+        assert feed_in_chunks(RESPONSE * 3, sizes) == expected
+
+
+def test_commands_are_returned_as_soon_as_they_close():
+    tokenizer = CommandTokenizer()
+    assert tokenizer.feed('<efil file="a.py">\nx = 1\n</ef') == []
+    assert tokenizer.feed("il>\n<exec>a") == [Command("efil", "a.py", "\nx = 1\n", 0, 32)]
+    assert tokenizer.feed(".py</exec>") == [Command("exec", None, "a.py", 33, 50)]
+    assert tokenizer.close() == []
+
+
+def test_large_body_in_small_chunks():
+    body = "x = 1  # padding\n" * 20000
+    text = f'<efil file="big.py">{body}</efil><exec>big.py</exec>'
+    commands = feed_in_chunks(text, [4] * (len(text) // 4))
+    assert [(command.name, command.attr) for command in commands] == [("efil", "big.py"), ("exec", None)]
+    assert commands[0].body == body
+    assert commands[1].start == text.index("<exec>")
@@ -0,0 +1,79 @@
+import pytest
+from patcher import apply_patch, PatchError
+
+
+def block(search, replace):
+    return f"<<<<<<< SEARCH\n{search}=======\n{replace}>>>>>>> REPLACE\n"
+
+
+def test_exact_match():
+    text = "a = 1\nb = 2\n"
+    assert apply_patch(text, block("b = 2\n", "b = 3\n")) == "a = 1\nb = 3\n"
+
+
+def test_blocks_apply_in_order():
+    text = "a = 1\nb = 2\n"
+    patch = block("a = 1\n", "a = 10\n") + block("a = 10\nb = 2\n", "a = 10\nb = 20\n")
+    assert apply_patch(text, patch) == "a = 10\nb = 20\n"
+
+
+def test_empty_search_appends():
+    assert apply_patch("a = 1", block("", "b = 2\n")) == "a = 1\nb = 2\n"
+
+
+def test_ambiguous_search_fails():
+    with pytest.raises(PatchError, match="matches 2 places"):
+        apply_patch("x = 1\nx = 1\n", block("x = 1\n", "x = 2\n"))
+
+
+def test_missing_blocks_fail():
+    with pytest.raises(PatchError, match="no SEARCH/REPLACE blocks"):
+        apply_patch("x = 1\n", "x = 2\n")
+
+
+def test_not_found_reports_closest_match():
+    with pytest.raises(PatchError, match="Closest match"):
+        apply_patch("def f():\n    return 1\n", block("class Unrelated:\n    pass\n", "pass\n"))
+
+
+def test_trailing_whitespace_is_ignored():
+    text = "def f():   \n    return 1\n"
+    assert apply_patch(text, block("def f():\n    return 1\n", "def f():\n    return 2\n")) == (
+        "def f():\n    return 2\n"
+    )
+
+
+def test_shifted_search_is_reindented():
+    text = "class A:\n    def f(self):\n        return 1\n"
+    patch = block("def f(self):\n    return 1\n", "def f(self):\n    if self:\n        return 2\n    return 1\n")
+    assert apply_patch(text, patch) == (
+        "class A:\n    def f(self):\n        if self:\n            return 2\n        return 1\n"
+    )
+
+
+def test_tabs_file_with_space_indented_search():
+    text = "def f():\n\tif x:\n\t\treturn 1\n\treturn 0\n"
+    patch = block(
+        "    if x:\n        return 1\n",
+        "    if x:\n        y = 2\n        if y:\n            return y\n",
+    )
+    assert apply_patch(text, patch) == "def f():\n\tif x:\n\t\ty = 2\n\t\tif y:\n\t\t\treturn y\n\treturn 0\n"
+
+
+def test_each_line_follows_its_own_file_indentation():
+    # Only the first line's offset differs from the file; the others must not be shifted with it
+    text = "def f():\n        a = 1\n    b = 2\n"
+    patch = block("    a = 1\nb = 2\n", "    a = 10\nb = 20\n")
+    assert apply_patch(text, patch) == "def f():\n        a = 10\n    b = 20\n"
+
+
+def test_different_nesting_fails():
+    text = "def f():\n    a = 1\n    b = 2\n"
+    with pytest.raises(PatchError, match="nested differently"):
+        apply_patch(text, block("  a = 1\n      b = 2\n", "  a = 1\n      b = 3\n"))
+
+
+def test_unplaceable_replacement_indent_fails():
+    text = "def f():\n\treturn 1\n"
+    with pytest.raises(PatchError, match="REPLACE indentation"):
+        apply_patch(text, block("    return 1\n", "    if x:\n      return 2\n    return 1\n"))
@@ -0,0 +1,366 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import contextlib
+from telemetry import span
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+# Configuration for the shared virtual environment pool
+VENV_POOL_DIR = os.getenv(
+    "VENV_POOL_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "auto-python-agent", "venvs"),
+)
+VENV_POOL_MAX_ENVS = int(os.getenv("VENV_POOL_MAX_ENVS", "8"))
+VENV_POOL_MAX_BYTES = int(os.getenv("VENV_POOL_MAX_BYTES", str(10 * 1024 ** 3)))
+VENV_PYTHON = os.getenv("VENV_PYTHON", sys.executable)
+
+META_FILE = ".pool.json"
+LAST_USED_FILE = ".last_used"
+POOL_REQUIREMENTS_FILE = "pool-requirements.txt"
+
+
+class VenvSetupError(RuntimeError):
+    """Raised when a pooled environment cannot be created or populated."""
+
+    def __init__(self, stage, message):
+        super().__init__(message)
+        self.stage = stage
+
+
+def normalize_requirements(text):
+    """Return a sorted, de-duplicated list of requirement lines."""
+    requirements = set()
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        match = re.match(r"^([A-Za-z0-9][A-Za-z0-9._-]*)(.*)$", line)
+        if match:
+            name = re.sub(r"[-_.]+", "-", match.group(1)).lower()
+            line = name + re.sub(r"\s+", "", match.group(2))
+        requirements.add(line)
+    return sorted(requirements)
+
+
+def read_requirements(requirements_path):
+    """Read and normalize a requirements file; a missing file means no dependencies."""
+    if not requirements_path or not os.path.exists(requirements_path):
+        return []
+    with open(requirements_path, "r") as f:
+        return normalize_requirements(f.read())
+
+
+def requirements_key(requirements, python=VENV_PYTHON):
+    """Hash the normalized requirements together with the interpreter they target."""
+    digest = hashlib.sha256()
+    digest.update(f"{python}\n{sys.version_info[0]}.{sys.version_info[1]}\n".encode())
+    digest.update("\n".join(requirements).encode())
+    return digest.hexdigest()[:16]
+
+
+def venv_python(venv_path):
+    """Return the interpreter path inside a virtual environment."""
+    if sys.platform == "win32":
+        return os.path.join(venv_path, "Scripts", "python.exe")
+    return os.path.join(venv_path, "bin", "python")
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _site_packages(venv_path):
+    if sys.platform == "win32":
+        return os.path.join(venv_path, "Lib", "site-packages")
+    matches = glob.glob(os.path.join(venv_path, "lib", "python*", "site-packages"))
+    return matches[0] if matches else None
+
+
+def _scripts_dir(venv_path):
+    return os.path.join(venv_path, "Scripts" if sys.platform == "win32" else "bin")
+
+
+def _clone_packages(base_path, venv_path):
+    """Copy a base environment's installed packages into a freshly created venv.
+
+    site-packages is hardlinked. Console scripts embed their environment's path in the
+    shebang, so those are rewritten for the new prefix; the new venv keeps its own
+    interpreter links and activate scripts.
+    """
+    base_site, site = _site_packages(base_path), _site_packages(venv_path)
+    if not base_site or not site:
+        raise OSError("site-packages not found")
+    shutil.rmtree(site)
+    shutil.copytree(base_site, site, symlinks=True, copy_function=_link_or_copy)
+    old_prefix, new_prefix = os.path.abspath(base_path).encode(), os.path.abspath(venv_path).encode()
+    base_scripts, scripts = _scripts_dir(base_path), _scripts_dir(venv_path)
+    for name in os.listdir(base_scripts):
+        src, dst = os.path.join(base_scripts, name), os.path.join(scripts, name)
+        if os.path.lexists(dst) or os.path.isdir(src):
+            continue
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+            continue
+        with open(src, "rb") as f:
+            data = f.read()
+        if old_prefix not in data:
+            _link_or_copy(src, dst)
+            continue
+        with open(dst, "wb") as f:
+            f.write(data.replace(old_prefix, new_prefix))
+        shutil.copymode(src, dst)
+
+
+async def _run(*args):
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    return process.returncode, stderr.decode(errors="replace")
+
+
+class VenvPool:
+    """Content-addressed pool of prebuilt virtual environments shared across sandboxes."""
+
+    def __init__(self, root=VENV_POOL_DIR, max_envs=VENV_POOL_MAX_ENVS, max_bytes=VENV_POOL_MAX_BYTES, python=VENV_PYTHON):
+        self.root = root
+        self.max_envs = max_envs
+        self.max_bytes = max_bytes
+        self.python = python
+        self._locks = {}
+        self._prewarming = {}  # key -> background build task
+
+    def env_path(self, key):
+        return os.path.join(self.root, key)
+
+    def _ready(self, key):
+        return os.path.exists(os.path.join(self.env_path(key), META_FILE))
+
+    def _read_meta(self, key):
+        try:
+            with open(os.path.join(self.env_path(key), META_FILE), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @contextlib.asynccontextmanager
+    async def _exclusive(self, key):
+        """Hold the in-process and cross-process build lock for one key."""
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            os.makedirs(self.root, exist_ok=True)
+            fd = os.open(os.path.join(self.root, f"{key}.lock"), os.O_RDWR | os.O_CREAT)
+            try:
+                if fcntl:
+                    await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    @contextlib.asynccontextmanager
+    async def _shared(self, key):
+        """Hold a shared lock on an environment so eviction leaves it alone.
+
+        Callers must re-check _ready() once inside: the environment may have been
+        evicted while the lock was being acquired.
+        """
+        fd = os.open(os.path.join(self.root, f"{key}.lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            if fcntl:
+                await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(fd)
+
+    def _nearest_base(self, requirements):
+        """Find the ready environment whose requirements are the largest subset of ours."""
+        wanted = set(requirements)
+        best, best_size = None, -1
+        if not os.path.isdir(self.root):
+            return None
+        for key in os.listdir(self.root):
+            if key.endswith(".lock") or not self._ready(key):
+                continue
+            meta = self._read_meta(key)
+            if not meta or meta.get("python") != self.python:
+                continue
+            installed = set(meta.get("requirements", []))
+            if installed <= wanted and len(installed) > best_size:
+                best, best_size = key, len(installed)
+        return best
+
+    async def ensure(self, requirements):
+        """Make sure an environment for these requirements exists and return its key."""
+        key = requirements_key(requirements, self.python)
+        if self._ready(key):
+            return key
+        async with self._exclusive(key):
+            if self._ready(key):
+                return key
+            await self._build(key, requirements)
+        self._evict(keep=key)
+        return key
+
+    async def _create_venv(self, venv_path):
+        try:
+            with span("venv.create"):
+                returncode, stderr = await _run("uv", "venv", venv_path, "--python", self.python)
+        except Exception as e:
+            raise VenvSetupError("venv", str(e))
+        if returncode != 0:
+            shutil.rmtree(venv_path, ignore_errors=True)
+            raise VenvSetupError("venv", stderr)
+
+    async def _build(self, key, requirements):
+        venv_path = self.env_path(key)
+        if os.path.exists(venv_path):
+            shutil.rmtree(venv_path)  # Leftover from an interrupted build
+
+        await self._create_venv(venv_path)
+        base = self._nearest_base(requirements)
+        if base:
+            # Start from the closest existing environment's packages so only the delta gets installed
+            print(f"[INFO] Cloning environment {base} for {len(requirements)} requirement(s)")
+            try:
+                async with self._shared(base):
+                    if not self._ready(base):
+                        raise OSError("evicted")
+                    with span("venv.clone", base=base):
+                        await asyncio.to_thread(_clone_packages, self.env_path(base), venv_path)
+            except Exception as e:
+                print(f"[INFO] Could not clone environment {base}: {e}")
+                shutil.rmtree(venv_path, ignore_errors=True)
+                await self._create_venv(venv_path)
+
+        if requirements:
+            pool_requirements = os.path.join(venv_path, POOL_REQUIREMENTS_FILE)
+            with open(pool_requirements, "w") as f:
+                f.write("\n".join(requirements) + "\n")
+            try:
+                with span("venv.install", requirements=len(requirements)):
+                    returncode, stderr = await _run(
+                        "uv", "pip", "install", "-r", pool_requirements, "--python", venv_python(venv_path)
+                    )
+            except Exception as e:
+                shutil.rmtree(venv_path, ignore_errors=True)
+                raise VenvSetupError("install", str(e))
+            if returncode != 0:
+                shutil.rmtree(venv_path, ignore_errors=True)
+                raise VenvSetupError("install", stderr)
+
+        meta = {
+            "python": self.python,
+            "requirements": requirements,
+            "created": time.time(),
+            "size": await asyncio.to_thread(_dir_size, venv_path),
+        }
+        # The metadata file doubles as the "ready" marker, so it is written last
+        with open(os.path.join(venv_path, META_FILE), "w") as f:
+            json.dump(meta, f)
+        self._touch(key)
+
+    def _touch(self, key):
+        with open(os.path.join(self.env_path(key), LAST_USED_FILE), "w") as f:
+            f.write(str(time.time()))
+
+    def _last_used(self, key):
+        try:
+            return os.path.getmtime(os.path.join(self.env_path(key), LAST_USED_FILE))
+        except OSError:
+            return 0.0
+
+    def _evict(self, keep=None):
+        """Drop least recently used environments until the pool fits its limits."""
+        if not os.path.isdir(self.root):
+            return
+        entries = []
+        for key in os.listdir(self.root):
+            if key.endswith(".lock") or not self._ready(key):
+                continue
+            meta = self._read_meta(key) or {}
+            entries.append((self._last_used(key), key, meta.get("size", 0)))
+        entries.sort()
+        count = len(entries)
+        total = sum(size for _, _, size in entries)
+        for _, key, size in entries:
+            if count <= self.max_envs and total <= self.max_bytes:
+                break
+            if key == keep or (self._locks.get(key) and self._locks[key].locked()):
+                continue
+            fd = os.open(os.path.join(self.root, f"{key}.lock"), os.O_RDWR | os.O_CREAT)
+            try:
+                if fcntl:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue  # In use by another execution
+                shutil.rmtree(self.env_path(key), ignore_errors=True)
+                print(f"[INFO] Evicted pooled environment {key}")
+                count -= 1
+                total -= size
+            finally:
+                os.close(fd)
+
+    def prewarm(self, requirements):
+        """Start building an environment in the background, e.g. while the model is still replying.
+
+        A later ensure() for the same requirements waits on the same build lock and so joins
+        the work in flight instead of starting cold. Failures are only logged here; the
+        build is retried, and the error reported, by the execution that needs it.
+        """
+        key = requirements_key(requirements, self.python)
+        if self._ready(key) or key in self._prewarming:
+            return self._prewarming.get(key)
+        print(f"[INFO] Prewarming environment for {len(requirements)} requirement(s)")
+        task = asyncio.get_running_loop().create_task(self.ensure(requirements))
+        self._prewarming[key] = task
+        task.add_done_callback(lambda done: self._prewarmed(key, done))
+        return task
+
+    def _prewarmed(self, key, task):
+        self._prewarming.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[INFO] Prewarming environment {key} failed: {task.exception()}")
+
+    @contextlib.asynccontextmanager
+    async def lease(self, requirements_path):
+        """Yield the interpreter of a warm environment matching the requirements file."""
+        requirements = read_requirements(requirements_path)
+        while True:
+            key = await self.ensure(requirements)
+            async with self._shared(key):
+                if not self._ready(key):
+                    continue  # Evicted between ensure() and taking the lock: build it again
+                self._touch(key)
+                yield venv_python(self.env_path(key))
+                return
+
+
+# Shared pool used by the executor
+venv_pool = VenvPool()
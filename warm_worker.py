@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import shutil
+import socket
+import asyncio
+import tempfile
+from collections import OrderedDict
+
+# Run executions through a warm forkserver worker per pooled venv (off by default)
+WARM_WORKERS = os.getenv("WARM_WORKERS", "0").lower() in ("1", "true", "yes")
+WARM_WORKER_MAX = int(os.getenv("WARM_WORKER_MAX", "4"))
+WARM_WORKER_START_SECONDS = float(os.getenv("WARM_WORKER_START_SECONDS", "120"))
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "forkserver_worker.py")
+
+
+class WarmProcess:
+    """A program forked by a warm worker, with the parts of asyncio.subprocess.Process the executor uses."""
+
+    def __init__(self, pid, stdout, stderr, status, connection):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self.peak_rss = None
+        self._status = status  # Reader on the worker connection that delivers the exit status
+        self._connection = connection  # Its writer; dropping it would close the connection
+        self._waiter = None
+
+    async def _read_status(self):
+        line = await self._status.readline()
+        if not line:
+            raise ConnectionError("warm worker exited before reporting the exit status")
+        status = json.loads(line)
+        self.returncode = status["exit_code"]
+        self.peak_rss = status.get("peak_rss")
+        self._connection.close()
+        return self.returncode
+
+    async def wait(self):
+        # Safe to call repeatedly and concurrently, like Process.wait()
+        if self._waiter is None:
+            self._waiter = asyncio.ensure_future(self._read_status())
+        return await asyncio.shield(self._waiter)
+
+
+async def _pipe_reader(fd):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb", 0))
+    return reader
+
+
+class WarmWorker:
+    """A long-lived interpreter in one venv that has the requirements imported and forks per execution."""
+
+    def __init__(self, python_path, requirements):
+        self.python_path = python_path
+        self.requirements = requirements
+        self.identity = self._venv_identity()
+        self.directory = tempfile.mkdtemp(prefix="warm-worker-")
+        self.socket_path = os.path.join(self.directory, "worker.sock")
+        self.process = None
+        self.preloaded = []
+
+    def _venv_identity(self):
+        """Changes when the venv is evicted and rebuilt, which makes this worker stale."""
+        try:
+            st = os.lstat(self.python_path)  # The venv link itself, not the base interpreter
+            return st.st_ino, st.st_mtime_ns
+        except OSError:
+            return None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            self.python_path, WORKER_SCRIPT, self.socket_path, *self.requirements,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, cwd=self.directory
+        )
+        line = await asyncio.wait_for(self.process.stdout.readline(), WARM_WORKER_START_SECONDS)
+        if not line.startswith(b"ready "):
+            await self.stop()
+            raise RuntimeError("warm worker did not start")
+        self.preloaded = json.loads(line[len(b"ready "):])
+        print(f"[INFO] Warm worker ready with {len(self.preloaded)} preloaded module(s)")
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None and self._venv_identity() == self.identity
+
+    async def spawn(self, argv, cwd, limits):
+        """Fork a child running argv in cwd; returns a WarmProcess."""
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path)
+            request = json.dumps({"argv": argv, "cwd": os.path.abspath(cwd or "."), "limits": limits})
+            socket.send_fds(connection, [request.encode() + b"\n"], [stdout_write, stderr_write])
+        except Exception:
+            connection.close()
+            for fd in (stdout_read, stderr_read):
+                os.close(fd)
+            raise
+        finally:
+            os.close(stdout_write)
+            os.close(stderr_write)
+        connection.setblocking(False)
+        status, writer = await asyncio.open_unix_connection(sock=connection)
+        line = await status.readline()
+        if not line:
+            for fd in (stdout_read, stderr_read):
+                os.close(fd)
+            writer.close()
+            raise ConnectionError("warm worker closed the connection")
+        pid = json.loads(line)["pid"]
+        return WarmProcess(pid, await _pipe_reader(stdout_read), await _pipe_reader(stderr_read), status, writer)
+
+    async def stop(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class WarmWorkerPool:
+    """At most WARM_WORKER_MAX warm workers, one per venv interpreter, least recently used first out.
+
+    A venv without a worker runs its execution cold while a worker starts in the background,
+    so changed requirements (a different venv) always fall back to a cold start.
+    """
+
+    def __init__(self, max_workers=WARM_WORKER_MAX):
+        self.max_workers = max_workers
+        self.workers = OrderedDict()  # python path -> WarmWorker
+        self._starting = {}
+
+    def get(self, python_path, requirements):
+        """Return a ready worker for this interpreter, or None after starting one for next time."""
+        worker = self.workers.get(python_path)
+        if worker is not None:
+            if worker.alive:
+                self.workers.move_to_end(python_path)
+                return worker
+            self.discard(python_path)
+        if sys.platform != "win32" and python_path not in self._starting:
+            self._starting[python_path] = asyncio.get_running_loop().create_task(
+                self._start(python_path, requirements)
+            )
+        return None
+
+    async def _start(self, python_path, requirements):
+        worker = WarmWorker(python_path, requirements)
+        try:
+            await worker.start()
+        except Exception as e:
+            print(f"[INFO] Could not start warm worker: {e}")
+            await worker.stop()
+            return
+        finally:
+            self._starting.pop(python_path, None)
+        self.workers[python_path] = worker
+        while len(self.workers) > self.max_workers:
+            _, oldest = self.workers.popitem(last=False)
+            await oldest.stop()
+
+    def discard(self, python_path):
+        worker = self.workers.pop(python_path, None)
+        if worker is not None:
+            asyncio.get_running_loop().create_task(worker.stop())
+
+
+warm_workers = WarmWorkerPool()